@@ -0,0 +1,129 @@
+import os
+import shutil
+
+# The environment variables which configure a backend, the arguments of a backend take precedence
+ENV_HOME = 'DSSAT_HOME'
+ENV_MODEL = 'DSSAT_MODEL'
+ENV_R = 'DSSAT_R'
+ENV_VERSION = 'DSSAT_VERSION'
+# The crop models whose .CUL files are <model><version>.CUL, e.g. MZCER047.CUL
+CROP_MODELS = {'maize': 'MZCER', 'rice': 'RICER'}
+R_PATH = r'C:\Program Files\R\R-3.4.0\bin\R.exe'
+
+
+class Backend(object):
+    """
+    How the programs of a Dssat installed directory are named and launched. Every command is a list of arguments
+    which is run without shell. The subclasses only differ in their defaults.
+    """
+    # The defaults of subclasses, model_name is formatted with version
+    default_home = None
+    default_version = None
+    model_name = None
+    default_r = None
+    # Hard link .X files into the crop directory instead of copying them
+    link = False
+
+    def __init__(self, model=None, r_path=None, version=None, home=None):
+        """
+        :param model: The DSSAT model executable, as a path or a name on PATH. None means $DSSAT_MODEL,
+            or model_name in Dssat installed directory, or model_name on PATH.
+        :param r_path: The R executable to run GLUE, R reads Glue.r from stdin and Rscript gets it as argument.
+            None means $DSSAT_R or default_r.
+        :param version: The 3 digits DSSAT version of file names, e.g. '047'. None means $DSSAT_VERSION or
+            default_version.
+        :param home: The Dssat installed directory used when DSSAT gets none. None means $DSSAT_HOME or
+            default_home formatted with version.
+        """
+        self.version = version or os.environ.get(ENV_VERSION) or self.default_version
+        model = model or os.environ.get(ENV_MODEL)
+        self.model = (shutil.which(model) or model) if model else None
+        self.r_path = r_path or os.environ.get(ENV_R) or self.default_r
+        self._home = home or os.environ.get(ENV_HOME)
+
+    def home(self, run_path=None):
+        """
+        :return: run_path if it is given, else the Dssat installed directory of the backend.
+        """
+        return run_path or self._home or self.default_home.format(version=self.version)
+
+    def cul_name(self, crop_type):
+        """
+        :return: The name of .CUL file of crop_type without suffix, e.g. MZCER047.
+        """
+        return CROP_MODELS[crop_type] + self.version
+
+    @property
+    def batch_name(self):
+        """
+        The name of batch file in the crop directory, e.g. DSSBatch.v47.
+        """
+        return 'DSSBatch.v%s' % self.version[1:]
+
+    def model_path(self, run_path):
+        """
+        :return: The path to DSSAT model executable of the Dssat installed directory run_path.
+        """
+        if self.model is not None:
+            return self.model
+        name = self.model_name.format(version=self.version)
+        path = os.path.join(run_path, name)
+        if os.path.exists(path) or shutil.which(name) is None:
+            return path
+        return shutil.which(name)
+
+    def model_command(self, run_path, cul_file, simulation_model, batch_path):
+        """
+        :param cul_file: The name of .CUL file, e.g. MZCER047.CUL.
+        :param simulation_model: The simulation model, see DSSAT.run.
+        :param batch_path: The path to batch file.
+        :return: The command line to run DSSAT model.
+        """
+        return [self.model_path(run_path), cul_file, simulation_model, batch_path]
+
+    def glue_command(self, glue_r):
+        """
+        :param glue_r: The path to Glue.r.
+        :return: The command line to run GLUE, and the file to use as its stdin or None.
+        """
+        if os.path.basename(self.r_path).lower().startswith('rscript'):
+            return [self.r_path, glue_r], None
+        return [self.r_path, '--slave'], glue_r
+
+    def __repr__(self):
+        return '%s(model=%r, r_path=%r, version=%r)' % (type(self).__name__, self.model, self.r_path, self.version)
+
+
+class WindowsBackend(Backend):
+    """
+    DSCSM047.EXE and R.exe of a Dssat installed directory on Windows.
+    """
+    default_home = r'C:\DSSAT47'
+    default_version = '047'
+    model_name = 'DSCSM{version}.EXE'
+    default_r = R_PATH
+
+
+class PosixBackend(Backend):
+    """
+    dscsm048 built from DSSAT-CSM sources and Rscript on Linux or macOS, installed to /usr/local/dscsm048
+    by default. Setting DSSAT_VERSION=047 runs a 4.7 build.
+    """
+    default_home = '/usr/local/dscsm{version}'
+    default_version = '048'
+    model_name = 'dscsm{version}'
+    default_r = 'Rscript'
+    link = True
+
+
+BACKENDS = {'windows': WindowsBackend, 'posix': PosixBackend}
+
+
+def create_backend(name=None, **kwargs):
+    """
+    :param name: One of BACKENDS, None means the backend of current OS.
+    :param kwargs: The params of Backend, such as r_path.
+    """
+    if name is None:
+        name = 'windows' if os.name == 'nt' else 'posix'
+    return BACKENDS[name](**kwargs)
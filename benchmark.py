@@ -0,0 +1,395 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import utils
+
+
+def synthetic_sheet(rows, rows_per_file=50, cultivars=5, fertilizers=3, seed=0):
+    """
+    Create a summary DataFrame in the form of input xlsx file with random values.
+    :param rows: The number of rows.
+    :param rows_per_file: The average number of treatments in each .X file.
+    :param cultivars: The number of cultivars in each .X file.
+    :param fertilizers: The number of fertilizer levels in each .X file.
+    :param seed: The seed of random.
+    :return: DataFrame with every column as str.
+    """
+    rng = random.Random(seed)
+    crops = ['maize', 'rice']
+    files = max(1, rows // rows_per_file)
+    data = []
+    for _ in range(rows):
+        f = rng.randrange(files)
+        c = rng.randrange(cultivars)
+        ft = rng.randrange(fertilizers)
+        data.append({'crop_type': crops[f % 2],
+                     'file_name': 'UAFD%02d%02d' % (6 + f // 100 % 10, f % 100),
+                     'ingeno': '99%04d' % c,
+                     'cname': 'CULTIVAR %d' % c,
+                     'weather': 'UAFD',
+                     'soil': 'IB00000001',
+                     'PDATE': '06123',
+                     'EDATE': '06130',
+                     'FERTILIZERS': '06%03d FE001 AP001 5 %d 0 0' % (123 + ft, 10 * (ft + 1))})
+    return pd.DataFrame(data, dtype=str)
+
+
+def _legacy_create_xfile_dict(df):
+    """
+    The nested boolean masks and per-row iloc of create_input_files before it used groupby, kept for comparison.
+    """
+    xfile_dict = {}
+    for c in np.unique(df['crop_type']):
+        xfile_dict.update({c: {}})
+        for f in np.unique(df[df['crop_type'] == c]['file_name']):
+            xfile_dict[c].update({f: {}})
+            xfile_dict[c][f].update({'details': []})
+            df_c = df[df['crop_type'] == c]
+            df_c_f = df_c[df_c['file_name'] == f]
+            xfile_dict[c][f].update({'culitvar': {}})
+            xfile_dict[c][f].update({'ing-cname': {}})
+            for i, ing in enumerate(np.unique(df_c_f['ingeno'])):
+                xfile_dict[c][f]['culitvar'].update({ing: i + 1})
+                xfile_dict[c][f]['ing-cname'].update(
+                    {ing: str(np.unique((df_c_f[df_c_f['ingeno'] == ing])['cname'])[0])})
+            xfile_dict[c][f].update({'fertilizer': {}})
+            for i, ft in enumerate(np.unique(df_c_f['FERTILIZERS'])):
+                xfile_dict[c][f]['fertilizer'].update({ft: i + 1})
+    for i in range(len(df)):
+        df_line = df.iloc[i, :]
+        xfile_dict[df_line['crop_type']][df_line['file_name']]['details'].append(
+            {k: df_line[k] for k in utils.DETAIL_COLUMNS})
+    return xfile_dict
+
+
+def _legacy_create_xfile(out_path, crop_type, file_name, file_dict):
+    """
+    The _create_xfile before XFileWriter, which renders and writes the whole file once for every treatment,
+    kept for comparison.
+    """
+    details_array = file_dict['details']
+    suffixes = {'maize': '.MZX', 'rice': '.RIX'}
+    abbreviation = {'maize': 'MZ', 'rice': 'RI'}
+    pdate = details_array[0]['PDATE']
+    year = ''.join(list(filter(str.isnumeric, file_name))[:2])
+    now = datetime.datetime.now().year.__str__()[-2:]
+    year = ('20' if int(now) >= int(year) else '19') + year
+    station = ''.join(list(filter(str.isalpha, file_name)))
+    treatments = ''
+    for i, d in enumerate(details_array):
+        treatments += '{number:2d} 1 1 0 {cname:<26}{cultivar:2}  1  0  1  1  1{ml:>3}  1  0  0  0  0  1\n'.format(
+            number=i + 1, cname=file_dict['ing-cname'][d['ingeno']], cultivar=file_dict['culitvar'][d['ingeno']],
+            ml=file_dict['fertilizer'][d['FERTILIZERS']])
+        cultivars = ''
+        for ing, idx in file_dict['culitvar'].items():
+            cultivars += '{cultivar:2d} {abbreviation} {ingeno} {cname}\n'.format(
+                cultivar=idx, abbreviation=abbreviation[crop_type], ingeno=ing, cname=file_dict['ing-cname'][ing])
+        fertilizer = ''
+        for fts, idx in file_dict['fertilizer'].items():
+            for ft in fts.split(';'):
+                fertilizer += '{0:2d} {1:5}{2:>6}{3:>6}{4:>6}{5:>6}{6:>6}{7:>6}   -99   -99   -99 -99\n'.format(
+                    int(idx), *(ft.strip().split(' ')))
+        base_file = utils.XFILE_TEMPLATE.format(
+            file_name=file_name, abbreviation=abbreviation[crop_type], treatments=treatments, cultivars=cultivars,
+            weather=details_array[0]['weather'], soil=details_array[0]['soil'], station=station, year=year,
+            PDATE=pdate, PDATE_minus_1=int(pdate) - 1, EDATE=details_array[0]['EDATE'], fertilizer=fertilizer)
+        with open(os.path.join(out_path, file_name + suffixes[crop_type]), 'w', encoding='utf-8') as fp:
+            fp.write(base_file)
+
+
+def _timeit(func, *args, repeat=3):
+    """
+    :return: The best wall time of func(*args) in seconds and its result.
+    """
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        cost = time.perf_counter() - start
+        best = cost if best is None else min(best, cost)
+    return best, result
+
+
+def bench_input_files(sizes, repeat=3, legacy_limit=10000):
+    """
+    Compare the old and new way of reorganizing input data on synthetic sheets.
+    :param sizes: The numbers of rows.
+    :param repeat: Times to repeat, the best one is reported.
+    :param legacy_limit: The old way is skipped for sheets bigger than it.
+    """
+    print('%10s %12s %12s %9s' % ('rows', 'legacy(s)', 'groupby(s)', 'speedup'))
+    for rows in sizes:
+        df = synthetic_sheet(rows)
+        new, new_dict = _timeit(utils._create_xfile_dict, df, repeat=repeat)
+        if rows > legacy_limit:
+            print('%10d %12s %12.4f %9s' % (rows, '-', new, '-'))
+            continue
+        old, old_dict = _timeit(_legacy_create_xfile_dict, df, repeat=repeat)
+        assert old_dict == new_dict, 'groupby result differs from the legacy one'
+        print('%10d %12.4f %12.4f %8.1fx' % (rows, old, new, old / new))
+
+
+def bench_xfile(treatment_counts, repeat=3):
+    """
+    Compare the cost of writing a single .X file by the old and new way with different numbers of treatments.
+    :param treatment_counts: The numbers of treatments in the .X file.
+    :param repeat: Times to repeat, the best one is reported.
+    """
+    print('%10s %12s %12s %9s' % ('treatments', 'legacy(ms)', 'writer(ms)', 'speedup'))
+    out_path = tempfile.mkdtemp(prefix='pydssat_bench_')
+    for n in treatment_counts:
+        df = synthetic_sheet(n, rows_per_file=n)
+        file_dict = utils._create_xfile_dict(df)['maize']['UAFD0600']
+        path = os.path.join(out_path, 'UAFD0600.MZX')
+        old, _ = _timeit(_legacy_create_xfile, out_path, 'maize', 'UAFD0600', file_dict, repeat=repeat)
+        with open(path, encoding='utf-8') as fp:
+            old_text = fp.read()
+        new, _ = _timeit(utils._create_xfile, out_path, 'maize', 'UAFD0600', file_dict, repeat=repeat)
+        with open(path, encoding='utf-8') as fp:
+            assert fp.read() == old_text, 'XFileWriter result differs from the legacy one'
+        print('%10d %12.3f %12.3f %8.1fx' % (n, old * 1000, new * 1000, old / new))
+        os.remove(path)
+    os.rmdir(out_path)
+
+
+def bench_import(module='run_model', budget_ms=200.0, repeat=3, forbidden=('torch', 'pandas', 'numpy')):
+    """
+    Measure the time to import module in a fresh interpreter with `python -X importtime`.
+    :param module: The module to import.
+    :param budget_ms: The budget of cumulative import time in milliseconds.
+    :param repeat: Times to repeat, the best one is reported.
+    :param forbidden: The heavy packages which must not be imported with module.
+    :return: 0 if the import is in budget and without forbidden packages, else 1.
+    """
+    best, imported = None, set()
+    for _ in range(repeat):
+        proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            print(stderr)
+            return 1
+        # import time: self [us] | cumulative | imported package
+        cumulative = None
+        for line in stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            fields = line[len('import time:'):].split('|')
+            name = fields[2].rstrip()
+            imported.add(name.strip().split('.')[0])
+            if name.strip() == module and not name.startswith('  '):
+                cumulative = int(fields[1]) / 1000
+        if cumulative is not None:
+            best = cumulative if best is None else min(best, cumulative)
+
+    heavy = sorted(imported & set(forbidden))
+    print('import %s: %.1f ms (budget %.1f ms)' % (module, best, budget_ms))
+    if heavy:
+        print('Heavy packages imported: %s' % ', '.join(heavy))
+    return 0 if best <= budget_ms and not heavy else 1
+
+
+# The model executable of the fake install, which writes PlantGro.OUT and Summary.OUT for every line of DSSBatch
+STUB_MODEL = r'''#!{python}
+import os, sys
+days = int(os.environ.get('STUB_DAYS', '150'))
+with open(sys.argv[3]) as fp:
+    lines = fp.read().splitlines()
+entries = [(line[:92].strip(), line[92:99].strip()) for line in lines[lines.index(next(
+    line for line in lines if line.startswith('@FILEX'))) + 1:] if line.strip()]
+plant = ['$GROWTH ASPECTS OUTPUT FILE', '']
+summary = ['*SUMMARY : STUB', '', '!IDENTIFIERS',
+           '@   RUNNO   TRNO R# O# P# CR MODEL... EXNAME.. TNAM..................... FNAM.... WSTA.... '
+           'SOIL_ID...    HWAM']
+for run, (path, trtno) in enumerate(entries, 1):
+    exname = os.path.splitext(os.path.basename(path))[0]
+    plant += ['*DSSAT Cropping System Model Ver. 4.7.5.001 STUB', '', '*RUN %3d        : STUB' % run,
+              ' MODEL          : %s' % sys.argv[1][:8], ' EXPERIMENT     : %s %s STUB' % (exname, sys.argv[1][:2]),
+              ' TREATMENT%3s   : STUB' % trtno, '',
+              '@YEAR DOY   DAS   DAP   L#SD   LAID   CWAD   GWAD']
+    plant += [' 2006 %3d %5d %5d %6.1f %6.2f %6d %6d' % (123 + d % 240, d, d, d / 10.0, d / 50.0, d * 40,
+                                                          max(0, d - 60) * 30) for d in range(days)]
+    plant.append('')
+    summary.append('%8d %6s  1  0  1 %s %s %s %-26s-99      UAFD     IB00000001 %7d'
+                   % (run, trtno, sys.argv[1][:2], sys.argv[1][:8], exname, 'CULTIVAR ' + trtno, 5000 + run))
+with open('PlantGro.OUT', 'w') as fp:
+    fp.write('\n'.join(plant) + '\n')
+with open('Summary.OUT', 'w') as fp:
+    fp.write('\n'.join(summary) + '\n')
+print('Stub model: %d runs' % len(entries))
+'''
+# The R executable of the fake install, which writes the calibrated .CUL line of the cultivar in Glue.r.
+# It reads Glue.r from its argument as Rscript, or from stdin as R.
+STUB_R = r'''#!{python}
+import os, re, sys
+if len(sys.argv) > 1 and not sys.argv[-1].startswith('-'):
+    with open(sys.argv[-1]) as fp:
+        text = fp.read()
+else:
+    text = sys.stdin.read()
+od = re.search(r'OD<-"([^"]+)"', text).group(1)
+batch = re.search(r'CultivarBatchFile<-"([^"]+)"', text).group(1)
+with open(os.path.join(od, batch)) as fp:
+    head = fp.readline().split(':', 1)[1].strip()
+with open(os.path.join(od, head + '.CUL'), 'w') as fp:
+    fp.write('%-6s %-21s. IB0001 120.0 0.000 685.0 907.9 10.00 38.90\n' % (head[2:8], head[9:]))
+print('Stub GLUE: %s' % head)
+'''
+# The .CUL files of the fake install by crop type, {name} is the name of .CUL file without suffix
+CUL_HEADERS = {
+    'maize': ['*MAIZE CULTIVAR COEFFICIENTS: {name} MODEL', '!',
+              '@VAR#  VRNAME.......... EXPNO   ECO#    P1    P2    P5    G2    G3 PHINT',
+              'IB0001 CORNL281          . IB0001 110.0 0.300 685.0 907.9 10.00 38.90'],
+    'rice': ['*RICE CULTIVAR COEFFICIENTS: {name} MODEL', '!',
+             '@VAR#  VAR-NAME........ EXPNO   ECO#    P1   P2R    P5   P2O    G1    G2    G3 PHINT',
+             'IB0001 IR 8              . IB0001 880.0  52.0 550.0  12.1  65.0 .0280  1.00  1.00  83.0   1.0'],
+}
+
+
+def fake_install(path, name='posix', version=None):
+    """
+    Create a fake Dssat installed directory with stub model and R executables, which runs on Linux.
+    :param path: The directory to create.
+    :param name: The backend whose file names and R are used, see backend.BACKENDS.
+    :param version: Optional DSSAT version of file names, the default of backend if None.
+    :return: The backend.Backend which runs the stub executables of path.
+    """
+    from backend import create_backend
+    r_path = os.path.join(path, 'R' if name == 'windows' else 'Rscript')
+    backend = create_backend(name, r_path=r_path, version=version, home=path)
+    for directory in ('Genotype', 'Maize', 'Rice', 'GLWork', os.path.join('Tools', 'GLUE'), 'Weather', 'Soil'):
+        os.makedirs(os.path.join(path, directory))
+    for crop_type, lines in CUL_HEADERS.items():
+        cul_name = backend.cul_name(crop_type)
+        with open(os.path.join(path, 'Genotype', cul_name + '.CUL'), 'w', encoding='utf-8') as fp:
+            fp.write('\n'.join(lines).format(name=cul_name) + '\n')
+    with open(os.path.join(path, 'Tools', 'GLUE', 'Glue.r'), 'w') as fp:
+        fp.write('WD<-"%s";\nOD<-"%s";\nGD<-"%s";\nCultivarBatchFile<-"NONE.MZC";\n' % (
+            os.path.join(path, 'Tools', 'GLUE'), os.path.join(path, 'GLWork'), os.path.join(path, 'Genotype')))
+    with open(os.path.join(path, 'Tools', 'GLUE', 'SimulationControl.csv'), 'w') as fp:
+        fp.write('Parameter,Value\nNumberOfModelRun,5000\nGLUEFlag,1\n')
+    with open(os.path.join(path, 'Weather', 'UAFD0601.WTH'), 'w') as fp:
+        fp.write('*WEATHER DATA : STUB\n')
+    with open(os.path.join(path, 'Soil', 'IB.SOL'), 'w') as fp:
+        fp.write('*SOILS: STUB\n')
+    for exe, text in ((backend.model_path(path), STUB_MODEL), (r_path, STUB_R)):
+        with open(exe, 'w') as fp:
+            fp.write(text.replace('{python}', sys.executable))
+        os.chmod(exe, os.stat(exe).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return backend
+
+
+def _stage(records, name, rows, func, *args):
+    """
+    Run func(*args) with its prints muted, and record its wall time and the peak memory allocated by Python.
+    :return: The result of func.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(*args)
+    cost = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    records.append({'stage': name, 'rows': rows, 'seconds': round(cost, 6), 'peak_kb': round(peak / 1024.0, 1)})
+    print('%10d %-20s %12.4f %12.1f' % (rows, name, cost, peak / 1024.0))
+    return result
+
+
+def bench_pipeline(sizes, calls=2, epochs=10, json_path=None, keep=None):
+    """
+    Run every stage of the pipeline on synthetic sheets against a fake Dssat installed directory.
+    :param sizes: The numbers of rows of synthetic sheets.
+    :param calls: The number of .X files run by a full DSSAT.__call__ (GLUE and the model) for each size.
+    :param epochs: The epochs passed to GLUE.
+    :param json_path: Optional path to write the records as JSON, for tracking regressions.
+    :param keep: Optional directory to keep the fake install and outputs in, a temporary one is removed if None.
+    :return: [{'stage':.., 'rows':.., 'seconds':.., 'peak_kb':..}, ...]
+    """
+    from dssat import DSSAT
+    root = keep or tempfile.mkdtemp(prefix='pydssat_pipeline_')
+    records = []
+    print('%10s %-20s %12s %12s' % ('rows', 'stage', 'seconds', 'peak(KB)'))
+    try:
+        for rows in sizes:
+            work = os.path.join(root, str(rows))
+            run_path = os.path.join(work, 'DSSAT')
+            backend = fake_install(run_path)
+            crop_path = os.path.join(work, 'output')
+            os.makedirs(crop_path)
+            sheet = os.path.join(work, 'input.csv')
+            synthetic_sheet(rows).to_csv(sheet, index=False)
+
+            _stage(records, 'create_input_files', rows, utils.create_input_files, sheet, work)
+            _stage(records, 'create_xfile', rows, utils.create_xfile, os.path.join(work, 'xfile.json'), crop_path)
+            x_files = sorted(os.path.join(crop_path, fn) for fn in os.listdir(crop_path))
+            experiments = _stage(records, 'DSSAT.__init__', rows,
+                                 lambda: [DSSAT(x, run_path, backend=backend) for x in x_files])
+            cultivars = _stage(records, '_search_treatments', rows,
+                               lambda: [list(zip(*d._search_treatments())) for d in experiments])
+            _stage(records, 'create_DSSBatch', rows, lambda: [d.create_DSSBatch() for d in experiments])
+            _stage(records, 'genotype_update', rows,
+                   lambda: [d._genotype_store(c).flush() for d, c in zip(experiments, cultivars)])
+            _stage(records, 'DSSAT.__call__', rows,
+                   lambda: [d(os.path.join(work, 'result'), epochs) for d in experiments[:calls]])
+    finally:
+        if keep is None:
+            shutil.rmtree(root, ignore_errors=True)
+    if json_path is not None:
+        with open(json_path, 'w', encoding='utf-8') as fp:
+            json.dump({'python': sys.version.split()[0], 'records': records}, fp, indent=1)
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of pydssat')
+    subparsers = parser.add_subparsers(dest='bench')
+    input_files = subparsers.add_parser('input-files', help='create_input_files on synthetic sheets')
+    input_files.add_argument('--rows', '-r', type=int, nargs='+', default=[1000, 10000, 100000],
+                             help='numbers of rows of synthetic sheets')
+    input_files.add_argument('--repeat', type=int, default=3, help='times to repeat each benchmark')
+    input_files.add_argument('--legacy-limit', type=int, default=10000,
+                             help='skip the legacy path for sheets bigger than it')
+    xfile = subparsers.add_parser('xfile', help='per-file cost of _create_xfile vs. treatment count')
+    xfile.add_argument('--treatments', '-t', type=int, nargs='+', default=[1, 10, 50, 99],
+                       help='numbers of treatments in the .X file')
+    xfile.add_argument('--repeat', type=int, default=3, help='times to repeat each benchmark')
+    import_time = subparsers.add_parser('import', help='import time of a module with a budget check')
+    import_time.add_argument('--module', '-m', default='run_model', help='module to import')
+    import_time.add_argument('--budget', '-b', type=float, default=200.0, help='budget in milliseconds')
+    import_time.add_argument('--repeat', type=int, default=3, help='times to repeat each benchmark')
+    pipeline = subparsers.add_parser('pipeline', help='every stage against a fake install with stub executables')
+    pipeline.add_argument('--rows', '-r', type=int, nargs='+', default=[100, 1000, 10000],
+                          help='numbers of rows of synthetic sheets')
+    pipeline.add_argument('--calls', '-c', type=int, default=2, help='number of .X files run by DSSAT.__call__')
+    pipeline.add_argument('--epochs', '-e', type=int, default=10, help='epochs of GLUE')
+    pipeline.add_argument('--json', '-j', help='path to write the results as JSON')
+    pipeline.add_argument('--keep', help='directory to keep the fake install and outputs in')
+
+    args = parser.parse_args()
+    if args.bench == 'input-files':
+        bench_input_files(args.rows, args.repeat, args.legacy_limit)
+    elif args.bench == 'xfile':
+        bench_xfile(args.treatments, args.repeat)
+    elif args.bench == 'import':
+        sys.exit(bench_import(args.module, args.budget, args.repeat))
+    elif args.bench == 'pipeline':
+        bench_pipeline(args.rows, args.calls, args.epochs, args.json, args.keep)
+    else:
+        parser.print_help()
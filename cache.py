@@ -0,0 +1,255 @@
+import filecmp
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+# {path: (st_mtime_ns, st_size, sha256)} of input files which are hashed again and again, such as weather files
+_DIGESTS = {}
+
+
+def file_digest(path):
+    """
+    :return: sha256 of the content of path, which is remembered until its modified time or size changes.
+    """
+    stat = os.stat(path)
+    cached = _DIGESTS.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(block)
+    _DIGESTS[path] = (stat.st_mtime_ns, stat.st_size, sha.hexdigest())
+    return _DIGESTS[path][2]
+
+
+def sync_file(src, dst, link=False):
+    """
+    Make dst the same as src in process. Nothing is written if dst has the same content, so that it keeps
+    its modified time. dst is replaced by rename, which never writes through a hard link of dst.
+    :param link: Hard link dst to src if possible, instead of copying.
+    :return: True if dst is written.
+    """
+    if os.path.exists(dst) and (os.path.samefile(src, dst) or filecmp.cmp(src, dst, shallow=False)):
+        return False
+    tmp_path = os.path.join(os.path.dirname(dst), '.%s.tmp' % os.path.basename(dst))
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    if link:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            # Across devices
+            link = False
+    if not link:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+    return True
+
+
+def break_links(path):
+    """
+    Remove the files of directory path which have other hard links, e.g. the outputs restored by ResultCache,
+    so that a program writing path can't rewrite the other copies through them.
+    """
+    for fn in os.listdir(path):
+        fn = os.path.join(path, fn)
+        if os.path.isfile(fn) and os.stat(fn).st_nlink > 1:
+            os.remove(fn)
+
+
+def hash_parts(parts):
+    """
+    :param parts: [(name, str or bytes), ...]
+    :return: The hex sha256 of parts.
+    """
+    sha = hashlib.sha256()
+    for name, value in parts:
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        sha.update(('%s:%d:' % (name, len(value))).encode('utf-8'))
+        sha.update(value)
+    return sha.hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, root, max_bytes=10 * 1024 ** 3, link=True):
+        """
+        A content-addressed cache of the output directories of DSSAT model.
+        Every entry lives in root/key[:2]/key, where key is the hash of everything deciding the outputs.
+        Entries are evicted by the least recent use when the cache grows bigger than max_bytes.
+        :param root: The directory of cache.
+        :param max_bytes: The size limit of cache in bytes.
+        :param link: Restore and store files by hard links if possible, else by copies.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.link = link
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    @staticmethod
+    def key(parts):
+        """
+        :param parts: [(name, str or bytes), ...] which decide the outputs, see DSSAT._result_key.
+        :return: The hex sha256 of parts.
+        """
+        return hash_parts(parts)
+
+    def _entry(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _put(self, src, dst):
+        if os.path.exists(dst):
+            os.remove(dst)
+        if self.link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(src, dst)
+
+    def restore(self, key, output_path):
+        """
+        Restore the files of key into output_path.
+        :return: True if key is in cache.
+        """
+        entry = self._entry(key)
+        try:
+            for fn in os.listdir(entry):
+                self._put(os.path.join(entry, fn), os.path.join(output_path, fn))
+            os.utime(entry)
+        except OSError:
+            # key is not in cache, or it was evicted by another process meanwhile
+            self.stats['misses'] += 1
+            return False
+        self.stats['hits'] += 1
+        return True
+
+    def release(self, output_path):
+        """
+        Remove the files of output_path which are hard links of cache,
+        so that DSSAT model can't rewrite the cache through them.
+        """
+        break_links(output_path)
+
+    def store(self, key, output_path):
+        """
+        Keep the files of output_path as the entry of key, then evict old entries if cache is too big.
+        """
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        if not os.path.exists(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix='.tmp_', dir=self.root)
+        try:
+            for fn in os.listdir(output_path):
+                if os.path.isfile(os.path.join(output_path, fn)):
+                    self._put(os.path.join(output_path, fn), os.path.join(tmp_path, fn))
+            os.rename(tmp_path, entry)
+        except OSError:
+            # Another process has stored the same key
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+        self.stats['stores'] += 1
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until cache is not bigger than max_bytes.
+        """
+        entries, total = [], 0
+        for prefix in os.listdir(self.root):
+            prefix_path = os.path.join(self.root, prefix)
+            if prefix.startswith('.') or not os.path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                entry = os.path.join(prefix_path, key)
+                try:
+                    size = sum(e.stat().st_size for e in os.scandir(entry) if e.is_file())
+                    entries.append((os.stat(entry).st_mtime, size, entry))
+                except OSError:
+                    continue
+                total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.stats['evictions'] += 1
+
+    def merge_stats(self, stats):
+        """
+        Add stats of the same cache used in other processes.
+        """
+        for name, value in stats.items():
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def summary(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return 'Result cache: %d hits, %d misses (%.1f%% hit rate), %d stored, %d evicted' % (
+            self.stats['hits'], self.stats['misses'], 100.0 * self.stats['hits'] / total if total else 0.0,
+            self.stats['stores'], self.stats['evictions'])
+
+
+class CalibrationCache(object):
+    def __init__(self, path):
+        """
+        A SQLite file of the .CUL lines calibrated by GLUE, so that GLUE is not run again for a cultivar
+        whose treatments, observed data, epochs and glue_flag are the same.
+        :param path: The path to SQLite file, which is created if it doesn't exist.
+        """
+        self.path = path
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0}
+        self._conn = sqlite3.connect(path, timeout=60)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS calibrations (key TEXT PRIMARY KEY, crop_type TEXT, '
+                               'ingeno TEXT, cname TEXT, line TEXT, created REAL)')
+
+    @staticmethod
+    def key(parts):
+        """
+        :param parts: [(name, str or bytes), ...] which decide the calibration, see DSSAT._calibration_key.
+        :return: The hex sha256 of parts.
+        """
+        return hash_parts(parts)
+
+    def get(self, key):
+        """
+        :return: The calibrated .CUL line of key, None if it isn't in cache.
+        """
+        row = self._conn.execute('SELECT line FROM calibrations WHERE key = ?', (key,)).fetchone()
+        self.stats['misses' if row is None else 'hits'] += 1
+        return None if row is None else row[0]
+
+    def put(self, key, crop_type, ingeno, cname, line):
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO calibrations VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, crop_type, ingeno, cname, line.rstrip('\r\n'), time.time()))
+        self.stats['stores'] += 1
+
+    def invalidate(self, crop_type=None, ingeno=None):
+        """
+        Drop the calibrations of a cultivar, of a crop type, or all of them if no argument is given.
+        :return: The number of calibrations dropped.
+        """
+        conditions = [(name, value) for name, value in (('crop_type', crop_type), ('ingeno', ingeno))
+                      if value is not None]
+        sql = 'DELETE FROM calibrations'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join('%s = ?' % name for name, _ in conditions)
+        with self._conn:
+            return self._conn.execute(sql, [value for _, value in conditions]).rowcount
+
+    def close(self):
+        self._conn.close()
+
+    def summary(self):
+        return 'Calibration cache: %d hits, %d misses, %d stored' % (
+            self.stats['hits'], self.stats['misses'], self.stats['stores'])
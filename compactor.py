@@ -0,0 +1,126 @@
+import fnmatch
+import hashlib
+import json
+import os
+import tarfile
+
+# The outputs kept by default, patterns are matched without case
+DEFAULT_KEEP = ('Summary.OUT', 'Evaluate.OUT', 'ERROR.OUT', 'WARNING.OUT', '*.parquet', '*.feather')
+ARCHIVES = ('gz', 'zst')
+MANIFEST = 'manifest.json'
+
+
+class Compactor(object):
+    def __init__(self, keep=DEFAULT_KEEP, archive=None, workers=1):
+        """
+        The post-run stage which prunes the output directory of a run written by DSSAT.run.
+        Files which don't match keep are deleted (out.txt, daily outputs, ...), the kept files are optionally
+        packed into one archive, and a manifest with their sizes and sha256 is written.
+        Directories are compacted by a pool of threads, so that compaction overlaps the next run.
+        :param keep: The patterns of file names to keep.
+        :param archive: Optional 'gz' or 'zst' to pack the kept files into <file_name>.tar.gz/.tar.zst,
+            'zst' needs zstandard.
+        :param workers: The number of directories compacted at once.
+        """
+        if archive is not None and archive not in ARCHIVES:
+            raise ValueError('Unknown archive %s, should be one of %s' % (archive, ', '.join(ARCHIVES)))
+        self.keep = [pattern.upper() for pattern in keep]
+        self.archive = archive
+        self.workers = workers
+        self._pool = None
+        self._futures = []
+
+    def _kept(self, fn):
+        return any(fnmatch.fnmatchcase(fn.upper(), pattern) for pattern in self.keep)
+
+    @staticmethod
+    def _compacted(fn):
+        return fn == MANIFEST or any(fn.endswith('.tar.' + archive) for archive in ARCHIVES)
+
+    def compact(self, run_path):
+        """
+        Compact run_path at once.
+        :param run_path: The output directory of a run, such as result/crop_type/file_name.
+        :return: The manifest, {'files': {name: {'size':.., 'sha256':..}}, 'archive': name of archive or None}
+        """
+        files = {}
+        for fn in sorted(os.listdir(run_path)):
+            path = os.path.join(run_path, fn)
+            if not os.path.isfile(path) or self._compacted(fn):
+                continue
+            if not self._kept(fn):
+                os.remove(path)
+                continue
+            sha = hashlib.sha256()
+            with open(path, 'rb') as fp:
+                for block in iter(lambda: fp.read(1 << 20), b''):
+                    sha.update(block)
+            files[fn] = {'size': os.path.getsize(path), 'sha256': sha.hexdigest()}
+        if not files and os.path.exists(os.path.join(run_path, MANIFEST)):
+            # It has been compacted before
+            with open(os.path.join(run_path, MANIFEST), 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        manifest = {'files': files, 'archive': None}
+        if self.archive is not None and files:
+            manifest['archive'] = self._pack(run_path, sorted(files))
+        with open(os.path.join(run_path, MANIFEST), 'w', encoding='utf-8') as fp:
+            json.dump(manifest, fp, indent=1)
+        return manifest
+
+    def _pack(self, run_path, names):
+        """
+        Pack names in run_path into one archive, then delete them.
+        :return: The name of archive.
+        """
+        name = '%s.tar.%s' % (os.path.basename(os.path.normpath(run_path)), self.archive)
+        tmp_path = os.path.join(run_path, '.' + name)
+        if self.archive == 'gz':
+            with tarfile.open(tmp_path, 'w:gz') as tar:
+                for fn in names:
+                    tar.add(os.path.join(run_path, fn), arcname=fn)
+        else:
+            import zstandard
+            with open(tmp_path, 'wb') as fp, zstandard.ZstdCompressor().stream_writer(fp) as stream, \
+                    tarfile.open(fileobj=stream, mode='w|') as tar:
+                for fn in names:
+                    tar.add(os.path.join(run_path, fn), arcname=fn)
+        os.replace(tmp_path, os.path.join(run_path, name))
+        for fn in names:
+            os.remove(os.path.join(run_path, fn))
+        return name
+
+    def submit(self, run_path):
+        """
+        Compact run_path in the background.
+        :return: Future of the manifest.
+        """
+        if self._pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers=self.workers)
+        future = self._pool.submit(self.compact, run_path)
+        self._futures.append(future)
+        return future
+
+    def wait(self):
+        """
+        Wait for every submitted directory, errors of compaction are raised here.
+        :return: The number of directories compacted.
+        """
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+        return len(futures)
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
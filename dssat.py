@@ -1,254 +1,712 @@
-import numpy as np
-import subprocess
-import os
-import pandas as pd
-import re
-
-SUFFIXES = {'maize': '.MZX', 'rice': '.RIX'}
-CUL_NAME = {'maize': 'MZCER047', 'rice': 'RICER047'}
-RE_SUFFIXES = {v: k for k, v in SUFFIXES.items()}
-import torch
-
-torch.nn.Module()
-
-
-class DSSAT(object):
-    def __init__(self, x_file, run_path_absolute=r'C:\DSSAT47'):
-        """
-        Initializes necessary params from single x_file and Dssat installed directory.
-        :param x_file: The absolute path to .cuXf ile
-        :param run_path_absolute: The absolute path to Dssat installed directory
-        """
-        # The path of the DSCSM047.EXE
-        self._run_path = run_path_absolute
-        # Consist of /dir/_file_name.cuX
-        self._base_name = os.path.basename(x_file)
-        # Only prefix of basename without suffix.
-        self._file_name = os.path.splitext(self._base_name)[0]
-        self._crop_type = RE_SUFFIXES[os.path.splitext(self._base_name)[-1]]
-        self._genotype_file_path = os.path.join(self._run_path, 'Genotype', '%s.CUL' % CUL_NAME[self._crop_type])
-        self._crop_path = os.path.join(self._run_path, self._crop_type.capitalize())
-        # make soft link to x_file in DEFAULT CROP FILE
-        if self._crop_path != os.path.dirname(x_file):
-            os.system(r'copy /Y %s %s > c:\Windows\nul' % (x_file, os.path.join(self._crop_path, self._base_name)))
-        self.pwd = os.getcwd()
-        print('\n### Current crop: %s , filename: %s' % (self._crop_type, self._file_name))
-
-    def run_glue(self, epochs, glue_flag=1):
-        """
-        First ,change the params of config files in /DSSAT/GLWork
-        Second ,Calling R program to run GLUE.
-        Third ,rewrite the .CUL genotype file.
-        :param epochs:
-        :param glue_flag:
-        :return:
-        """
-        if not isinstance(epochs, int):
-            epochs = int(epochs)
-        print('\n\tRunning Glue (with epochs: %d)......' % epochs)
-        glue_work = os.path.join(self._run_path, 'GLWork')
-        glue_path = os.path.join(self._run_path, 'Tools', 'GLUE')
-
-        def _create_batch(ingeno, cname, treatments, group_begin_idx):
-            file = []
-            file.append('$BATCH(CULTIVAR):%s%s %s' % (SUFFIXES[self._crop_type][1:3], ingeno, cname))
-            file.append(' ')
-            file.append(
-                '@FILEX%88sTRTNO     RP     SQ     OP     CO' % '')
-            group_end_idx = group_begin_idx
-            for i in range(len(treatments)):
-                group_end_idx += 1
-                file.append(
-                    '%-50s%49s      0      0      0      0' % (
-                        os.path.join(self._crop_path, self._file_name + SUFFIXES[self._crop_type]),
-                        group_begin_idx + i + 1))
-
-            with open(os.path.join(glue_work, cname.replace(' ', '_') + SUFFIXES[self._crop_type])[:-1] + 'C',
-                      'w') as fp:
-                fp.write('\n'.join(file) + '\n')
-            return group_end_idx
-
-        # control the treatment_id in the xfile
-        group_begin_idx = 0
-        for ingeno, cname, treatments in zip(*self._search_treatments()):
-
-            # Check whether target ingeno is in Genotype.
-            # If ingeno exists, continue ,else ,add at end
-            encoding = "utf-8"
-            if self._crop_type == 'rice':
-                encoding = 'gbk'
-            with open(self._genotype_file_path, 'r+', encoding=encoding) as fp:
-                lines = fp.read()
-                if ingeno not in lines or cname not in lines:
-                    if self._crop_type == 'maize':
-                        fp.write('{ingeno:6} {cname:<21}. IB0001 120.0 0.000 685.0 907.9 10.00 38.90\n'.format(
-                            ingeno=ingeno, cname=cname))
-                    elif self._crop_type == 'rice':
-                        fp.write(
-                            '{ingeno:6} {cname:<21}. IB0001 880.0  52.0 550.0  12.1  65.0 .0280  1.00  1.00  83.0   1.0\
-                            \n'.format(ingeno=ingeno, cname=cname))
-                    else:
-                        print('\n Warning This crop is unsupportable now!!!')
-                        return
-
-            for fn in os.listdir(glue_work):
-                if os.path.isfile(os.path.join(glue_work, fn)):
-                    os.remove(os.path.join(glue_work, fn))
-            group_begin_idx = _create_batch(ingeno, cname, treatments, group_begin_idx)
-            with open(os.path.join(glue_path, 'Glue.r'), 'r') as fp:
-                text = fp.read()
-            text = re.sub('CultivarBatchFile<-[^;]+";?',
-                          'CultivarBatchFile<-"%s";' % (cname.replace(' ', '_') + SUFFIXES[self._crop_type][:-1] + 'C'),
-                          text)
-            with open(os.path.join(glue_path, 'Glue.r'), 'w') as fp:
-                fp.write(text)
-            del text
-
-            df = pd.read_csv(os.path.join(glue_path, 'SimulationControl.csv'))
-            df.iloc[0, 1] = epochs
-            df.iloc[1, 1] = glue_flag
-            df.to_csv(os.path.join(glue_path, 'SimulationControl.csv'), index=None)
-            os.chdir(self._run_path)
-            with open(os.path.join(glue_work, 'stdout.txt'), 'w') as fp:
-                subprocess.call(r'"C:\Program Files\R\R-3.4.0\bin\R.exe" --slave < C:\dssat47\Tools\Glue\Glue.r',
-                                stdout=fp)
-            with open(os.path.join(glue_work, '%s%s.CUL'
-                                              % (SUFFIXES[self._crop_type][1:3], ' '.join([ingeno, cname]))),
-                      'r') as f:
-                line = f.readline()
-            print('\n\tFinished Cultivar : %s......' % ingeno)
-            with open(self._genotype_file_path, 'r')as fr:
-                text = fr.read()
-            if line[:26] not in text:
-                text = text + '\n' + line + '\n'
-                print('New line:%s has added' % line)
-            else:
-                # some char in cname such as +,(,)* can't be recognized by re, then I choose first 9 chars in line
-                text = re.sub('%s[^\n]+\n?' % (line[:10]), line, text)
-            with open(self._genotype_file_path, 'w') as fw:
-                fw.write(text)
-        os.chdir(self.pwd)
-
-    def _search_treatments(self):
-        with open(os.path.join(self._crop_path, self._base_name), 'r', encoding='utf-8') as fp:
-            ingenos, cnames, treatments = {}, {}, {}
-            line = fp.readline()
-            while line != '':
-                if '@N R O C TNAME' in line:
-                    line = fp.readline()
-                    while line != '\n':
-                        treatments.update({line[9:34].strip(): line[36:38].strip()})
-                        line = fp.readline()
-                    continue
-                if '@C CR INGENO CNAME' in line:
-                    line = fp.readline()
-                    while line != '\n':
-                        ingenos.update({line[6:12]: line[:2].strip()})
-                        cnames.update({line[:2].strip(): line[13:].strip()})
-                        line = fp.readline()
-                    continue
-                line = fp.readline()
-        ings = ingenos.keys()
-        cns = [cnames[ingenos[ing]] for ing in ings]
-        tms = {i: [] for i in np.unique(list(treatments.values()))}
-        for tm, idx in treatments.items():
-            tms[idx].append(tm)
-        return ings, cns, [tms[ingenos[ing]] for ing in ings]
-
-    def create_DSSBatch(self):
-        """
-        crop_type: The type of crop to be simulated. Now supported : 'maize','rice'.
-        At present ，I find that the model can't run without .x and .v47 in the main corp file, such as Maize,Wheat.
-        :return:
-        """
-
-        print('\n\tCreating DSSBatch.v47 file......')
-        lines = []
-        lines.append('$BATCH(%s)' % self._crop_type.upper())
-        lines.append('!')
-        lines.append('! Crop         : %s' % self._crop_type.capitalize())
-        lines.append('! Shengyang Agricultural University  Qianchuan Mi')
-        lines.append('! ExpNo        : 1')
-        lines.append('')
-        lines.append(
-            '@FILEX                                                                                        TRTNO     RP     SQ     OP     CO')
-
-        name_list = []
-        variety_numbers = {}
-        fn = self._base_name
-        if SUFFIXES[self._crop_type.lower()] == os.path.splitext(fn)[-1]:
-            name_list.append(fn)
-            with open(os.path.join(self._crop_path, fn), 'r', encoding='utf-8') as fp:
-                while True:
-                    if '@N R O C TNAME.................... CU FL SA IC MP MI MF MR MC MT ME MH SM' in fp.readline():
-                        nums = 0
-                        while '\n' != fp.readline():
-                            nums += 1
-                        variety_numbers[fn] = nums
-                        break
-
-        for i in range(len(name_list)):
-            for j in range(variety_numbers[name_list[i]]):
-                lines.append(
-                    '%-98s%s      1      0      0      0' % (
-                        os.path.join(self._crop_path, name_list[i]), j + 1))
-
-        fname = os.path.join(self._crop_path, 'DSSBatch.v47')
-        with open(fname, 'w') as f:
-            f.write('\n'.join(lines))
-        print('\n\tDSSBatch.v47 Created successfully ! ')
-
-    def run(self, output_path, simulation_model='B'):
-        '''
-        :param:output_path:The directory to keep evaluated outputs.Absolutely path is recommended.
-        :param:simulation_model:
-            B – Batch, for use with conventional single treatment, single season *.crX files,
-                where “cr” represents a DSSAT crop code (e.g., WH).
-            N – Seasonal, for use with *.SNX files
-            Q – Sequence, for use with *.SQX files
-            S – Spatial, for use witn *.GSX files
-
-        '''
-        print('\n\tRunning DSSAT model......')
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
-        output_path = os.path.join(output_path, self._crop_type)
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
-        output_path = os.path.join(output_path, self._file_name)
-        if not os.path.exists(output_path):
-            os.mkdir(output_path)
-        exe_path = os.path.join(self._run_path, 'DSCSM047.EXE')
-        batch_path = os.path.join(self._crop_path, 'DSSBatch.v47')
-
-        with open(os.path.join(output_path, 'out.txt'), mode='w', encoding='utf-8') as f:
-            # os.chdir will change the work directory
-            # Change the place of this command will figure out problems with relative path
-            os.chdir(output_path)
-            subprocess.check_call([exe_path, os.path.basename(self._genotype_file_path), simulation_model, batch_path],
-                                  shell=True, stdout=f)
-            print('\n\tRunning successful! With result in %s' % os.getcwd())
-            os.chdir(self.pwd)
-
-    def __call__(self, out_path, gl_epochs, glue_flag=1, simulation_model='B'):
-        """
-        :param out_path: The directory to keep evaluated outputs,Absolutely path is recommended.
-        :param gl_epochs: The epochs to run glue
-        :return:
-        """
-        # STEP1 : RUN GLUE
-        self.run_glue(gl_epochs, glue_flag)
-
-        # STEP2 : CREATE DSSBatch FILE
-        self.create_DSSBatch()
-
-        # STEP3 : RUN DSSAT
-        self.run(out_path, simulation_model)
-
-        # STEP4 : DELETE USELESS FILES
-
-        # STEP5 : EXTRACT AVAILABLE FILES
-
-
-if __name__ == '__main__':
-    dssat = DSSAT(r'output/UAFD0011.RIX')
+import contextlib
+import subprocess
+import os
+import re
+import shutil
+import tempfile
+import weakref
+
+from backend import create_backend
+from cache import break_links, file_digest, hash_parts, sync_file
+from genotype import DEFAULT_LINES, ENCODINGS, GenotypeStore
+from instrument import NULL_RECORDER
+from outputs import read_output, split_outputs
+from xfile import read_xfile
+
+SUFFIXES = {'maize': '.MZX', 'rice': '.RIX'}
+RE_SUFFIXES = {v: k for k, v in SUFFIXES.items()}
+# GLWork and Tools/GLUE are shared, so arun_glue holds a lock for each Dssat installed directory.
+# {event loop: {run path: lock}}, since a lock can only be awaited in the loop it was first awaited in
+_GLUE_LOCKS = weakref.WeakKeyDictionary()
+
+
+def _write_DSSBatch(crop_type, crop_path, entries, batch_name='DSSBatch.v47'):
+    """
+    Write DSSBatch.v47 in crop_path.
+    :param crop_type: The type of crop to be simulated.
+    :param crop_path: The crop directory.
+    :param entries: [(path to .X file, treatment number), ...]
+    :param batch_name: The name of batch file of the DSSAT version, see Backend.batch_name.
+    """
+    lines = []
+    lines.append('$BATCH(%s)' % crop_type.upper())
+    lines.append('!')
+    lines.append('! Crop         : %s' % crop_type.capitalize())
+    lines.append('! Shengyang Agricultural University  Qianchuan Mi')
+    lines.append('! ExpNo        : %d' % len(set(path for path, _ in entries)))
+    lines.append('')
+    lines.append(
+        '@FILEX                                                                                        TRTNO     RP     SQ     OP     CO')
+    for path, trtno in entries:
+        lines.append('%-92s%7s      1      0      0      0' % (path, trtno))
+
+    fname = os.path.join(crop_path, batch_name)
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines))
+
+
+class DSSAT(object):
+    def __init__(self, x_file, run_path_absolute=None, workspace=None, env=None, r_path=None,
+                 recorder=None, journal=None, backend=None):
+        """
+        Initializes necessary params from single x_file and Dssat installed directory.
+        :param x_file: The absolute path to .cuXf ile
+        :param run_path_absolute: The absolute path to Dssat installed directory, None means the one of backend
+        :param workspace: The absolute path to a private scratch directory. If given, the crop directory,
+            DSSBatch.v47 and a copy of the .CUL file live here instead of in Dssat installed directory,
+            so that several runs can happen at once.
+        :param env: The environment of the launched programs, None means the environment of current process.
+        :param r_path: The R executable to run GLUE, which is used when backend is None.
+        :param recorder: Optional instrument.Recorder to record the stages of GLUE and DSSAT model.
+        :param journal: Optional journal.Journal. The cultivars calibrated and the run finished in it are skipped,
+            and the stages done are recorded in it.
+        :param backend: Optional backend.Backend which names and launches DSSAT model and R,
+            None means the backend of current OS.
+        """
+        self._backend = backend or create_backend(r_path=r_path)
+        # The path of the Dssat installed directory
+        self._run_path = self._backend.home(run_path_absolute)
+        # Consist of /dir/_file_name.cuX
+        self._base_name = os.path.basename(x_file)
+        # Only prefix of basename without suffix.
+        self._file_name = os.path.splitext(self._base_name)[0]
+        self._crop_type = RE_SUFFIXES[os.path.splitext(self._base_name)[-1]]
+        self._genotype_file_path = os.path.join(self._run_path, 'Genotype',
+                                                '%s.CUL' % self._backend.cul_name(self._crop_type))
+        self._crop_path = os.path.join(self._run_path, self._crop_type.capitalize())
+        self._workspace = workspace
+        if workspace is not None:
+            self._crop_path = os.path.join(workspace, self._crop_type.capitalize())
+            genotype_path = os.path.join(workspace, 'Genotype')
+            for path in (self._crop_path, genotype_path):
+                if not os.path.exists(path):
+                    os.makedirs(path)
+            sync_file(self._genotype_file_path, os.path.join(genotype_path, os.path.basename(self._genotype_file_path)))
+            self._genotype_file_path = os.path.join(genotype_path, os.path.basename(self._genotype_file_path))
+        self._env = env
+        self._recorder = recorder or NULL_RECORDER
+        self._journal = journal
+        # [(ingeno, digest), ...] calibrated by GLUE, which are recorded in journal once they are flushed
+        self._glued = []
+        # The treatment numbers of the last create_DSSBatch, None means every treatment
+        self._treatments = None
+        # make soft link to x_file in DEFAULT CROP FILE, an unchanged file is left as it is
+        if self._crop_path != os.path.dirname(x_file):
+            sync_file(x_file, os.path.join(self._crop_path, self._base_name), self._backend.link)
+        print('\n### Current crop: %s , filename: %s' % (self._crop_type, self._file_name))
+
+    def run_glue(self, epochs, glue_flag=1, workers=1, calibration_cache=None, force=False, sandbox=False):
+        """
+        First ,change the params of config files in /DSSAT/GLWork
+        Second ,Calling R program to run GLUE.
+        Third ,rewrite the .CUL genotype file.
+        :param epochs:
+        :param glue_flag:
+        :param workers: The number of cultivars calibrated at once. If it is not 1, every cultivar gets
+            a private copy of Tools/GLUE, GLWork and the genotype files, None means the number of CPUs.
+        :param calibration_cache: Optional CalibrationCache. Cultivars found in it get their calibrated line
+            without running R, and the others are stored in it after GLUE.
+        :param force: Run GLUE for every cultivar even if it is in calibration_cache or done in journal.
+        :param sandbox: Give every cultivar a private copy even if workers is 1, so that other processes can
+            run GLUE with the same Dssat installed directory at once.
+        :return:
+        """
+        if not isinstance(epochs, int):
+            epochs = int(epochs)
+        print('\n\tRunning Glue (with epochs: %d)......' % epochs)
+
+        cultivars = list(zip(*self._search_treatments()))
+        store = self._genotype_store(cultivars)
+        if store is None:
+            return
+        cultivars, digests = self._skip_glued(cultivars, epochs, glue_flag, force)
+        cultivars, keys = self._reuse_calibrations(store, cultivars, epochs, glue_flag, calibration_cache, force)
+        if workers != 1 or sandbox:
+            self._run_glue_parallel(store, cultivars, epochs, glue_flag, workers, calibration_cache, keys, digests)
+            return
+        glue_work = os.path.join(self._run_path, 'GLWork')
+        try:
+            for ingeno, cname, treatments in cultivars:
+                with self._recorder.stage('run_glue', (glue_work,), file_name=self._file_name, ingeno=ingeno):
+                    self._prepare_glue(ingeno, cname, treatments, epochs, glue_flag)
+                    args, stdin = self._backend.glue_command(os.path.join(self._run_path, 'Tools', 'GLUE', 'Glue.r'))
+                    with open(os.path.join(glue_work, 'stdout.txt'), 'w') as fp, open(stdin or os.devnull, 'r') as fr:
+                        subprocess.call(args, stdin=fr, stdout=fp, cwd=self._run_path, env=self._env)
+                    self._finish_glue(store, ingeno, cname, calibration_cache=calibration_cache,
+                                      key=keys.get(ingeno), digest=digests.get(ingeno))
+        finally:
+            self._flush(store)
+
+    async def arun_glue(self, epochs, glue_flag=1, calibration_cache=None, force=False):
+        """
+        The same as run_glue, but R program is awaited as an asyncio subprocess.
+        GLWork and Tools/GLUE are shared in Dssat installed directory, so only one GLUE runs at once
+        for each Dssat installed directory.
+        :param epochs:
+        :param glue_flag:
+        :param calibration_cache: The same as run_glue.
+        :param force: The same as run_glue.
+        :return:
+        """
+        import asyncio
+        if not isinstance(epochs, int):
+            epochs = int(epochs)
+        print('\n\tRunning Glue (with epochs: %d)......' % epochs)
+        lock = _GLUE_LOCKS.setdefault(asyncio.get_event_loop(), {}).setdefault(self._run_path, asyncio.Lock())
+        async with lock:
+            cultivars = list(zip(*self._search_treatments()))
+            store = self._genotype_store(cultivars)
+            if store is None:
+                return
+            cultivars, digests = self._skip_glued(cultivars, epochs, glue_flag, force)
+            cultivars, keys = self._reuse_calibrations(store, cultivars, epochs, glue_flag, calibration_cache,
+                                                       force)
+            glue_work = os.path.join(self._run_path, 'GLWork')
+            try:
+                for ingeno, cname, treatments in cultivars:
+                    with self._recorder.stage('run_glue', (glue_work,), file_name=self._file_name, ingeno=ingeno):
+                        self._prepare_glue(ingeno, cname, treatments, epochs, glue_flag)
+                        args, stdin = self._backend.glue_command(
+                            os.path.join(self._run_path, 'Tools', 'GLUE', 'Glue.r'))
+                        with open(os.path.join(glue_work, 'stdout.txt'), 'w') as fp, \
+                                open(stdin or os.devnull, 'r') as fr:
+                            proc = await asyncio.create_subprocess_exec(*args, stdin=fr, stdout=fp,
+                                                                        cwd=self._run_path, env=self._env)
+                            await proc.wait()
+                        self._finish_glue(store, ingeno, cname, calibration_cache=calibration_cache,
+                                          key=keys.get(ingeno), digest=digests.get(ingeno))
+            finally:
+                self._flush(store)
+
+    def _run_glue_parallel(self, store, cultivars, epochs, glue_flag, workers, calibration_cache=None, keys=None,
+                           digests=None):
+        """
+        Calibrate cultivars with a bounded pool of R processes, each of them in its own sandbox.
+        The calibrated lines are merged into store, which is flushed once at the end.
+        :param calibration_cache: Optional CalibrationCache to store the calibrated lines in.
+        :param keys: {ingeno: key in calibration_cache}
+        :param digests: {ingeno: digest to record in journal}
+        """
+        keys = keys or {}
+        digests = digests or {}
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(self._run_glue_sandbox, ingeno, cname, treatments, epochs, glue_flag):
+                           (ingeno, cname) for ingeno, cname, treatments in cultivars}
+                for future in as_completed(futures):
+                    ingeno, cname = futures[future]
+                    sandbox = future.result()
+                    try:
+                        self._finish_glue(store, ingeno, cname, os.path.join(sandbox, 'GLWork'), calibration_cache,
+                                          keys.get(ingeno), digests.get(ingeno))
+                    finally:
+                        shutil.rmtree(sandbox, ignore_errors=True)
+        finally:
+            self._flush(store)
+
+    def _run_glue_sandbox(self, ingeno, cname, treatments, epochs, glue_flag):
+        """
+        Run GLUE for a single cultivar with private copies of Tools/GLUE, GLWork and the genotype files of the crop.
+        The directories in Glue.r (WD, OD, GD) are pointed at the copies.
+        :return: The sandbox directory, whose GLWork keeps the calibrated .CUL line.
+        """
+        sandbox = tempfile.mkdtemp(prefix='%s_' % ingeno, dir=os.path.join(self._run_path, 'GLWork'))
+        try:
+            with self._recorder.stage('run_glue', (sandbox,), file_name=self._file_name, ingeno=ingeno):
+                glue_path = os.path.join(sandbox, 'GLUE')
+                glue_work = os.path.join(sandbox, 'GLWork')
+                genotype_path = os.path.join(sandbox, 'Genotype')
+                shutil.copytree(os.path.join(self._run_path, 'Tools', 'GLUE'), glue_path)
+                os.mkdir(glue_work)
+                os.mkdir(genotype_path)
+                genotype_dir = os.path.join(self._run_path, 'Genotype')
+                for fn in os.listdir(genotype_dir):
+                    if fn.startswith(self._backend.cul_name(self._crop_type)):
+                        shutil.copyfile(os.path.join(genotype_dir, fn), os.path.join(genotype_path, fn))
+                # A workspace keeps its own .CUL file, the other genotype files are the installed ones
+                shutil.copyfile(self._genotype_file_path,
+                                os.path.join(genotype_path, os.path.basename(self._genotype_file_path)))
+
+                self._prepare_glue(ingeno, cname, treatments, epochs, glue_flag, glue_path, glue_work,
+                                   {'WD': glue_path, 'OD': glue_work, 'GD': genotype_path})
+                args, stdin = self._backend.glue_command(os.path.join(glue_path, 'Glue.r'))
+                with open(os.path.join(glue_work, 'stdout.txt'), 'w') as fp, open(stdin or os.devnull, 'r') as fr:
+                    subprocess.call(args, stdin=fr, stdout=fp, cwd=self._run_path, env=self._env)
+        except BaseException:
+            shutil.rmtree(sandbox, ignore_errors=True)
+            raise
+        return sandbox
+
+    def _genotype_store(self, cultivars):
+        """
+        Load the .CUL genotype file and make sure every cultivar is in it.
+        Cultivars which are not in .CUL file are added with default line before GLUE runs.
+        :param cultivars: [(ingeno, cname, treatments), ...] from _search_treatments.
+        :return: GenotypeStore, None if the crop is unsupportable.
+        """
+        if self._crop_type not in DEFAULT_LINES:
+            print('\n Warning This crop is unsupportable now!!!')
+            return None
+        with self._recorder.stage('genotype_load', file_name=self._file_name):
+            store = GenotypeStore(self._genotype_file_path, ENCODINGS[self._crop_type])
+            for ingeno, cname, _ in cultivars:
+                store.add_default(self._crop_type, ingeno, cname)
+        self._flush(store)
+        return store
+
+    def _flush(self, store):
+        """
+        Write the changes of store back to .CUL file.
+        """
+        with self._recorder.stage('genotype_flush', file_name=self._file_name) as event:
+            if store.flush():
+                event['files'], event['bytes'] = 1, os.path.getsize(store.path)
+        # The calibrations are done only once they are in .CUL file
+        glued, self._glued = self._glued, []
+        for ingeno, digest in glued:
+            self._journal.mark(self._base_name, 'glue', ingeno, digest)
+
+    def _skip_glued(self, cultivars, epochs, glue_flag, force=False):
+        """
+        Leave out the cultivars calibrated in journal with the same calibration key.
+        :param cultivars: [(ingeno, cname, treatments), ...] from _search_treatments.
+        :param force: Keep every cultivar, which is recorded in journal again after GLUE.
+        :return: The cultivars left for GLUE, and {ingeno: digest to record in journal} of them.
+        """
+        if self._journal is None:
+            return cultivars, {}
+        left, digests = [], {}
+        for ingeno, cname, treatments in cultivars:
+            digest = hash_parts(self._calibration_key(ingeno, cname, treatments, epochs, glue_flag))
+            if not force and self._journal.done(self._base_name, 'glue', ingeno, digest):
+                print('\n\tSkipped Cultivar calibrated before : %s......' % ingeno)
+                continue
+            left.append((ingeno, cname, treatments))
+            digests[ingeno] = digest
+        return left, digests
+
+    def _reuse_calibrations(self, store, cultivars, epochs, glue_flag, calibration_cache=None, force=False):
+        """
+        Put the lines found in calibration_cache into store.
+        :param cultivars: [(ingeno, cname, treatments), ...] from _search_treatments.
+        :return: The cultivars left for GLUE, and {ingeno: key in calibration_cache} of them.
+        """
+        if calibration_cache is None:
+            return cultivars, {}
+        left, keys = [], {}
+        for ingeno, cname, treatments in cultivars:
+            key = calibration_cache.key(self._calibration_key(ingeno, cname, treatments, epochs, glue_flag))
+            line = None if force else calibration_cache.get(key)
+            if line is None:
+                left.append((ingeno, cname, treatments))
+                keys[ingeno] = key
+                continue
+            store.upsert(line)
+            print('\n\tReused calibration of Cultivar : %s......' % ingeno)
+        return left, keys
+
+    def _calibration_key(self, ingeno, cname, treatments, epochs, glue_flag):
+        """
+        Everything that decides the calibration of a cultivar: the cultivar, its treatments, the x_file,
+        the observed data (.cuA and .cuT files in the crop directory), epochs and glue_flag.
+        :return: [(name, str or bytes), ...] for CalibrationCache.key.
+        """
+        parts = [('crop_type', self._crop_type), ('ingeno', ingeno), ('cname', cname),
+                 ('treatments', ' '.join(treatments))]
+        with open(os.path.join(self._crop_path, self._base_name), 'rb') as fp:
+            parts.append(('xfile', fp.read()))
+        for suffix in ('A', 'T'):
+            path = os.path.join(self._crop_path, self._file_name + SUFFIXES[self._crop_type][:-1] + suffix)
+            parts.append((suffix, file_digest(path) if os.path.isfile(path) else ''))
+        parts.append(('epochs', epochs))
+        parts.append(('glue_flag', glue_flag))
+        return parts
+
+    def _prepare_glue(self, ingeno, cname, treatments, epochs, glue_flag, glue_path=None, glue_work=None,
+                      directories=None):
+        """
+        Rewrite GLWork and the config files of GLUE for a single cultivar.
+        :param treatments: The treatment numbers of the cultivar in the x_file.
+        :param glue_path: The directory of Glue.r and SimulationControl.csv, Tools/GLUE if None.
+        :param glue_work: The work directory of GLUE, GLWork if None.
+        :param directories: Optional {variable in Glue.r: directory} to rewrite, such as {'OD': glue_work}.
+        """
+        glue_work = glue_work or os.path.join(self._run_path, 'GLWork')
+        glue_path = glue_path or os.path.join(self._run_path, 'Tools', 'GLUE')
+
+        def _create_batch(ingeno, cname, treatments):
+            file = []
+            file.append('$BATCH(CULTIVAR):%s%s %s' % (SUFFIXES[self._crop_type][1:3], ingeno, cname))
+            file.append(' ')
+            file.append(
+                '@FILEX%88sTRTNO     RP     SQ     OP     CO' % '')
+            for trtno in treatments:
+                file.append(
+                    '%-50s%49s      0      0      0      0' % (
+                        os.path.join(self._crop_path, self._file_name + SUFFIXES[self._crop_type]), trtno))
+
+            with open(os.path.join(glue_work, cname.replace(' ', '_') + SUFFIXES[self._crop_type])[:-1] + 'C',
+                      'w') as fp:
+                fp.write('\n'.join(file) + '\n')
+
+        for fn in os.listdir(glue_work):
+            if os.path.isfile(os.path.join(glue_work, fn)):
+                os.remove(os.path.join(glue_work, fn))
+        _create_batch(ingeno, cname, treatments)
+        with open(os.path.join(glue_path, 'Glue.r'), 'r') as fp:
+            text = fp.read()
+        text = re.sub('CultivarBatchFile<-[^;]+";?',
+                      'CultivarBatchFile<-"%s";' % (cname.replace(' ', '_') + SUFFIXES[self._crop_type][:-1] + 'C'),
+                      text)
+        for name, directory in (directories or {}).items():
+            # R accepts '/' on every OS, and '\\' would be an escape char in the replacement
+            text = re.sub(r'\b%s<-[^;]+";?' % name, '%s<-"%s";' % (name, directory.replace('\\', '/')), text)
+        with open(os.path.join(glue_path, 'Glue.r'), 'w') as fp:
+            fp.write(text)
+        del text
+
+        import pandas as pd
+        df = pd.read_csv(os.path.join(glue_path, 'SimulationControl.csv'))
+        df.iloc[0, 1] = epochs
+        df.iloc[1, 1] = glue_flag
+        df.to_csv(os.path.join(glue_path, 'SimulationControl.csv'), index=None)
+
+    def _finish_glue(self, store, ingeno, cname, glue_work=None, calibration_cache=None, key=None, digest=None):
+        """
+        Put the line calibrated by GLUE into the genotype store, which is written back by its flush.
+        :param glue_work: The work directory of GLUE, GLWork if None.
+        :param calibration_cache: Optional CalibrationCache to keep the line in with key.
+        :param digest: Optional digest to record the cultivar in journal with, after the flush.
+        """
+        glue_work = glue_work or os.path.join(self._run_path, 'GLWork')
+        with open(os.path.join(glue_work, '%s%s.CUL'
+                                          % (SUFFIXES[self._crop_type][1:3], ' '.join([ingeno, cname]))),
+                  'r') as f:
+            line = f.readline()
+        print('\n\tFinished Cultivar : %s......' % ingeno)
+        if store.upsert(line):
+            print('New line:%s has added' % line)
+        if calibration_cache is not None and key is not None:
+            calibration_cache.put(key, self._crop_type, ingeno, cname, line)
+        if digest is not None:
+            self._glued.append((ingeno, digest))
+
+    def cultivar_lines(self):
+        """
+        :return: {ingeno: line} of the cultivars of x_file found in .CUL file, e.g. the lines calibrated by GLUE.
+        """
+        if self._crop_type not in ENCODINGS:
+            return {}
+        store = GenotypeStore(self._genotype_file_path, ENCODINGS[self._crop_type])
+        return {ingeno: store.get(ingeno) for ingeno in self._search_treatments()[0] if ingeno in store}
+
+    def _search_treatments(self):
+        """
+        :return: INGENOs, CNAMEs and treatment numbers of each cultivar in the x_file.
+        """
+        xfile = read_xfile(os.path.join(self._crop_path, self._base_name))
+        treatments = {}
+        for row in xfile.treatments:
+            treatments.setdefault(row['CU'], []).append(row['N'])
+        ings = [row['INGENO'] for row in xfile.cultivars]
+        cns = [row['CNAME'] for row in xfile.cultivars]
+        return ings, cns, [treatments.get(row['C'], []) for row in xfile.cultivars]
+
+    def create_DSSBatch(self, treatments=None):
+        """
+        crop_type: The type of crop to be simulated. Now supported : 'maize','rice'.
+        At present ，I find that the model can't run without .x and .v47 in the main corp file, such as Maize,Wheat.
+        :param treatments: Optional treatment numbers to run, None means every treatment in the x_file.
+        :return:
+        """
+
+        print('\n\tCreating DSSBatch.v47 file......')
+        self._treatments = treatments
+        with self._recorder.stage('create_DSSBatch', file_name=self._file_name) as event:
+            _write_DSSBatch(self._crop_type, self._crop_path, self._batch_entries(treatments),
+                            self._backend.batch_name)
+            event['files'], event['bytes'] = 1, os.path.getsize(
+                os.path.join(self._crop_path, self._backend.batch_name))
+        print('\n\tDSSBatch.v47 Created successfully ! ')
+
+    def _batch_entries(self, treatments=None):
+        """
+        :param treatments: Optional treatment numbers to run, None means every treatment in the x_file.
+        :return: [(path to x_file, treatment number), ...] for DSSBatch.v47.
+        """
+        path = os.path.join(self._crop_path, self._base_name)
+        if treatments is None:
+            treatments = [row['N'] for row in read_xfile(path).treatments]
+        return [(path, trtno) for trtno in treatments]
+
+    def run(self, output_path, simulation_model='B', cache=None):
+        '''
+        :param:output_path:The directory to keep evaluated outputs.Absolutely path is recommended.
+        :param:simulation_model:
+            B – Batch, for use with conventional single treatment, single season *.crX files,
+                where “cr” represents a DSSAT crop code (e.g., WH).
+            N – Seasonal, for use with *.SNX files
+            Q – Sequence, for use with *.SQX files
+            S – Spatial, for use witn *.GSX files
+        :param:cache: Optional ResultCache. The outputs are restored from it if nothing has changed since
+            they were stored, otherwise DSSAT model is run and the outputs are stored.
+
+        '''
+        print('\n\tRunning DSSAT model......')
+        output_path = self._create_output_path(output_path)
+        with self._recorder.stage('run', (output_path,), file_name=self._file_name) as event:
+            key = None
+            if cache is not None:
+                key = cache.key(self._result_key(simulation_model, self._treatments))
+                event['cached'] = cache.restore(key, output_path)
+                if event['cached']:
+                    print('\n\tRestored from cache! With result in %s' % output_path)
+                    return
+            # The outputs restored by a cached run before are hard links of the cache, even without cache now
+            break_links(output_path)
+            with self._genotype_copy(output_path), \
+                    open(os.path.join(output_path, 'out.txt'), mode='w', encoding='utf-8') as f:
+                # The model is run in output_path, which figures out problems with relative path
+                subprocess.check_call(self._model_command(simulation_model), stdout=f, cwd=output_path,
+                                      env=self._env)
+            if cache is not None:
+                cache.store(key, output_path)
+        print('\n\tRunning successful! With result in %s' % output_path)
+
+    async def arun(self, output_path, simulation_model='B'):
+        '''
+        The same as run, but DSSAT model is awaited as an asyncio subprocess, so that one event loop can keep
+        many runs in flight. Every DSSAT object should own a workspace when they are run at once,
+        because DSSBatch.v47 is kept in the crop directory.
+        :param:output_path:The directory to keep evaluated outputs.Absolutely path is recommended.
+        :param:simulation_model: The same as run.
+        '''
+        import asyncio
+        print('\n\tRunning DSSAT model......')
+        output_path = self._create_output_path(output_path)
+        cmd = self._model_command(simulation_model)
+        break_links(output_path)
+        with self._genotype_copy(output_path), \
+                open(os.path.join(output_path, 'out.txt'), mode='w', encoding='utf-8') as f:
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=f, cwd=output_path, env=self._env)
+            return_code = await proc.wait()
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, cmd)
+        print('\n\tRunning successful! With result in %s' % output_path)
+
+    def extract(self, output_path, names=('Summary.OUT',), sidecar=None):
+        """
+        Parse the outputs of DSSAT model in output_path/crop_type/file_name into DataFrames.
+        :param output_path: The same as run.
+        :param names: The .OUT files to parse.
+        :param sidecar: Optional 'parquet' or 'feather' to keep the parsed frames, see outputs.read_output.
+        :return: {name: DataFrame}, the files which don't exist are left out.
+        """
+        output_path = os.path.join(output_path, self._crop_type, self._file_name)
+        return {name: read_output(os.path.join(output_path, name), sidecar) for name in names
+                if os.path.isfile(os.path.join(output_path, name))}
+
+    def _create_output_path(self, output_path):
+        """
+        Create output_path/crop_type/file_name for the outputs of DSSAT model.
+        :return: The directory created.
+        """
+        if not os.path.exists(output_path):
+            os.mkdir(output_path)
+        output_path = os.path.join(output_path, self._crop_type)
+        if not os.path.exists(output_path):
+            os.mkdir(output_path)
+        output_path = os.path.join(output_path, self._file_name)
+        if not os.path.exists(output_path):
+            os.mkdir(output_path)
+        return output_path
+
+    @contextlib.contextmanager
+    def _genotype_copy(self, work_path):
+        """
+        Keep a copy of the .CUL file of workspace in work_path while DSSAT model runs there, since DSSAT looks for
+        the genotype file in the work directory before the one in Dssat installed directory.
+        The copy is removed afterwards, so that results and the cache only keep outputs.
+        """
+        if self._workspace is None:
+            yield
+            return
+        path = os.path.join(work_path, os.path.basename(self._genotype_file_path))
+        # It may be a hard link of ResultCache, which sync_file never writes through
+        sync_file(self._genotype_file_path, path)
+        try:
+            yield
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _result_key(self, simulation_model, treatments=None):
+        """
+        Everything that decides the outputs of DSSAT model: the x_file, the .CUL lines of its cultivars,
+        the weather and soil files of its fields, the simulation model and the DSSAT model executable.
+        :param treatments: Optional treatment numbers to run, None means every treatment in the x_file.
+        :return: [(name, str or bytes), ...] for ResultCache.key.
+        """
+        path = os.path.join(self._crop_path, self._base_name)
+        with open(path, 'rb') as fp:
+            parts = [('xfile', fp.read())]
+        xfile = read_xfile(path)
+        parts.append(('treatments', ' '.join(str(trtno) for trtno in treatments or [])))
+        store = GenotypeStore(self._genotype_file_path, ENCODINGS.get(self._crop_type, 'utf-8'))
+        for row in xfile.cultivars:
+            parts.append(('cultivar', store.get(row['INGENO'], '')))
+        stations = set(row['WSTA'][:4].upper() for row in xfile.fields)
+        soils = set(row['ID_SOIL'][:2].upper() + '.SOL' for row in xfile.fields) | {'SOIL.SOL'}
+        for directory, match in (('Weather', lambda fn: fn[:4].upper() in stations),
+                                 ('Soil', lambda fn: fn.upper() in soils)):
+            directory = os.path.join(self._run_path, directory)
+            for fn in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+                if match(fn) and os.path.isfile(os.path.join(directory, fn)):
+                    parts.append((fn, file_digest(os.path.join(directory, fn))))
+        parts.append(('simulation_model', simulation_model))
+        parts.append(('model', file_digest(self._model_command(simulation_model)[0])))
+        return parts
+
+    def _model_command(self, simulation_model):
+        """
+        :return: The command line to run DSSAT model with DSSBatch.v47 in the crop directory.
+        """
+        return self._backend.model_command(self._run_path, os.path.basename(self._genotype_file_path),
+                                           simulation_model, os.path.join(self._crop_path, self._backend.batch_name))
+
+    def __call__(self, out_path, gl_epochs, glue_flag=1, simulation_model='B', glue_workers=1, cache=None,
+                 calibration_cache=None, force_glue=False, extract=None, sidecar=None, compactor=None):
+        """
+        :param out_path: The directory to keep evaluated outputs,Absolutely path is recommended.
+        :param gl_epochs: The epochs to run glue
+        :param glue_workers: The number of cultivars calibrated at once, see run_glue.
+        :param cache: Optional ResultCache, see run.
+        :param calibration_cache: Optional CalibrationCache, see run_glue.
+        :param force_glue: Run GLUE even for the cultivars in calibration_cache.
+        :param extract: Optional names of .OUT files to parse, see extract.
+        :param sidecar: Optional 'parquet' or 'feather' to keep the parsed frames next to the .OUT files.
+        :param compactor: Optional Compactor to prune the outputs after extraction, which works in background.
+        :return: {name: DataFrame} if extract is given.
+        """
+        stage = 'glue'
+        try:
+            # STEP1 : RUN GLUE
+            self.run_glue(gl_epochs, glue_flag, glue_workers, calibration_cache, force_glue)
+
+            stage = 'run'
+            digest = file_digest(os.path.join(self._crop_path, self._base_name))
+            if self._journal is not None and self._journal.done(self._base_name, 'run', digest=digest):
+                print('\n\tSkipped DSSAT model, which has finished before!')
+            else:
+                # STEP2 : CREATE DSSBatch FILE
+                self.create_DSSBatch()
+
+                # STEP3 : RUN DSSAT
+                self.run(out_path, simulation_model, cache)
+                if self._journal is not None:
+                    self._journal.mark(self._base_name, 'run', digest=digest)
+
+            # STEP4 : EXTRACT AVAILABLE FILES
+            stage = 'extract'
+            frames = self.extract(out_path, extract, sidecar) if extract else None
+        except Exception as e:
+            if self._journal is not None:
+                self._journal.fail(self._base_name, stage, e)
+            raise
+
+        # STEP5 : DELETE USELESS FILES, which overlaps the next run
+        if compactor is not None:
+            compactor.submit(os.path.join(out_path, self._crop_type, self._file_name))
+        return frames
+
+
+class DSSATBatch(object):
+    def __init__(self, x_files, run_path_absolute=None, workspace=None, env=None, treatments=None,
+                 recorder=None, backend=None):
+        """
+        Run many x_files of the same crop type with a single DSSBatch.v47 and a single DSSAT model process.
+        :param x_files: The absolute paths to .cuX files.
+        :param run_path_absolute: The absolute path to Dssat installed directory
+        :param workspace: The same as DSSAT.
+        :param env: The same as DSSAT.
+        :param treatments: Optional {file_name: [treatment numbers]} to run part of the treatments of some files.
+        :param recorder: The same as DSSAT.
+        :param backend: The same as DSSAT.
+        """
+        backend = backend or create_backend()
+        self._experiments = [DSSAT(x_file, run_path_absolute, workspace, env, recorder=recorder, backend=backend)
+                             for x_file in x_files]
+        self._backend = backend
+        self._recorder = recorder or NULL_RECORDER
+        crop_types = set(dssat._crop_type for dssat in self._experiments)
+        if len(crop_types) != 1:
+            raise ValueError('DSSATBatch needs .X files of a single crop type, got %s' % sorted(crop_types))
+        self._crop_type = crop_types.pop()
+        self._treatments = treatments or {}
+
+    def create_DSSBatch(self, experiments=None):
+        """
+        Write a single DSSBatch.v47 covering every x_file.
+        :param experiments: Optional DSSAT objects to cover, None means all of them.
+        """
+        experiments = self._experiments if experiments is None else experiments
+        print('\n\tCreating DSSBatch.v47 file for %d files......' % len(experiments))
+        crop_path = self._experiments[0]._crop_path
+        with self._recorder.stage('create_DSSBatch', files=1, file_name=[d._file_name for d in experiments]) as event:
+            entries = []
+            for dssat in experiments:
+                entries.extend(dssat._batch_entries(self._treatments.get(dssat._file_name)))
+            _write_DSSBatch(self._crop_type, crop_path, entries, self._backend.batch_name)
+            event['bytes'] = os.path.getsize(os.path.join(crop_path, self._backend.batch_name))
+        print('\n\tDSSBatch.v47 Created successfully ! ')
+
+    def run(self, output_path, simulation_model='B', cache=None):
+        """
+        Run DSSAT model once, then split the outputs into output_path/crop_type/file_name of each x_file.
+        :param output_path: The directory to keep evaluated outputs.Absolutely path is recommended.
+        :param simulation_model: The same as DSSAT.run.
+        :param cache: Optional ResultCache. Experiments found in it are restored, and only the others are run
+            with a DSSBatch.v47 rewritten for them.
+        :return: {file_name: the directory keeps its outputs}
+        """
+        print('\n\tRunning DSSAT model with %d files......' % len(self._experiments))
+        first = self._experiments[0]
+        output_paths = {dssat._file_name: dssat._create_output_path(output_path) for dssat in self._experiments}
+        experiments, keys = self._experiments, {}
+        if cache is not None:
+            experiments = []
+            for dssat in self._experiments:
+                key = cache.key(dssat._result_key(simulation_model, self._treatments.get(dssat._file_name)))
+                if not cache.restore(key, output_paths[dssat._file_name]):
+                    experiments.append(dssat)
+                    keys[dssat._file_name] = key
+            if not experiments:
+                print('\n\tRestored from cache! With result in %s' % os.path.join(output_path, self._crop_type))
+                return output_paths
+            if len(experiments) < len(self._experiments):
+                self.create_DSSBatch(experiments)
+        # split_outputs rewrites the outputs of experiments, which may be hard links of the cache
+        for dssat in experiments:
+            break_links(output_paths[dssat._file_name])
+        combined_path = tempfile.mkdtemp(prefix='batch_', dir=os.path.join(output_path, self._crop_type))
+        try:
+            with self._recorder.stage('run', [output_paths[d._file_name] for d in experiments],
+                                      file_name=[d._file_name for d in experiments]):
+                with first._genotype_copy(combined_path), \
+                        open(os.path.join(combined_path, 'out.txt'), mode='w', encoding='utf-8') as f:
+                    subprocess.check_call(first._model_command(simulation_model), stdout=f, cwd=combined_path,
+                                          env=first._env)
+                split_outputs(combined_path,
+                              {dssat._file_name: output_paths[dssat._file_name] for dssat in experiments})
+        finally:
+            shutil.rmtree(combined_path, ignore_errors=True)
+        for file_name, key in keys.items():
+            cache.store(key, output_paths[file_name])
+        print('\n\tRunning successful! With result in %s' % os.path.join(output_path, self._crop_type))
+        return output_paths
+
+
+if __name__ == '__main__':
+    dssat = DSSAT(r'output/UAFD0011.RIX')
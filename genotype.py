@@ -0,0 +1,102 @@
+import os
+import shutil
+import tempfile
+
+# The line of a new cultivar which is added before GLUE calibrates it
+DEFAULT_LINES = {
+    'maize': '{ingeno:6} {cname:<21}. IB0001 120.0 0.000 685.0 907.9 10.00 38.90',
+    'rice': '{ingeno:6} {cname:<21}. IB0001 880.0  52.0 550.0  12.1  65.0 .0280  1.00  1.00  83.0   1.0',
+}
+ENCODINGS = {'maize': 'utf-8', 'rice': 'gbk'}
+
+
+class GenotypeStore(object):
+    def __init__(self, path, encoding='utf-8'):
+        """
+        Parse a .CUL genotype file once into memory.
+        Cultivar lines are indexed by INGENO, while header and comment lines are kept as they are.
+        Changes stay in memory until flush writes the whole file back at once.
+        :param path: The path to .CUL file.
+        :param encoding: The encoding of .CUL file.
+        """
+        self.path = path
+        self.encoding = encoding
+        with open(path, 'r', encoding=encoding) as fp:
+            self._lines = fp.read().splitlines()
+        # {ingeno: index of its line in self._lines}, the first line wins like DSSAT does
+        self._index = {}
+        for i, line in enumerate(self._lines):
+            ingeno = self._ingeno(line)
+            if ingeno is not None and ingeno not in self._index:
+                self._index[ingeno] = i
+        self._dirty = False
+
+    @staticmethod
+    def _ingeno(line):
+        """
+        :return: INGENO of a cultivar line, None for blank, comment('!'), header('@', '*', '$') lines.
+        """
+        if not line.strip() or line[0] in '!@*$ \t':
+            return None
+        return line[:6].strip()
+
+    def __contains__(self, ingeno):
+        return ingeno in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, ingeno, default=None):
+        """
+        :return: The cultivar line of ingeno.
+        """
+        if ingeno not in self._index:
+            return default
+        return self._lines[self._index[ingeno]]
+
+    def upsert(self, line):
+        """
+        Replace the line with the same INGENO, or add it at the end.
+        :param line: A cultivar line of .CUL file.
+        :return: True if the line is new.
+        """
+        line = line.rstrip('\r\n')
+        ingeno = self._ingeno(line)
+        if ingeno is None:
+            raise ValueError('Not a cultivar line: %r' % line)
+        self._dirty = True
+        if ingeno in self._index:
+            self._lines[self._index[ingeno]] = line
+            return False
+        self._index[ingeno] = len(self._lines)
+        self._lines.append(line)
+        return True
+
+    def add_default(self, crop_type, ingeno, cname):
+        """
+        Add the default line of crop_type for a cultivar which is not in .CUL file yet.
+        :return: True if the line is added.
+        """
+        if ingeno in self._index:
+            return False
+        return self.upsert(DEFAULT_LINES[crop_type].format(ingeno=ingeno, cname=cname))
+
+    def flush(self):
+        """
+        Write all the changes back with a temp file in the same directory, which is renamed over .CUL file.
+        :return: True if .CUL file is written.
+        """
+        if not self._dirty:
+            return False
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(self.path), dir=os.path.dirname(self.path))
+        try:
+            with open(fd, 'w', encoding=self.encoding) as fp:
+                fp.write('\n'.join(self._lines) + '\n')
+            shutil.copymode(self.path, tmp_path)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._dirty = False
+        return True
@@ -0,0 +1,139 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # resource is only on POSIX, the usage of CPU and memory is left out on Windows
+    resource = None
+
+
+def _usage(children=False):
+    """
+    :return: (user + system CPU seconds, max RSS in KB) of this process or of its terminated child processes,
+        (None, None) without resource.
+    """
+    if resource is None:
+        return None, None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss // (1024 if sys.platform == 'darwin' else 1)
+
+
+def _snapshot(paths):
+    """
+    :return: {file path: (st_mtime_ns, st_size)} of every file under paths.
+    """
+    files = {}
+    for path in paths:
+        for root, _, names in os.walk(path):
+            for fn in names:
+                try:
+                    stat = os.stat(os.path.join(root, fn))
+                except OSError:
+                    continue
+                files[os.path.join(root, fn)] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+class Recorder(object):
+    def __init__(self, path=None, callback=None):
+        """
+        Record the wall time, CPU time of this process and of child processes (R, DSCSM047.EXE), max RSS of child
+        processes and the files written by every stage of the pipeline.
+        Every event is kept in events, appended to path as a JSON line and passed to callback.
+        CPU and RSS of child processes are for the whole process, so they overlap when stages run at once.
+        :param path: Optional JSON-lines file to append events to.
+        :param callback: Optional callable which takes every event.
+        """
+        self.path = path
+        self.callback = callback
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, stage, watch=(), **fields):
+        """
+        Record the code in with block as an event of stage.
+        :param stage: The name of stage, such as 'run_glue'.
+        :param watch: The directories in which the files written by the stage are counted. Without them,
+            the with block may set 'files' and 'bytes' of the event itself.
+        :param fields: More fields of the event, such as file_name='UAFD0600'.
+        :return: The event, more fields can be added to it in with block.
+        """
+        event = {'stage': stage}
+        event.update(fields)
+        before = _snapshot(watch)
+        cpu, _ = _usage()
+        child_cpu, _ = _usage(children=True)
+        event['start'] = time.time()
+        start = time.perf_counter()
+        try:
+            yield event
+        finally:
+            event['wall'] = time.perf_counter() - start
+            if resource is not None:
+                event['cpu'] = _usage()[0] - cpu
+                after_cpu, event['child_max_rss_kb'] = _usage(children=True)
+                event['child_cpu'] = after_cpu - child_cpu
+            if watch:
+                written = [(path, size) for path, (mtime, size) in _snapshot(watch).items()
+                           if before.get(path) != (mtime, size)]
+                event['files'] = len(written)
+                event['bytes'] = sum(size for _, size in written)
+            event.setdefault('files', 0)
+            event.setdefault('bytes', 0)
+            event['pid'] = os.getpid()
+            self.emit(event)
+
+    def emit(self, event):
+        """
+        Keep event and pass it to the sinks, events recorded in other processes are emitted by this.
+        """
+        with self._lock:
+            self.events.append(event)
+            if self.path is not None:
+                with open(self.path, 'a', encoding='utf-8') as fp:
+                    fp.write(json.dumps(event) + '\n')
+        if self.callback is not None:
+            self.callback(event)
+
+    def summary(self):
+        """
+        :return: A table of the events summed up by stage.
+        """
+        stages = {}
+        for event in self.events:
+            total = stages.setdefault(event['stage'], {'count': 0, 'wall': 0.0, 'child_cpu': 0.0,
+                                                       'child_max_rss_kb': 0, 'files': 0, 'bytes': 0})
+            total['count'] += 1
+            for name in ('wall', 'child_cpu', 'files', 'bytes'):
+                total[name] += event.get(name) or 0
+            total['child_max_rss_kb'] = max(total['child_max_rss_kb'], event.get('child_max_rss_kb') or 0)
+        lines = ['%-20s %7s %10s %12s %14s %7s %10s' % ('stage', 'count', 'wall(s)', 'child cpu(s)',
+                                                        'child rss(MB)', 'files', 'MB')]
+        for stage, total in stages.items():
+            lines.append('%-20s %7d %10.3f %12.3f %14.1f %7d %10.2f' % (
+                stage, total['count'], total['wall'], total['child_cpu'], total['child_max_rss_kb'] / 1024.0,
+                total['files'], total['bytes'] / 1024.0 ** 2))
+        return '\n'.join(lines)
+
+
+class NullRecorder(Recorder):
+    """
+    The Recorder used when nothing is recorded, whose stage costs nothing.
+    """
+
+    @contextlib.contextmanager
+    def stage(self, stage, watch=(), **fields):
+        yield {}
+
+    def emit(self, event):
+        pass
+
+
+NULL_RECORDER = NullRecorder()
@@ -0,0 +1,78 @@
+import sqlite3
+import time
+import traceback
+
+# The stages of an experiment in order, a stage done again makes the later stages of the experiment undone
+STAGES = ('xfile', 'glue', 'run', 'extract')
+
+
+class Journal(object):
+    def __init__(self, path):
+        """
+        A SQLite file of the stages finished by every experiment of a campaign, so that a campaign stopped halfway
+        (a failed file, a reboot) is resumed without doing the finished work again.
+        Experiments are named by the base name of their .X file, e.g. UAFD0600.MZX. Every record keeps the digest
+        of what the stage was done with, such as the content of .X file, a record with another digest isn't done.
+        :param path: The path to SQLite file, which is created if it doesn't exist.
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=60)
+        with self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS stages (experiment TEXT, stage TEXT, item TEXT, '
+                               'digest TEXT, status TEXT, error TEXT, updated REAL, '
+                               'PRIMARY KEY (experiment, stage, item))')
+
+    def done(self, experiment, stage, item='', digest=''):
+        """
+        :param item: The part of stage, such as the ingeno of 'glue' and the .OUT file of 'extract'.
+        :return: True if stage of item has been done with digest.
+        """
+        row = self._conn.execute('SELECT digest, status FROM stages WHERE experiment = ? AND stage = ? AND item = ?',
+                                 (experiment, stage, item)).fetchone()
+        return row == (digest, 'done')
+
+    def mark(self, experiment, stage, item='', digest=''):
+        """
+        Record stage of item done with digest. The failures of experiment so far are dropped,
+        and its later stages are undone.
+        """
+        later = STAGES[STAGES.index(stage) + 1:]
+        with self._conn:
+            self._conn.execute("DELETE FROM stages WHERE experiment = ? AND (status = 'failed' OR stage IN (%s))"
+                               % ', '.join('?' * len(later)), (experiment,) + later)
+            self._conn.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (experiment, stage, item, digest, 'done', None, time.time()))
+
+    def fail(self, experiment, stage, error, item=''):
+        """
+        Record the error of experiment at stage.
+        :param error: The exception or the message.
+        """
+        if isinstance(error, BaseException):
+            error = ''.join(traceback.format_exception_only(type(error), error)).strip()
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (experiment, stage, item, '', 'failed', str(error), time.time()))
+
+    def failures(self):
+        """
+        :return: [(experiment, stage, error), ...] of the experiments failed and not done since.
+        """
+        return self._conn.execute("SELECT experiment, stage, error FROM stages WHERE status = 'failed' "
+                                  "ORDER BY experiment").fetchall()
+
+    def reset(self):
+        """
+        Forget every record, which starts a new campaign.
+        """
+        with self._conn:
+            self._conn.execute('DELETE FROM stages')
+
+    def close(self):
+        self._conn.close()
+
+    def summary(self):
+        counts = dict(self._conn.execute("SELECT stage, COUNT(DISTINCT experiment) FROM stages WHERE status = 'done' "
+                                         "GROUP BY stage").fetchall())
+        return 'Journal: %s, %d failed' % (', '.join('%d %s done' % (counts.get(stage, 0), stage) for stage in STAGES),
+                                           len(self.failures()))
@@ -0,0 +1,236 @@
+import json
+import os
+import pickle
+import sys
+
+# The suffix of the binary summary kept next to xfile.json
+PICKLE_SUFFIX = '.pickle'
+# The fields of a single fertilizer application: FDATE FMCD FACD FDEP FAMN FAMP FAMK
+FERTILIZER_FIELDS = 7
+
+
+def _code(value, name):
+    """
+    :return: value as an interned str, so that a code repeated in every row is a single object in memory.
+    """
+    # NaN of an empty cell isn't equal to itself
+    if value is None or value != value:
+        raise ValueError('Missing %s' % name)
+    value = str(value)
+    if not value.strip():
+        raise ValueError('Missing %s' % name)
+    return sys.intern(value)
+
+
+def _date(value, name, missing=False):
+    """
+    :param missing: Whether -99 (left to DSSAT model) is allowed, which is also used for an empty value.
+    :return: value as an interned YYDDD date of 5 digits. Leading zeros dropped by a spreadsheet are put back,
+        e.g. 6123 -> 06123.
+    """
+    if missing and (value is None or value != value or str(value).strip() in ('', '-99')):
+        return sys.intern('-99')
+    text = str(value).strip()
+    if not text.isdigit() or len(text) > 5 or not 1 <= int(text[-3:]) <= 366:
+        raise ValueError('%s should be a YYDDD date, got %r' % (name, value))
+    return sys.intern(text.zfill(5))
+
+
+class Cultivar(object):
+    __slots__ = ('number', 'ingeno', 'cname')
+
+    def __init__(self, number, ingeno, cname):
+        """
+        A cultivar of an experiment, which is the CU level of treatments.
+        :param number: The CU level from 1.
+        :param ingeno: INGENO of the cultivar in .CUL file.
+        :param cname: The cultivar name.
+        """
+        self.number = int(number)
+        self.ingeno = _code(ingeno, 'ingeno')
+        self.cname = _code(cname, 'cname')
+
+    def __reduce__(self):
+        return _restore, (Cultivar, (self.number, self.ingeno, self.cname))
+
+    def __repr__(self):
+        return 'Cultivar(%d, %r, %r)' % (self.number, self.ingeno, self.cname)
+
+
+class FertilizerLevel(object):
+    __slots__ = ('number', 'code', 'applications')
+
+    def __init__(self, number, code):
+        """
+        A fertilizer level of an experiment, which is the MF level of treatments.
+        :param number: The MF level from 1.
+        :param code: FERTILIZERS of input data, applications split by ';' and each of them with
+            FERTILIZER_FIELDS fields split by ' ', e.g. '06123 FE001 AP001 5 10 0 0;06150 FE001 AP001 5 30 0 0'.
+        """
+        self.number = int(number)
+        self.code = _code(code, 'FERTILIZERS')
+        applications = []
+        for application in self.code.split(';'):
+            fields = application.strip().split(' ')
+            if len(fields) != FERTILIZER_FIELDS:
+                raise ValueError('A fertilizer application should have %d fields, got %r in %r' % (
+                    FERTILIZER_FIELDS, application, self.code))
+            _date(fields[0], 'FDATE')
+            applications.append(tuple(sys.intern(field) for field in fields))
+        self.applications = tuple(applications)
+
+    def __reduce__(self):
+        return _restore, (FertilizerLevel, (self.number, self.code, self.applications))
+
+    def __repr__(self):
+        return 'FertilizerLevel(%d, %r)' % (self.number, self.code)
+
+
+class Treatment(object):
+    __slots__ = ('cultivar', 'fertilizer', 'weather', 'soil', 'PDATE', 'EDATE')
+
+    def __init__(self, cultivar, fertilizer, weather, soil, PDATE, EDATE='-99'):
+        """
+        A treatment of an experiment, that is a row of input data.
+        :param cultivar: The Cultivar of the treatment, shared by the treatments of the same ingeno.
+        :param fertilizer: The FertilizerLevel of the treatment, shared by the treatments of the same FERTILIZERS.
+        :param weather: The weather station.
+        :param soil: The soil ID.
+        :param PDATE: The planting date as YYDDD.
+        :param EDATE: The emergence date as YYDDD, -99 or empty to simulate it.
+        """
+        self.cultivar = cultivar
+        self.fertilizer = fertilizer
+        self.weather = _code(weather, 'weather')
+        self.soil = _code(soil, 'soil')
+        self.PDATE = _date(PDATE, 'PDATE')
+        self.EDATE = _date(EDATE, 'EDATE', missing=True)
+
+    def details(self):
+        """
+        :return: The row of the treatment as the 'details' of xfile.json.
+        """
+        return {'ingeno': self.cultivar.ingeno, 'weather': self.weather, 'soil': self.soil, 'PDATE': self.PDATE,
+                'EDATE': self.EDATE, 'FERTILIZERS': self.fertilizer.code}
+
+
+class Experiment(object):
+    __slots__ = ('crop_type', 'file_name', 'cultivars', 'fertilizers', '_columns')
+
+    def __init__(self, crop_type, file_name, cultivars, fertilizers, treatments):
+        """
+        The treatments of a single .X file, which is validated at construction.
+        Treatments are kept by columns, which refer to cultivars and fertilizers by position, so that an experiment
+        costs a few tuples instead of an object for every treatment, and it is pickled and loaded as they are.
+        :param crop_type: The crop type.
+        :param file_name: File name of .X file.
+        :param cultivars: [Cultivar, ...] in the order of .X file.
+        :param fertilizers: [FertilizerLevel, ...] in the order of .X file.
+        :param treatments: [Treatment, ...] in the order of input data.
+        """
+        self.crop_type = _code(crop_type, 'crop_type')
+        self.file_name = _code(file_name, 'file_name')
+        self.cultivars = tuple(cultivars)
+        self.fertilizers = tuple(fertilizers)
+        treatments = tuple(treatments)
+        if not treatments:
+            raise ValueError('%s/%s has no treatment' % (self.crop_type, self.file_name))
+        cultivar_index = {id(cu): i for i, cu in enumerate(self.cultivars)}
+        fertilizer_index = {id(ft): i for i, ft in enumerate(self.fertilizers)}
+        try:
+            self._columns = (tuple(cultivar_index[id(t.cultivar)] for t in treatments),
+                             tuple(fertilizer_index[id(t.fertilizer)] for t in treatments),
+                             tuple(t.weather for t in treatments), tuple(t.soil for t in treatments),
+                             tuple(t.PDATE for t in treatments), tuple(t.EDATE for t in treatments))
+        except KeyError:
+            raise ValueError('%s/%s has a treatment whose cultivar or fertilizer is not in the experiment' % (
+                self.crop_type, self.file_name))
+
+    def __reduce__(self):
+        return _restore, (Experiment, (self.crop_type, self.file_name, self.cultivars, self.fertilizers,
+                                       self._columns))
+
+    def __repr__(self):
+        return 'Experiment(%r, %r, %d treatments)' % (self.crop_type, self.file_name, len(self))
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    @property
+    def treatments(self):
+        """
+        :return: (Treatment, ...) in the order of input data, which are created on every access.
+        """
+        treatments = []
+        for cu, ft, weather, soil, pdate, edate in zip(*self._columns):
+            treatments.append(_restore(Treatment, (self.cultivars[cu], self.fertilizers[ft], weather, soil,
+                                                   pdate, edate)))
+        return tuple(treatments)
+
+    @classmethod
+    def from_dict(cls, crop_type, file_name, file_dict):
+        """
+        :param file_dict: xfile_dict[c][f], see utils._file_dict.
+        """
+        try:
+            cultivars = {ing: Cultivar(number, ing, file_dict['ing-cname'][ing])
+                         for ing, number in file_dict['culitvar'].items()}
+            fertilizers = {ft: FertilizerLevel(number, ft) for ft, number in file_dict['fertilizer'].items()}
+            treatments = [Treatment(cultivars[d['ingeno']], fertilizers[d['FERTILIZERS']], d['weather'], d['soil'],
+                                    d['PDATE'], d['EDATE']) for d in file_dict['details']]
+        except (KeyError, ValueError) as e:
+            raise ValueError('Invalid %s/%s: %s' % (crop_type, file_name, e))
+        return cls(crop_type, file_name, cultivars.values(), fertilizers.values(), treatments)
+
+    def to_dict(self):
+        """
+        :return: xfile_dict[c][f] of the experiment.
+        """
+        return {'details': [t.details() for t in self.treatments],
+                'culitvar': {cu.ingeno: cu.number for cu in self.cultivars},
+                'ing-cname': {cu.ingeno: cu.cname for cu in self.cultivars},
+                'fertilizer': {ft.code: ft.number for ft in self.fertilizers}}
+
+
+def _restore(cls, values):
+    """
+    Create an object of cls validated before, e.g. when it is unpickled, without validating it again.
+    :param values: The values of cls.__slots__ in order.
+    """
+    obj = cls.__new__(cls)
+    for name, value in zip(cls.__slots__, values):
+        setattr(obj, name, value)
+    return obj
+
+
+def from_xfile_dict(xfile_dict):
+    """
+    :return: {crop_type: {file_name: Experiment}} of xfile_dict.
+    """
+    return {c: {f: Experiment.from_dict(c, f, fdict) for f, fdict in cdict.items()} for c, cdict in xfile_dict.items()}
+
+
+def dump_summary(experiments, path):
+    """
+    Write {crop_type: {file_name: Experiment}} to path with the highest pickle protocol.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        pickle.dump(experiments, fp, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_summary(json_file):
+    """
+    Load the summary written by utils.create_input_files.
+    :param json_file: The path to xfile.json, or to xfile.pickle.
+    :return: {crop_type: {file_name: Experiment}} if xfile.pickle is next to json_file and not older than it,
+        else xfile_dict of json_file.
+    """
+    pickle_file = os.path.splitext(json_file)[0] + PICKLE_SUFFIX
+    if os.path.exists(pickle_file) and (not os.path.exists(json_file) or
+                                        os.path.getmtime(pickle_file) >= os.path.getmtime(json_file)):
+        with open(pickle_file, 'rb') as fp:
+            return pickle.load(fp)
+    with open(json_file, 'r', encoding='utf-8') as j:
+        return json.load(j)
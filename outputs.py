@@ -0,0 +1,251 @@
+import io
+import mmap
+import os
+import re
+import shutil
+
+from xfile import Table
+
+_EXPERIMENT = re.compile(r'^\s*EXPERIMENT\s*:\s*(\S+)')
+# The same patterns over the bytes of a memory-mapped .OUT file
+_HEADER = re.compile(rb'^@[^\r\n]*', re.M)
+# A table ends before a blank line or a line of another section, table or batch
+_TABLE_END = re.compile(rb'\n(?:[ \t]*(?:\r?\n|$)|[*@$])')
+_RUN_KEYS = {'RUN': re.compile(rb'^\*RUN\s+(\d+)', re.M),
+             'EXPERIMENT': re.compile(rb'^\s*EXPERIMENT\s*:\s*(\S+)', re.M),
+             'TRNO': re.compile(rb'^\s*TREATMENT\s+(\d+)', re.M)}
+# DSSAT writes -99 for missing values
+MISSING = -99
+FORMATS = ('csv', 'parquet', 'feather')
+# The inputs which may be in the work directory of DSSAT model: genotype files and .X files
+_INPUTS = re.compile(r'\.(CUL|ECO|SPE|\w\wX)$', re.I)
+
+
+def _experiment_key(name):
+    # DSSAT names an experiment with the first 8 chars of .X file name
+    return name[:8].upper()
+
+
+def split_outputs(combined_path, output_paths):
+    """
+    Split the outputs of a DSSAT run with many .X files into a directory for each experiment.
+        Files made of runs (PlantGro.OUT, ...) are split by the EXPERIMENT line of each run,
+        files with an EXNAME column (Summary.OUT) are split by the rows,
+        other files (out.txt, ...) are copied to every experiment, inputs (.CUL, .X files, ...) are left out.
+    :param combined_path: The directory keeps outputs of the run.
+    :param output_paths: {file_name of .X file: the directory to keep its outputs}
+    :return: None
+    """
+    targets = {_experiment_key(name): path for name, path in output_paths.items()}
+    for path in targets.values():
+        if not os.path.exists(path):
+            os.makedirs(path)
+    for fn in os.listdir(combined_path):
+        src = os.path.join(combined_path, fn)
+        if not os.path.isfile(src) or _INPUTS.search(fn):
+            continue
+        # latin-1 keeps every byte as it is
+        with open(src, 'r', encoding='latin-1', newline='') as fp:
+            lines = fp.read().splitlines(True)
+        parts = _split_runs(lines, targets) or _split_rows(lines, targets)
+        if parts is None:
+            for path in targets.values():
+                shutil.copyfile(src, os.path.join(path, fn))
+            continue
+        for key, path in targets.items():
+            with open(os.path.join(path, fn), 'w', encoding='latin-1', newline='') as fp:
+                fp.write(''.join(parts[key]))
+
+
+def _split_runs(lines, targets):
+    """
+    :return: {experiment: lines}, None if lines are not made of runs with EXPERIMENT lines.
+    """
+    # A run begins with *DSSAT Cropping System Model, or with *RUN if there isn't that line
+    begins = [i for i, line in enumerate(lines) if line.startswith('*DSSAT Cropping System Model')]
+    if not begins:
+        begins = [i for i, line in enumerate(lines) if line.startswith('*RUN')]
+    if not begins:
+        return None
+    parts = {key: lines[:begins[0]] for key in targets}
+    found = False
+    for begin, end in zip(begins, begins[1:] + [len(lines)]):
+        block = lines[begin:end]
+        keys = list(targets)
+        for line in block:
+            m = _EXPERIMENT.match(line)
+            if m is not None:
+                found = True
+                keys = [k for k in targets if k == _experiment_key(m.group(1))]
+                break
+        for key in keys:
+            parts[key].extend(block)
+    return parts if found else None
+
+
+def _split_rows(lines, targets):
+    """
+    :return: {experiment: lines}, None if lines have no '@' header with EXNAME column.
+    """
+    for i, line in enumerate(lines):
+        if line.startswith('@') and re.search(r'\bEXNAME\b', line):
+            break
+    else:
+        return None
+    table = Table(None, lines[i].rstrip('\r\n'))
+    rows = [line for line in lines[i + 1:] if line.strip()]
+    for line in rows:
+        table.append(line.rstrip('\r\n'))
+    parts = {key: lines[:i + 1] for key in targets}
+    for line, row in zip(rows, table.rows):
+        key = _experiment_key(row['EXNAME'])
+        if key in parts:
+            parts[key].append(line)
+    return parts
+
+
+def read_output(path, sidecar=None):
+    """
+    Parse a fixed-width .OUT file of DSSAT model (Summary.OUT, PlantGro.OUT, ...) into a typed DataFrame.
+    The file is memory-mapped, and every '@' table in it is parsed at once by the C parser of pandas.
+    Rows are tagged with RUN, EXPERIMENT and TRNO of the run they belong to, unless the table has those columns.
+    MISSING values become NaN.
+    :param path: The path to .OUT file.
+    :param sidecar: Optional 'parquet' or 'feather'. The frame is kept in path.sidecar, which is read instead
+        of parsing path again until path is modified.
+    :return: DataFrame
+    """
+    import pandas as pd
+
+    if sidecar is not None:
+        sidecar_path = '%s.%s' % (path, sidecar)
+        if os.path.exists(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(path):
+            return getattr(pd, 'read_' + sidecar)(sidecar_path)
+    frames = []
+    if os.path.getsize(path):
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            previous = 0
+            for m in _HEADER.finditer(mm):
+                end = _TABLE_END.search(mm, m.end())
+                end = end.start() + 1 if end is not None else len(mm)
+                keys = {}
+                for name, pattern in _RUN_KEYS.items():
+                    found = pattern.findall(mm, previous, m.start())
+                    if found:
+                        keys[name] = found[-1].decode('latin-1')
+                frame = _read_table(m.group().decode('latin-1'), mm[m.end():end], keys)
+                if frame is not None:
+                    frames.append(frame)
+                previous = end
+    df = pd.concat(frames, ignore_index=True, sort=False) if frames else pd.DataFrame()
+    if sidecar is not None:
+        write_frame(df, sidecar_path, sidecar)
+    return df
+
+
+def _read_table(header, body, keys):
+    """
+    :param header: The '@' header line.
+    :param body: The bytes of rows under header.
+    :param keys: {'RUN': .., 'EXPERIMENT': .., 'TRNO': ..} found before header.
+    :return: DataFrame, None if there is no row.
+    """
+    import pandas as pd
+
+    table = Table(None, header)
+    rows = body.lstrip(b'\r\n')
+    if not table.columns or not rows.strip():
+        return None
+    first = rows.split(b'\n', 1)[0]
+    df = None
+    if len(first.split()) == len(table.columns):
+        try:
+            df = pd.read_csv(io.BytesIO(rows), sep=r'\s+', header=None, names=table.columns, encoding='latin-1',
+                             comment='!')
+        except pd.errors.ParserError:
+            df = None
+    if df is None:
+        # Values with blanks (TNAM, FNAM, ...) are read by the fixed width of the header like xfile.Table
+        colspecs = [(b, e if e is not None else len(first) + 1024) for b, e in table._spans]
+        df = pd.read_fwf(io.BytesIO(rows), colspecs=colspecs, header=None, names=table.columns,
+                         encoding='latin-1', comment='!')
+    numeric = df.select_dtypes(include='number').columns
+    df[numeric] = df[numeric].where(df[numeric] != MISSING)
+    for name in ('TRNO', 'EXPERIMENT', 'RUN'):
+        if name in keys and name not in df.columns:
+            df.insert(0, name, int(keys[name]) if keys[name].isdigit() else keys[name])
+    return df
+
+
+def read_results(result_path, name='Summary.OUT', workers=None, sidecar=None, file_names=None):
+    """
+    Parse name in every result directory (result_path/crop_type/file_name, as written by DSSAT.run)
+    with a pool of threads, and concatenate them into one frame keyed by crop_type, file_name and TRNO.
+    :param result_path: The directory keeps evaluated outputs.
+    :param name: The .OUT file to parse.
+    :param workers: The number of files parsed at once, None means the default of ThreadPoolExecutor.
+    :param sidecar: Optional 'parquet' or 'feather', see read_output.
+    :param file_names: Optional set of (crop_type, file_name) to parse, None means every result directory.
+    :return: DataFrame
+    """
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+
+    paths = []
+    for crop_type in sorted(os.listdir(result_path)):
+        if not os.path.isdir(os.path.join(result_path, crop_type)):
+            continue
+        for file_name in sorted(os.listdir(os.path.join(result_path, crop_type))):
+            path = os.path.join(result_path, crop_type, file_name, name)
+            if (file_names is None or (crop_type, file_name) in file_names) and os.path.isfile(path):
+                paths.append((crop_type, file_name, path))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        frames = list(pool.map(lambda item: read_output(item[2], sidecar), paths))
+    for (crop_type, file_name, _), df in zip(paths, frames):
+        df.insert(0, 'file_name', file_name)
+        df.insert(0, 'crop_type', crop_type)
+    return pd.concat(frames, ignore_index=True, sort=False) if frames else pd.DataFrame()
+
+
+def merge_results(table, df, kept):
+    """
+    Update a table of read_results with the rows of some experiments parsed again.
+    :param table: The frame of read_results written before.
+    :param df: The frame of read_results of the experiments parsed again.
+    :param kept: The set of (crop_type, file_name) whose rows of table are kept, the rows of the others are dropped.
+    :return: DataFrame ordered by crop_type and file_name like read_results.
+    """
+    import pandas as pd
+
+    rows = [key in kept for key in zip(table['crop_type'], table['file_name'])]
+    df = pd.concat([table[rows], df], ignore_index=True, sort=False)
+    return df.sort_values(['crop_type', 'file_name'], kind='mergesort').reset_index(drop=True)
+
+
+def write_frame(df, path, fmt='csv'):
+    """
+    Write df in one of FORMATS, parquet and feather need pyarrow.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format %s, should be one of %s' % (fmt, ', '.join(FORMATS)))
+    if fmt == 'csv':
+        df.to_csv(path, index=False)
+    elif fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(path)
+
+
+def read_frame(path, fmt='csv'):
+    """
+    Read a frame written by write_frame. The cells of csv are kept as they are written, e.g. a date like 06123.
+    """
+    import pandas as pd
+
+    if fmt not in FORMATS:
+        raise ValueError('Unknown format %s, should be one of %s' % (fmt, ', '.join(FORMATS)))
+    if fmt == 'csv':
+        return pd.read_csv(path, dtype=str, keep_default_na=False)
+    elif fmt == 'parquet':
+        return pd.read_parquet(path)
+    return pd.read_feather(path)
@@ -1,32 +1,226 @@
-import utils
-from dssat import DSSAT
-import os
-import argparse
-
-SUFFIXES = {'maize': '.MZX', 'rice': '.RIX'}
-
-
-def run_model(input_summary_file, output_summary_file, out_crop_path, result_output, gl_epochs, crop_type=None,
-              file_name=None, run_path_absolute=r'C:\DSSAT47', glue_flag=1, simulation_model='B'):
-    utils.create_input_files(input_summary_file, output_summary_file)
-    utils.create_xfile(os.path.join(output_summary_file, 'xfile.json'), out_crop_path, crop_type, file_name)
-    for fn in os.listdir(out_crop_path):
-        if os.path.splitext(fn)[-1] in list(SUFFIXES.values()):
-            dssat = DSSAT(os.path.join(out_crop_path, fn), run_path_absolute)
-            dssat(result_output, gl_epochs, glue_flag, simulation_model)
-
-
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Run Dssat model with GLUE')
-    parser.add_argument('--input', '-i', help='path to input summary file')
-    parser.add_argument('--output', '-o', default=os.getcwd(),
-                        help='path to preserve reorganized summary output file')
-    parser.add_argument('--cropdir', '-cd', default=os.path.join(os.getcwd(), 'output'),
-                        help='path to preserve reorganized summary output file')
-    parser.add_argument('--result', '-rs', default=os.path.join(os.getcwd(), 'result'),
-                        help='path to preserve result files of dssat model')
-    parser.add_argument('--epochs', '-e', default=5000, help='Epochs of GLUE')
-
-    args = parser.parse_args()
-
-    run_model(args.input, args.output, args.cropdir, args.result, args.epochs)
+import utils
+from backend import BACKENDS, create_backend
+from cache import CalibrationCache, ResultCache, file_digest
+from compactor import ARCHIVES, DEFAULT_KEEP, Compactor
+from dssat import DSSAT, RE_SUFFIXES
+from instrument import NULL_RECORDER, Recorder
+from journal import Journal
+from outputs import FORMATS, merge_results, read_frame, read_results, write_frame
+from scheduler import run_parallel
+from workqueue import WorkQueue, coordinate, work
+import os
+import sys
+import argparse
+
+SUFFIXES = {'maize': '.MZX', 'rice': '.RIX'}
+
+
+def _experiment(x_file):
+    """
+    :return: (crop_type, file_name) of x_file, which names its result directory.
+    """
+    base_name = os.path.basename(x_file)
+    return RE_SUFFIXES[os.path.splitext(base_name)[-1]], os.path.splitext(base_name)[0]
+
+
+def run_model(input_summary_file, output_summary_file, out_crop_path, result_output, gl_epochs, crop_type=None,
+              file_name=None, run_path_absolute=None, glue_flag=1, simulation_model='B', workers=1,
+              stream=False, stream_json=False, batch_size=1, glue_workers=1, r_path=None, cache=None,
+              calibration_cache=None, force_glue=False, extract=None, sidecar=None, compactor=None, recorder=None,
+              incremental=False, journal=None, resume=False, backend=None, queue=None, poll=5):
+    """
+    Run a campaign from input summary file: create .X files, run GLUE and DSSAT model for each of them,
+    then extract and compact the outputs. A file which fails doesn't stop the others.
+    :param journal: Optional journal.Journal to record the stages done by every .X file.
+    :param resume: Skip the work done in journal, which is started over otherwise.
+        .X files are created incrementally when resuming.
+    :param backend: Optional backend.Backend to launch DSSAT model and R, see DSSAT.
+    :param queue: Optional workqueue.WorkQueue. The .X files are run by the workers of the queue instead of here,
+        so out_crop_path, result_output and cache must be on the filesystem shared by them. workers, batch_size
+        and glue_workers are the options of a worker, and calibration_cache (SQLite) can't be shared by nodes,
+        so they can't be used with queue.
+    :param poll: The seconds between two looks at queue.
+    :return: The .X files failed.
+    """
+    if queue is not None:
+        unsupported = [name for name, used in (('workers', workers != 1), ('batch_size', batch_size != 1),
+                                               ('glue_workers', glue_workers != 1),
+                                               ('calibration_cache', calibration_cache is not None),
+                                               ('force_glue', force_glue)) if used]
+        if unsupported:
+            raise ValueError('%s can not be used with queue' % ', '.join(unsupported))
+    stages = recorder or NULL_RECORDER
+    backend = backend or create_backend(r_path=r_path)
+    if journal is not None and not resume:
+        journal.reset()
+    incremental = incremental or resume
+    if stream:
+        json_file = os.path.join(output_summary_file, 'xfile.jsonl') if stream_json else None
+        with stages.stage('create_xfile', (out_crop_path,)):
+            utils.create_xfile_streaming(input_summary_file, out_crop_path, crop_type, file_name, json_file,
+                                         incremental=incremental)
+    else:
+        with stages.stage('create_input_files', files=1) as event:
+            utils.create_input_files(input_summary_file, output_summary_file)
+            event['bytes'] = os.path.getsize(os.path.join(output_summary_file, 'xfile.json'))
+        with stages.stage('create_xfile', (out_crop_path,)):
+            utils.create_xfile(os.path.join(output_summary_file, 'xfile.json'), out_crop_path, crop_type, file_name,
+                               incremental=incremental)
+    x_files = [os.path.join(out_crop_path, fn) for fn in os.listdir(out_crop_path)
+               if os.path.splitext(fn)[-1] in list(SUFFIXES.values())]
+    digests = {x_file: file_digest(x_file) for x_file in x_files}
+    for x_file in x_files if journal is not None else []:
+        # A changed .X file undoes the later stages of it
+        if not journal.done(os.path.basename(x_file), 'xfile', digest=digests[x_file]):
+            journal.mark(os.path.basename(x_file), 'xfile', digest=digests[x_file])
+    # The files to extract are read after every run, so the compaction waits for them
+    run_compactor = None if extract else compactor
+    if queue is not None:
+        results = coordinate(queue, x_files, result_output, gl_epochs, glue_flag, simulation_model, run_compactor,
+                             resume, poll, journal, run_path_absolute, backend, cache, recorder)
+        failed = [x_file for x_file in x_files if x_file not in results]
+    elif workers is None or workers > 1 or batch_size > 1:
+        results = run_parallel(x_files, result_output, gl_epochs, run_path_absolute, glue_flag, simulation_model,
+                               workers, batch_size=batch_size, glue_workers=glue_workers, cache=cache,
+                               calibration_cache=calibration_cache, force_glue=force_glue, compactor=run_compactor,
+                               recorder=recorder, journal=journal, backend=backend)
+        failed = [x_file for x_file in x_files if x_file not in results]
+    else:
+        failed = []
+        for x_file in x_files:
+            try:
+                dssat = DSSAT(x_file, run_path_absolute, recorder=recorder, journal=journal, backend=backend)
+                dssat(result_output, gl_epochs, glue_flag, simulation_model, glue_workers, cache, calibration_cache,
+                      force_glue, compactor=run_compactor)
+            except Exception as e:
+                print('\n### Failed: %s, %s: %s' % (x_file, type(e).__name__, e))
+                failed.append(x_file)
+    finished = [x_file for x_file in x_files if x_file not in failed]
+    if cache is not None:
+        print(cache.summary())
+    if calibration_cache is not None:
+        print(calibration_cache.summary())
+    for name in extract or []:
+        fmt = sidecar or 'csv'
+        path = os.path.join(output_summary_file, '%s.%s' % (os.path.splitext(name)[0], fmt))
+        extracted = []
+        if journal is not None and os.path.exists(path):
+            extracted = [x_file for x_file in finished
+                         if journal.done(os.path.basename(x_file), 'extract', name, digests[x_file])]
+        if journal is not None and os.path.exists(path) and len(extracted) == len(finished):
+            print('\n### Extracted before: %s' % path)
+            continue
+        with stages.stage('extract', files=1, name=name) as event:
+            if extracted:
+                # The directories extracted before may have been compacted since, so their rows are kept from the
+                # table and only the other experiments are parsed
+                kept = set(_experiment(x_file) for x_file in extracted)
+                df = read_results(result_output, name, sidecar=sidecar, file_names=set(
+                    _experiment(x_file) for x_file in finished if x_file not in extracted))
+                df = merge_results(read_frame(path, fmt), df, kept)
+            else:
+                df = read_results(result_output, name, sidecar=sidecar)
+            write_frame(df, path, fmt)
+            event['bytes'] = os.path.getsize(path)
+        for x_file in finished if journal is not None else []:
+            journal.mark(os.path.basename(x_file), 'extract', name, digests[x_file])
+        print('\n### Extracted: %s' % path)
+    if compactor is not None:
+        if extract:
+            for x_file in finished:
+                compactor.submit(os.path.join(result_output, *_experiment(x_file)))
+        with stages.stage('compact'):
+            compactor.close()
+    if recorder is not None:
+        print(recorder.summary())
+    if journal is not None:
+        print(journal.summary())
+    if failed:
+        print('\n### %d of %d .X files failed: %s' % (
+            len(failed), len(x_files), ', '.join(os.path.basename(x_file) for x_file in failed)))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run Dssat model with GLUE')
+    parser.add_argument('--input', '-i', help='path to input summary file')
+    parser.add_argument('--output', '-o', default=os.getcwd(),
+                        help='path to preserve reorganized summary output file')
+    parser.add_argument('--cropdir', '-cd', default=os.path.join(os.getcwd(), 'output'),
+                        help='path to preserve reorganized summary output file')
+    parser.add_argument('--result', '-rs', default=os.path.join(os.getcwd(), 'result'),
+                        help='path to preserve result files of dssat model')
+    parser.add_argument('--epochs', '-e', default=5000, help='Epochs of GLUE')
+    parser.add_argument('--workers', '-w', default=1, type=int,
+                        help='number of processes to run dssat model at once, 0 means the number of CPUs')
+    parser.add_argument('--batch-size', '-bs', default=1, type=int,
+                        help='number of .X files run by a single process of dssat model')
+    parser.add_argument('--glue-workers', '-gw', default=1, type=int,
+                        help='number of cultivars calibrated by GLUE at once, 0 means the number of CPUs')
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help='how to launch dssat model and R, the one of current OS by default')
+    parser.add_argument('--dssat-home', help='Dssat installed directory, $DSSAT_HOME or the default of --backend')
+    parser.add_argument('--model', help='dssat model executable, $DSSAT_MODEL or DSCSM047.EXE/dscsm048 by default')
+    parser.add_argument('--dssat-version', help='3 digits version in the names of Dssat files, e.g. 047 or 048')
+    parser.add_argument('--r-path', help='R or Rscript executable to run GLUE, $DSSAT_R or the default of --backend')
+    parser.add_argument('--cache', help='directory of the result cache, outputs of unchanged experiments are reused')
+    parser.add_argument('--cache-size', default=10.0, type=float, help='size limit of the result cache in GB')
+    parser.add_argument('--glue-cache',
+                        help='SQLite file of calibrated cultivars, GLUE is skipped for the unchanged ones')
+    parser.add_argument('--force-glue', action='store_true',
+                        help='run GLUE for every cultivar even if it is in --glue-cache or done in --journal')
+    parser.add_argument('--extract', nargs='+',
+                        help='.OUT files to collect from every result directory into one table in --output, '
+                             'e.g. Summary.OUT PlantGro.OUT')
+    parser.add_argument('--sidecar', choices=FORMATS[1:],
+                        help='keep parsed .OUT files as parquet/feather, which is also the format of --extract')
+    parser.add_argument('--compact', action='store_true',
+                        help='delete the outputs which don\'t match --keep and write a manifest in each result '
+                             'directory while the next run goes on')
+    parser.add_argument('--keep', nargs='+', default=list(DEFAULT_KEEP), help='outputs kept by --compact')
+    parser.add_argument('--archive', choices=ARCHIVES, help='pack the outputs kept by --compact into a tar file')
+    parser.add_argument('--profile', help='JSON-lines file to append the time and resources of every stage to')
+    parser.add_argument('--stream', action='store_true',
+                        help='create .X files chunk by chunk without xfile.json, rows of a file must be together')
+    parser.add_argument('--stream-json', action='store_true',
+                        help='keep the summary as xfile.jsonl in --output when --stream is set')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only rewrite the .X files whose rows changed since the last run')
+    parser.add_argument('--journal', help='SQLite file to record the stages done by every .X file, '
+                                          'journal.db in --output by default')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the .X files, cultivars and outputs done in --journal by the last run')
+    parser.add_argument('--queue', help='directory on a shared filesystem to publish the .X files to, which are run '
+                                        'by the workers started with --worker on any node')
+    parser.add_argument('--worker', help='run the tasks of this queue directory until all of them are done')
+    parser.add_argument('--progress', help='print the progress of this queue directory and the running tasks')
+    parser.add_argument('--lease', default=300, type=float,
+                        help='seconds before the task of a worker without heartbeat is run by another one')
+    parser.add_argument('--max-attempts', default=3, type=int, help='times a task is tried before it fails')
+    parser.add_argument('--poll', default=5, type=float, help='seconds between two looks at the queue')
+    parser.add_argument('--scratch', help='local directory of the workspaces of --worker, a temporary one by default')
+
+    args = parser.parse_args()
+    backend = create_backend(args.backend, model=args.model, r_path=args.r_path, version=args.dssat_version,
+                             home=args.dssat_home)
+    if args.progress:
+        print(WorkQueue(args.progress).view())
+        sys.exit(0)
+    if args.worker:
+        work(WorkQueue(args.worker), scratch_path=args.scratch, glue_workers=args.glue_workers or None,
+             backend=backend, poll=args.poll)
+        sys.exit(0)
+
+    failed = run_model(args.input, args.output, args.cropdir, args.result, args.epochs, workers=args.workers or None,
+                       stream=args.stream, stream_json=args.stream_json, batch_size=args.batch_size,
+                       glue_workers=args.glue_workers or None,
+                       cache=ResultCache(args.cache, int(args.cache_size * 1024 ** 3)) if args.cache else None,
+                       calibration_cache=CalibrationCache(args.glue_cache) if args.glue_cache else None,
+                       force_glue=args.force_glue, extract=args.extract, sidecar=args.sidecar,
+                       compactor=Compactor(args.keep, args.archive) if args.compact or args.archive else None,
+                       recorder=Recorder(args.profile) if args.profile else None, incremental=args.incremental,
+                       journal=Journal(args.journal or os.path.join(args.output, 'journal.db')),
+                       resume=args.resume, backend=backend,
+                       queue=WorkQueue(args.queue, args.lease, args.max_attempts) if args.queue else None,
+                       poll=args.poll)
+    sys.exit(1 if failed else 0)
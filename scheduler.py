@@ -0,0 +1,176 @@
+import os
+import shutil
+import tempfile
+
+from cache import file_digest
+from backend import create_backend
+from dssat import DSSAT, DSSATBatch, RE_SUFFIXES
+from instrument import Recorder
+
+
+def _run_worker(x_files, run_path_absolute, scratch_path, simulation_model, cache=None, record=False, backend=None):
+    """
+    Run x_files of the same crop type inside their own workspace, which is called in a pool worker.
+    A single x_file is run by DSSAT, more x_files are run by DSSATBatch with one DSSAT model process.
+    :param x_files: The absolute paths to .cuX files.
+    :param run_path_absolute: The absolute path to Dssat installed directory.
+    :param scratch_path: The directory to create the private workspace in.
+    :param simulation_model: The simulation model passed to DSSAT.run.
+    :param cache: Optional ResultCache, a copy of it lives in the worker.
+    :param record: Record the stages with a Recorder in the worker.
+    :param backend: The backend.Backend of DSSAT.
+    :return: The private directory that keeps evaluated outputs of x_files, the stats of cache and the events
+        recorded.
+    """
+    recorder = Recorder() if record else None
+    if cache is not None:
+        # The copy comes with the counters of the parent, only the ones of this call are merged back
+        cache.stats = dict.fromkeys(cache.stats, 0)
+    file_name = os.path.splitext(os.path.basename(x_files[0]))[0]
+    workspace = tempfile.mkdtemp(prefix=file_name + '_', dir=scratch_path)
+    try:
+        if len(x_files) == 1:
+            dssat = DSSAT(x_files[0], run_path_absolute, workspace=workspace, recorder=recorder, backend=backend)
+        else:
+            dssat = DSSATBatch(x_files, run_path_absolute, workspace=workspace, recorder=recorder, backend=backend)
+        dssat.create_DSSBatch()
+        dssat.run(os.path.join(workspace, 'result'), simulation_model, cache)
+    except BaseException:
+        # The workspace of a successful run is removed once it is merged
+        shutil.rmtree(workspace, ignore_errors=True)
+        raise
+    return workspace, cache.stats if cache is not None else {}, recorder.events if record else []
+
+
+def _chunks(x_files, batch_size):
+    """
+    Group x_files by crop type, then cut every group into lists of at most batch_size files.
+    """
+    groups = {}
+    for x_file in x_files:
+        groups.setdefault(os.path.splitext(x_file)[-1], []).append(x_file)
+    return [files[i:i + batch_size] for files in groups.values() for i in range(0, len(files), batch_size)]
+
+
+def _result_path(result_output, x_file):
+    """
+    :return: result_output/crop_type/file_name of x_file.
+    """
+    base_name = os.path.basename(x_file)
+    return os.path.join(result_output, RE_SUFFIXES[os.path.splitext(base_name)[-1]], os.path.splitext(base_name)[0])
+
+
+def _failed(journal, x_file, stage, error):
+    """
+    Report the error of x_file at stage, which doesn't stop the other files.
+    """
+    print('\n### Failed: %s at %s, %s: %s' % (x_file, stage, type(error).__name__, error))
+    if journal is not None:
+        journal.fail(os.path.basename(x_file), stage, error)
+
+
+def _merge_tree(src, dst):
+    """
+    Move every file under src into dst, files in dst with the same name are replaced.
+    """
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    for fn in os.listdir(src):
+        if os.path.isdir(os.path.join(src, fn)):
+            _merge_tree(os.path.join(src, fn), os.path.join(dst, fn))
+        else:
+            os.replace(os.path.join(src, fn), os.path.join(dst, fn))
+
+
+def run_parallel(x_files, result_output, gl_epochs, run_path_absolute=None, glue_flag=1,
+                 simulation_model='B', workers=None, scratch_path=None, batch_size=1, glue_workers=1,
+                 r_path=None, cache=None, calibration_cache=None, force_glue=False, compactor=None,
+                 recorder=None, journal=None, backend=None):
+    """
+    Run many x_files at once with a pool of processes.
+    GLUE shares GLWork and Tools/GLUE of Dssat installed directory, so it is still called one by one at first.
+    Then every x_file is run by DSSAT.run in a private workspace (crop directory, DSSBatch.v47, output directory
+    and a copy of .CUL file), and the outputs are merged back into result_output at the end.
+    :param x_files: The absolute paths to .cuX files.
+    :param result_output: The directory to keep evaluated outputs, as in DSSAT.run.
+    :param gl_epochs: The epochs to run glue, None skips GLUE.
+    :param run_path_absolute: The absolute path to Dssat installed directory, None means the one of backend.
+    :param glue_flag:
+    :param simulation_model:
+    :param workers: The number of worker processes, None means the number of CPUs.
+    :param scratch_path: The directory to keep workspaces. A temporary directory is used and removed if None.
+    :param batch_size: The number of x_files run by a single DSSAT model process. Bigger batches start
+        fewer processes, smaller ones spread better over the workers.
+    :param glue_workers: The number of cultivars calibrated at once, see DSSAT.run_glue.
+    :param r_path: The R executable to run GLUE, which is used when backend is None.
+    :param cache: Optional ResultCache shared by the workers, whose stats are merged back.
+    :param calibration_cache: Optional CalibrationCache, see DSSAT.run_glue.
+    :param force_glue: Run GLUE even for the cultivars in calibration_cache.
+    :param compactor: Optional Compactor, every result directory is submitted to it once it is merged.
+    :param recorder: Optional instrument.Recorder, which gets the events recorded in the workers too.
+    :param journal: Optional journal.Journal. The cultivars calibrated and the files run in it are skipped,
+        and the stages done or failed are recorded in it.
+    :param backend: Optional backend.Backend, see DSSAT.
+    :return: {x_file: result directory} of the files run or skipped. A file whose GLUE or run fails is left out
+        while the others go on, with batch_size > 1 the whole batch of a failed run is left out.
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    backend = backend or create_backend(r_path=r_path)
+    # STEP1 : RUN GLUE
+    failed = set()
+    for x_file in x_files if gl_epochs is not None else []:
+        try:
+            DSSAT(x_file, run_path_absolute, recorder=recorder, journal=journal, backend=backend).run_glue(
+                gl_epochs, glue_flag, glue_workers, calibration_cache, force_glue)
+        except Exception as e:
+            _failed(journal, x_file, 'glue', e)
+            failed.add(x_file)
+
+    results, digests, pending = {}, {}, []
+    for x_file in x_files:
+        if x_file in failed:
+            continue
+        digests[x_file] = file_digest(x_file)
+        if journal is not None and journal.done(os.path.basename(x_file), 'run', digest=digests[x_file]):
+            results[x_file] = _result_path(result_output, x_file)
+            print('\n### Skipped: %s, which has finished before' % results[x_file])
+        else:
+            pending.append(x_file)
+
+    # STEP2 : RUN DSSAT IN WORKSPACES
+    remove_scratch = scratch_path is None
+    if remove_scratch:
+        scratch_path = tempfile.mkdtemp(prefix='pydssat_')
+    elif not os.path.exists(scratch_path):
+        os.makedirs(scratch_path)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_run_worker, chunk, run_path_absolute, scratch_path, simulation_model, cache,
+                                   recorder is not None, backend): chunk for chunk in _chunks(pending, batch_size)}
+            for future in as_completed(futures):
+                try:
+                    workspace, stats, events = future.result()
+                except Exception as e:
+                    for x_file in futures[future]:
+                        _failed(journal, x_file, 'run', e)
+                    continue
+                if cache is not None:
+                    cache.merge_stats(stats)
+                for event in events:
+                    recorder.emit(event)
+
+                # STEP3 : MERGE OUTPUTS
+                for x_file in futures[future]:
+                    results[x_file] = _result_path(result_output, x_file)
+                    _merge_tree(_result_path(os.path.join(workspace, 'result'), x_file), results[x_file])
+                    print('\n### Merged: %s' % results[x_file])
+                    if journal is not None:
+                        journal.mark(os.path.basename(x_file), 'run', digest=digests[x_file])
+                    if compactor is not None:
+                        compactor.submit(results[x_file])
+                shutil.rmtree(workspace, ignore_errors=True)
+    finally:
+        if remove_scratch:
+            shutil.rmtree(scratch_path, ignore_errors=True)
+    return results
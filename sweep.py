@@ -0,0 +1,187 @@
+import itertools
+import os
+import re
+from collections import OrderedDict
+
+from utils import XFILE_TEMPLATE, XFileWriter
+
+# DSSAT reads 2 digits of treatment number and of every factor level
+MAX_TREATMENTS = 99
+_LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+def _level_line(template, header):
+    """
+    :return: The line under the header line starting with header, which renders the first level of a section.
+    """
+    m = re.search(r'^%s[^\n]*\n([^\n]*)' % re.escape(header), template, re.M)
+    return m.group(1)
+
+
+_FIELD_LINE = _level_line(XFILE_TEMPLATE, '@L ID_FIELD')
+_PLANTING_LINE = _level_line(XFILE_TEMPLATE, '@P PDATE')
+# The template of XFileWriter with a line for each field level and planting level
+SWEEP_TEMPLATE = XFILE_TEMPLATE.replace('\n' + _FIELD_LINE + '\n', '\n{fields}\n', 1).replace(
+    '\n' + _PLANTING_LINE + '\n', '\n{planting}\n', 1)
+
+
+class SweepWriter(XFileWriter):
+    """
+    Render .X files whose treatments are scenarios, every scenario may have its own cultivar, field
+    (weather and soil), planting and fertilizer level.
+    """
+
+    def __init__(self, template=SWEEP_TEMPLATE):
+        super(SweepWriter, self).__init__(template)
+
+    def render(self, crop_type, file_name, scenarios):
+        """
+        :param crop_type: The crop type.
+        :param file_name: File name of output .X file.
+        :param scenarios: [(scenario number, {'ingeno':.., 'cname':.., 'weather':.., 'soil':.., 'PDATE':..,
+            'EDATE':.., 'FERTILIZERS':..}), ...], at most MAX_TREATMENTS of them.
+        :return: The text of .X file.
+        """
+        abbreviation = self.abbreviation[crop_type]
+        station, year = self._station_year(file_name)
+        cultivars, field_levels, plantings, fertilizers = OrderedDict(), OrderedDict(), OrderedDict(), OrderedDict()
+        treatments = []
+        for i, (number, s) in enumerate(scenarios):
+            cu = cultivars.setdefault(s['ingeno'], (len(cultivars) + 1, s['cname']))[0]
+            fl = field_levels.setdefault((s['weather'], s['soil']), len(field_levels) + 1)
+            mp = plantings.setdefault((s['PDATE'], s['EDATE']), len(plantings) + 1)
+            mf = fertilizers.setdefault(s['FERTILIZERS'], len(fertilizers) + 1)
+            treatments.append('{number:2d} 1 1 0 {tname:<26}{cu:2}{fl:>3}  0  1{mp:>3}  1{mf:>3}  1  0  0  0  0  1\n'
+                              .format(number=i + 1, tname='SCENARIO %d' % number, cu=cu, fl=fl, mp=mp, mf=mf))
+        # The sections of a single level start with the earliest planting
+        pdate = min(pdate for pdate, _ in plantings)
+        field_lines = ['%2d%s' % (level, _FIELD_LINE[2:].format(station=station, weather=weather, soil=soil))
+                       for (weather, soil), level in field_levels.items()]
+        planting_lines = ['%2d%s' % (level, _PLANTING_LINE[2:].format(PDATE=p, EDATE=e))
+                          for (p, e), level in plantings.items()]
+        fields = {'file_name': file_name, 'abbreviation': abbreviation, 'treatments': ''.join(treatments),
+                  'cultivars': ''.join('{0:2d} {1} {2} {3}\n'.format(idx, abbreviation, ing, cname)
+                                       for ing, (idx, cname) in cultivars.items()),
+                  'fields': '\n'.join(field_lines), 'planting': '\n'.join(planting_lines),
+                  'station': station, 'year': year, 'PDATE': pdate, 'PDATE_minus_1': int(pdate) - 1,
+                  'fertilizer': ''.join(
+                      '{0:2d} {1:5}{2:>6}{3:>6}{4:>6}{5:>6}{6:>6}{7:>6}   -99   -99   -99 -99\n'.format(
+                          idx, *(ft.strip().split(' '))) for fts, idx in fertilizers.items() for ft in fts.split(';'))}
+        return self._fill(fields)
+
+
+class Sweep(object):
+    def __init__(self, base, axes, crop_type='maize', prefix='SW', max_treatments=MAX_TREATMENTS):
+        """
+        A grid of scenarios made of a base experiment and the axes to sweep, which is rendered straight into
+        .X files with up to max_treatments scenarios in each, without input xlsx rows or xfile.json.
+        :param base: The base experiment as a row of input xlsx file,
+            {'ingeno':.., 'cname':.., 'weather':.., 'soil':.., 'PDATE':.., 'EDATE':.., 'FERTILIZERS':..}.
+        :param axes: {name: [value, ...]}. A value is a str of the column name, or a dict of several columns,
+            e.g. {'PDATE': ['06113', '06123'], 'cultivar': [{'ingeno': '990001', 'cname': 'A'}, ...]}.
+            If PDATE is swept without EDATE, EDATE is -99 and simulated by the model.
+            Cultivars should already be in the .CUL file, GLUE isn't run for a sweep.
+        :param crop_type: The crop type.
+        :param prefix: 2 letters of .X file names, which are prefix + 2 letters + YY + 2 digits.
+        :param max_treatments: The number of scenarios in a .X file at most.
+        """
+        self.base = dict(base)
+        self.axes = OrderedDict(axes)
+        self.crop_type = crop_type
+        self.prefix = prefix
+        self.max_treatments = min(max_treatments, MAX_TREATMENTS)
+        self._writer = SweepWriter()
+
+    def __len__(self):
+        size = 1
+        for values in self.axes.values():
+            size *= len(values)
+        return size
+
+    def scenarios(self):
+        """
+        :return: A generator of (scenario number from 1, {column: value}) over the product of axes.
+        """
+        for number, values in enumerate(itertools.product(*self.axes.values()), 1):
+            scenario, swept = dict(self.base), set()
+            for name, value in zip(self.axes, values):
+                value = value if isinstance(value, dict) else {name: value}
+                scenario.update(value)
+                swept.update(value)
+            if 'PDATE' in swept and 'EDATE' not in swept:
+                scenario['EDATE'] = '-99'
+            yield number, scenario
+
+    def _packs(self):
+        """
+        :return: A generator of (file name, [(scenario number, scenario), ...]).
+            Scenarios of different years (the first 2 digits of PDATE) are never in the same file.
+        """
+        packs, counts = OrderedDict(), {}
+        for number, scenario in self.scenarios():
+            year = scenario['PDATE'][:2]
+            pack = packs.setdefault(year, [])
+            pack.append((number, scenario))
+            if len(pack) == self.max_treatments:
+                yield self._file_name(year, counts), pack
+                packs[year] = []
+        for year, pack in packs.items():
+            if pack:
+                yield self._file_name(year, counts), pack
+
+    def _file_name(self, year, counts):
+        count = counts.get(year, 0)
+        counts[year] = count + 1
+        if count >= 26 * 26 * 100:
+            raise ValueError('Too many .X files for year %s, use another prefix for a part of the sweep' % year)
+        return '%s%s%s%s%02d' % (self.prefix, _LETTERS[count // 2600], _LETTERS[count // 100 % 26], year, count % 100)
+
+    def write(self, out_path):
+        """
+        Render the .X files of the sweep.
+        :param out_path: The directory to write .X files in.
+        :return: The paths of .X files, and the index of scenarios
+            [{'scenario':.., 'crop_type':.., 'file_name':.., 'TRNO':.., axis columns...}, ...]
+        """
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+        x_files, index = [], []
+        for file_name, pack in self._packs():
+            path = os.path.join(out_path, file_name + self._writer.suffixes[self.crop_type])
+            with open(path, 'w', encoding='utf-8') as fp:
+                fp.write(self._writer.render(self.crop_type, file_name, pack))
+            x_files.append(path)
+            for trtno, (number, scenario) in enumerate(pack, 1):
+                row = {'scenario': number, 'crop_type': self.crop_type, 'file_name': file_name, 'TRNO': trtno}
+                row.update((k, v) for k, v in scenario.items() if k not in row)
+                index.append(row)
+        return x_files, index
+
+    def run(self, out_crop_path, result_output, run_path_absolute=None, simulation_model='B',
+            workers=None, batch_size=10, name='Summary.OUT', **kwargs):
+        """
+        Write the .X files of the sweep, run them with scheduler.run_parallel, and collect name of every run.
+        :param out_crop_path: The directory to write .X files in.
+        :param result_output: The directory to keep evaluated outputs.
+        :param run_path_absolute: The absolute path to Dssat installed directory, None means the one of backend.
+        :param simulation_model: The same as DSSAT.run.
+        :param workers: The number of worker processes, None means the number of CPUs.
+        :param batch_size: The number of .X files run by a single DSSAT model process.
+        :param name: The .OUT file to collect.
+        :param kwargs: More keyword params of scheduler.run_parallel, such as cache, recorder and backend.
+        :return: DataFrame indexed by scenario, with the axis columns and the columns of name.
+        """
+        import pandas as pd
+        from outputs import read_results
+        from scheduler import run_parallel
+
+        x_files, index = self.write(out_crop_path)
+        run_parallel(x_files, result_output, None, run_path_absolute, simulation_model=simulation_model,
+                     workers=workers, batch_size=batch_size, **kwargs)
+        index = pd.DataFrame(index)
+        results = read_results(result_output, name, workers)
+        keys = ['crop_type', 'file_name', 'TRNO']
+        if results.empty:
+            return index.set_index('scenario')
+        results = results[results['file_name'].isin(index['file_name'].unique())]
+        return index.merge(results, on=keys, how='left', suffixes=('', '_out')).set_index('scenario')
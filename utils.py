@@ -1,277 +1,540 @@
-import pandas as pd
-import json
-import numpy as np
-import os
-import datetime
-
-
-def create_input_files(in_path, out_path):
-    """
-    Create an reorganized json file of original input data.
-    The json file is the summary of data.
-        xfile_dict will be a form of
-            {crop_types:{file_names:{cultivar:N,cname:NAME,ingenos:ING,treatments:TRM,soil:...}}}
-    :param in_path: The path of summary input data.
-    :param out_path: The path of reorganized input data.
-    :return:None
-    """
-    # The dict to preserve the reorganized data in the particular form as described in COMMENT
-    xfile_dict = {}
-    df = pd.read_excel(in_path, header=0, dtype=np.str)
-
-    # Create the basic form of xfile_dict：{crop_types:{file_names:{{ingeno:IDX},{weather:IDX},{soil:IDX}}}}
-    # ingeno will be used to search for cultivar_index
-    for c in np.unique(df['crop_type']):
-        xfile_dict.update({c: {}})
-        for f in np.unique(df[df['crop_type'] == c]['file_name']):
-            xfile_dict[c].update({f: {}})
-
-            # There are two mean parts in xfile_dict[c][f]:
-            #   (1)marked INDIES' LEVEL for the whole file
-            #   (2)create a array named 'details' to hold each treatment
-            xfile_dict[c][f].update({'details': []})
-
-            df_c = df[df['crop_type'] == c]
-            df_c_f = df_c[df_c['file_name'] == f]
-
-            # (2).1 mark CU index with ingeno:
-            xfile_dict[c][f].update({'culitvar': {}})
-            xfile_dict[c][f].update({'ing-cname': {}})
-            for i, ing in enumerate(np.unique(df_c_f['ingeno'])):
-                xfile_dict[c][f]['culitvar'].update({ing: i + 1})
-                xfile_dict[c][f]['ing-cname'].update(
-                    {ing: str(np.unique((df_c_f[df_c_f['ingeno'] == ing])['cname'])[0])})
-
-            # (2).2 FL index associates with weather and soil date which normally unchange in experiment,
-            # which means we don't need to mark FL index.
-
-            # (2).3 ML index associates with fertilizer:
-            xfile_dict[c][f].update({'fertilizer': {}})
-            for i, ft in enumerate(np.unique(df_c_f['FERTILIZERS'])):
-                xfile_dict[c][f]['fertilizer'].update({ft: i + 1})
-
-    # Fill the xfile_dict with detail
-    for i in range(len(df)):
-        df_line = df.iloc[i, :]
-        crop = df_line['crop_type']
-        fname = df_line['file_name']
-        xfile_dict[crop][fname]['details'].append({'ingeno': df_line['ingeno'],
-                                                   # 'cname': df_line['cname'],
-                                                   'weather': df_line['weather'],
-                                                   'soil': df_line['soil'],
-                                                   'PDATE': df_line['PDATE'],
-                                                   'EDATE': df_line['EDATE'],
-                                                   'FERTILIZERS': df_line['FERTILIZERS']})
-    # print(xfile_dict)
-
-    with open(os.path.join(out_path, 'xfile.json'), 'w', encoding='utf-8') as j:
-        json.dump(xfile_dict, j)
-
-
-def _create_xfile(out_path, crop_type, file_name, file_dict):
-    """
-    Create a single xfiles by given particular crop type and file name.
-    :param out_path: The directory path to .X file.
-    :param crop_type: The crop type.
-    :param file_name: File name associate with json file and output .X file.
-    :param file_dict: This part is from xfile_dict[c][f].
-    :return:
-    """
-    details_array = file_dict['details']
-    suffixes = {'maize': '.MZX', 'rice': '.RIX'}
-    abbreviation = {'maize': 'MZ', 'rice': 'RI'}
-
-    # simply consider those params are unchanged
-    pdate = details_array[0]['PDATE']
-    edate = details_array[0]['EDATE']
-    weather = details_array[0]['weather']
-    soil = details_array[0]['soil']
-
-    # get STATION param and YEAR param by fname
-    year = ''.join(list(filter(str.isnumeric, file_name))[:2])
-    now = datetime.datetime.now().year.__str__()[-2:]
-    if int(now) >= int(year):
-        year = '20' + year
-    else:
-        year = '19' + year
-    station = ''.join(list(filter(str.isalpha, file_name)))
-
-    # use the part of xfile_dict[c][f]'s marked INDIES' LEVEL to fill the lines in xfile
-    treatments = ''
-    for i, d in enumerate(details_array):
-        treatments += '{number:2d} 1 1 0 {cname:<26}{cultivar:2}  1  0  1  1  1{ml:>3}  1  0  0  0  0  1\n'.format(
-            number=i + 1, cname=file_dict['ing-cname'][d['ingeno']], cultivar=file_dict['culitvar'][d['ingeno']],
-            ml=file_dict['fertilizer'][d['FERTILIZERS']]
-        )
-        cultivars = ''
-        for ing, idx in file_dict['culitvar'].items():
-            cultivars += '{cultivar:2d} {abbreviation} {ingeno} {cname}\n'.format(
-                cultivar=idx, abbreviation=abbreviation[crop_type], ingeno=ing, cname=file_dict['ing-cname'][ing]
-            )
-        fertilizer = ''
-        for fts, idx in file_dict['fertilizer'].items():
-            for ft in fts.split(';'):
-                fertilizer += '{0:2d} {1:5}{2:>6}{3:>6}{4:>6}{5:>6}{6:>6}{7:>6}   -99   -99   -99 -99\n'.format(
-                    int(idx), *(ft.strip().split(' '))
-                )
-
-        base_file = '''
-*EXP.DETAILS: {file_name}{abbreviation} {station}{year}
-
-*GENERAL
-@PEOPLE
--99
-@ADDRESS
--99
-@SITE
--99
-
-*TREATMENTS                        -------------FACTOR LEVELS------------
-@N R O C TNAME.................... CU FL SA IC MP MI MF MR MC MT ME MH SM
-{treatments}
-
-*CULTIVARS
-@C CR INGENO CNAME
-{cultivars}
-
-*FIELDS
-@L ID_FIELD WSTA....  FLSA  FLOB  FLDT  FLDD  FLDS  FLST SLTX  SLDP  ID_SOIL    FLNAME
- 1 {station}0001 {weather:<8}   -99   -99   -99   -99   -99   -99 -99    -99  {soil:<10} -99                       
-@L ...........XCRD ...........YCRD .....ELEV .............AREA .SLEN .FLWR .SLAS FLHST FHDUR
- 1             -99             -99       -99               -99   -99   -99   -99   -99   -99
-
-*SOIL ANALYSIS
-@A SADAT  SMHB  SMPX  SMKE  SANAME
- 1 {PDATE:5}   -99   -99   -99  -99                     
-@A  SABL  SADM  SAOC  SANI SAPHW SAPHB  SAPX  SAKE  SASC
- 1    15   -99   -99   -99   -99   -99   -99   -99   -99
-
-*INITIAL CONDITIONS
-@C   PCR ICDAT  ICRT  ICND  ICRN  ICRE  ICWD ICRES ICREN ICREP ICRIP ICRID ICNAME              ！2006写06***,2007年写07***，其中***表示播种日期的日序数-1
- 1    {abbreviation} {PDATE_minus_1:05d}   -99   -99     1     1   -99   -99   -99   -99   -99   -99 -99
-@C  ICBL  SH2O  SNH4  SNO3
- 1    25  .394    .4   3.4
- 1    55  .428    .4   3.4
-
-*PLANTING DETAILS
-@P PDATE EDATE  PPOP  PPOE  PLME  PLDS  PLRS  PLRD  PLDP  PLWT  PAGE  PENV  PLPH  SPRL                        PLNAME     
- 1 {PDATE:5} {EDATE:>5}     5     4     S     R    60     0     5   -99   -99   -99   -99   -99                        -99
-
-
-*IRRIGATION AND WATER MANAGEMENT
-@I  EFIR  IDEP  ITHR  IEPT  IOFF  IAME  IAMT IRNAME
- 1     1    30    50   100 GS000 IR001    10 -99
-@I IDATE  IROP IRVAL
- 1 {PDATE:5} IR001   -99
-
-*FERTILIZERS (INORGANIC)
-@F FDATE  FMCD  FACD  FDEP  FAMN  FAMP  FAMK  FAMC  FAMO  FOCD FERNAME
-{fertilizer}
-
-*RESIDUES AND ORGANIC FERTILIZER
-@R RDATE  RCOD  RAMT  RESN  RESP  RESK  RINP  RDEP  RMET RENAME
- 1 {PDATE:5}   -99   -99   -99   -99   -99   -99   -99   -99 -99
-
-*CHEMICAL APPLICATIONS
-@C CDATE CHCOD CHAMT  CHME CHDEP   CHT..CHNAME
- 1 {PDATE:5}   -99   -99   -99   -99   -99  -99
-
-*TILLAGE AND ROTATIONS
-@T TDATE TIMPL  TDEP TNAME
- 1 {PDATE:5}   -99   -99 -99
-
-*ENVIRONMENT MODIFICATIONS
-@E ODATE EDAY  ERAD  EMAX  EMIN  ERAIN ECO2  EDEW  EWIND ENVNAME
- 1 {PDATE:5} A   0 A   0 A   0 A   0 A 0.0 A   0 A   0 A   0
-
-*HARVEST DETAILS
-@H HDATE  HSTG  HCOM HSIZE   HPC  HBPC HNAME
- 1 {PDATE:5} GS000   -99   -99   -99   -99 Maize
-
-*SIMULATION CONTROLS
-@N GENERAL     NYERS NREPS START SDATE RSEED SNAME.................... SMODEL
- 1 GE              1     1     S {PDATE:5}  2150 DEFAULT SIMULATION CONTR  MZCER
-@N OPTIONS     WATER NITRO SYMBI PHOSP POTAS DISES  CHEM  TILL   CO2
- 1 OP              Y     Y     N     N     N     N     N     N     M
-@N METHODS     WTHER INCON LIGHT EVAPO INFIL PHOTO HYDRO NSWIT MESOM MESEV MESOL
- 1 ME              M     M     E     R     S     C     R     1     G     S     2
-@N MANAGEMENT  PLANT IRRIG FERTI RESID HARVS
- 1 MA              R     N     R     N     M
-@N OUTPUTS     FNAME OVVEW SUMRY FROPT GROUT CAOUT WAOUT NIOUT MIOUT DIOUT VBOSE CHOUT OPOUT FMOPT
- 1 OU              N     Y     Y     1     Y     N     N     N     N     N     D     N     Y     A
-
-@  AUTOMATIC MANAGEMENT
-@N PLANTING    PFRST PLAST PH2OL PH2OU PH2OD PSTMX PSTMN
- 1 PL          {PDATE:5} {PDATE:5}    40   100    30    40    10
-@N IRRIGATION  IMDEP ITHRL ITHRU IROFF IMETH IRAMT IREFF
- 1 IR             30    50   100 GS000 IR001    10     1
-@N NITROGEN    NMDEP NMTHR NAMNT NCODE NAOFF
- 1 NI             30    50    25 FE001 GS000
-@N RESIDUES    RIPCN RTIME RIDEP
- 1 RE            100     1    20
-@N HARVEST     HFRST HLAST HPCNP HPCNR
- 1 HA              0 {PDATE:5}   100     0
-
-
-                                     
-    '''.format(file_name=file_name, abbreviation=abbreviation[crop_type], treatments=treatments,
-               cultivars=cultivars, weather=weather, soil=soil, station=station, year=year,
-               PDATE=pdate, PDATE_minus_1=int(pdate) - 1, EDATE=edate, fertilizer=fertilizer)
-        with open(os.path.join(out_path, file_name + suffixes[crop_type]), 'w', encoding='utf-8') as fp:
-            fp.write(base_file)
-
-
-def create_xfile(in_file, out_path, crop_type=None, file_name=None):
-    """
-    Create xfiles in a pointed strategy.
-    :param in_file: The json file cotain summary data.
-    :param out_path: The directory path to .X file.
-    :param crop_type:
-        None: Create every crop_type from in_file;
-        str: Create particular crop_type from in_file.
-    :param file_name:
-        None: Create every file from in_file;
-        list: Create particular file which is in list from in_file
-        str: Create particular file from in_file.
-    :return:
-        1: Unexpected type of file_name
-        2: Unexpected type of file_dict
-    """
-    if not os.path.exists(out_path):
-        os.mkdir(out_path)
-    with open(in_file, 'r', encoding='utf-8') as j:
-        xfile_dict = json.load(j)
-    if crop_type is None:
-        for c, cdict in xfile_dict.items():
-            if file_name is None:
-                for fname, fdict in cdict.items():
-                    _create_xfile(out_path, c, fname, fdict)
-            elif isinstance(file_name, list):
-                for fname in file_name:
-                    _create_xfile(out_path, c, fname, cdict[fname])
-            elif isinstance(file_name, str):
-                _create_xfile(out_path, c, file_name, cdict[file_name])
-            else:
-                print('Unrecognized type of FILE_NAME:%s' % type(file_name))
-                return 2
-    elif isinstance(crop_type, str):
-        c, cdict = crop_type, xfile_dict[crop_type]
-        if file_name is None:
-            for fname, fdict in cdict.items():
-                _create_xfile(out_path, c, fname, fdict)
-        elif isinstance(file_name, list):
-            for fname in file_name:
-                _create_xfile(out_path, c, fname, cdict[fname])
-        elif isinstance(file_name, str):
-            _create_xfile(out_path, c, file_name, cdict[file_name])
-        else:
-            print('Unexpected type of FILE_NAME:%s' % type(file_name))
-            return 2
-    else:
-        print('Unexpected type of CROP_TYPE:%s' % type(crop_type))
-        return 1
-
-
-if __name__ == '__main__':
-    # create_input_files('test.xlsx', '.')
-    create_xfile('xfile.json', './output', crop_type='maize', file_name='AUAR0601')
+import hashlib
+import json
+import os
+import datetime
+import string
+
+from model import PICKLE_SUFFIX, Experiment, dump_summary, from_xfile_dict, load_summary
+
+
+# The columns of input summary file kept in the 'details' of each treatment
+DETAIL_COLUMNS = ['ingeno', 'weather', 'soil', 'PDATE', 'EDATE', 'FERTILIZERS']
+# {.X file name: [fingerprint, st_size, st_mtime_ns]} of the files created incrementally in a directory
+FINGERPRINTS = '.xfile_fingerprints.json'
+
+
+def create_input_files(in_path, out_path):
+    """
+    Create an reorganized json file of original input data.
+    The json file is the summary of data.
+        xfile_dict will be a form of
+            {crop_types:{file_names:{cultivar:N,cname:NAME,ingenos:ING,treatments:TRM,soil:...}}}
+    :param in_path: The path of summary input data, .xlsx or the equivalent .csv/.parquet.
+    The same summary is validated and kept as xfile.pickle of model.Experiment, which loads much faster.
+    :param out_path: The path of reorganized input data.
+    :return:None
+    """
+    xfile_dict = _create_xfile_dict(_read_sheet(in_path))
+    experiments = from_xfile_dict(xfile_dict)
+
+    with open(os.path.join(out_path, 'xfile.json'), 'w', encoding='utf-8') as j:
+        json.dump(xfile_dict, j)
+    dump_summary(experiments, os.path.join(out_path, 'xfile' + PICKLE_SUFFIX))
+
+
+def _read_sheet(in_path):
+    """
+    Read the whole summary input data with every column as str.
+    """
+    import pandas as pd
+    suffix = os.path.splitext(in_path)[-1].lower()
+    if suffix == '.csv':
+        return pd.read_csv(in_path, dtype=str)
+    if suffix == '.parquet':
+        return pd.read_parquet(in_path).astype(str)
+    return pd.read_excel(in_path, header=0, dtype=str)
+
+
+def _iter_sheet(in_path, chunksize=10000):
+    """
+    Read the summary input data row by row, only chunksize rows are kept in memory at once.
+    :param in_path: The path of summary input data, .xlsx or the equivalent .csv/.parquet.
+    :param chunksize: The number of rows read at once.
+    :return: A generator of rows as {column: str}
+    """
+    def _cell(value):
+        # Keep the same str as pd.read_excel(dtype=str), e.g. 6123.0 -> '6123'
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return value if value is None else str(value)
+
+    suffix = os.path.splitext(in_path)[-1].lower()
+    if suffix == '.csv':
+        import pandas as pd
+        for chunk in pd.read_csv(in_path, dtype=str, chunksize=chunksize):
+            for row in chunk.to_dict('records'):
+                yield row
+    elif suffix == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(in_path).iter_batches(batch_size=chunksize):
+            for row in batch.to_pylist():
+                yield {k: _cell(v) for k, v in row.items()}
+    else:
+        import openpyxl
+        wb = openpyxl.load_workbook(in_path, read_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = [str(h) for h in next(rows)]
+            for row in rows:
+                yield {h: _cell(v) for h, v in zip(header, row)}
+        finally:
+            wb.close()
+
+
+def _create_xfile_dict(df):
+    """
+    Reorganize the summary DataFrame into xfile_dict with a single groupby pass.
+    :param df: The DataFrame of summary input data.
+    :return: xfile_dict
+    """
+    # The dict to preserve the reorganized data in the particular form as described in COMMENT
+    xfile_dict = {}
+
+    # Extract the columns once, then every group only picks its rows by position
+    details = df[DETAIL_COLUMNS].to_dict('records')
+    cnames = df['cname'].tolist()
+    groups = df.groupby(['crop_type', 'file_name'], sort=True).indices
+    for c, f in sorted(groups):
+        rows = groups[(c, f)]
+        xfile_dict.setdefault(c, {})[f] = _file_dict([details[i] for i in rows], [cnames[i] for i in rows])
+    return xfile_dict
+
+
+def _file_dict(details, cnames):
+    """
+    Create xfile_dict[c][f] of a single file.
+    :param details: The 'details' of each treatment in the order of input data.
+    :param cnames: The cname of each treatment.
+    :return: {'details':[...], 'culitvar':{ingeno:CU}, 'ing-cname':{ingeno:cname}, 'fertilizer':{FERTILIZERS:ML}}
+    """
+    # There are two mean parts in xfile_dict[c][f]:
+    #   (1)marked INDIES' LEVEL for the whole file
+    #   (2)create a array named 'details' to hold each treatment
+    ing_cnames = {}
+    for d, cname in zip(details, cnames):
+        ing_cnames.setdefault(d['ingeno'], set()).add(cname)
+
+    # (2).1 mark CU index with ingeno, the first cname in order is chosen for each ingeno:
+    culitvar = {ing: i + 1 for i, ing in enumerate(sorted(ing_cnames))}
+    ing_cname = {ing: str(min(ing_cnames[ing])) for ing in culitvar}
+
+    # (2).2 FL index associates with weather and soil date which normally unchange in experiment,
+    # which means we don't need to mark FL index.
+
+    # (2).3 ML index associates with fertilizer:
+    fertilizer = {ft: i + 1 for i, ft in enumerate(sorted(set(d['FERTILIZERS'] for d in details)))}
+    return {'details': details, 'culitvar': culitvar, 'ing-cname': ing_cname, 'fertilizer': fertilizer}
+
+
+XFILE_TEMPLATE = '''
+*EXP.DETAILS: {file_name}{abbreviation} {station}{year}
+
+*GENERAL
+@PEOPLE
+-99
+@ADDRESS
+-99
+@SITE
+-99
+
+*TREATMENTS                        -------------FACTOR LEVELS------------
+@N R O C TNAME.................... CU FL SA IC MP MI MF MR MC MT ME MH SM
+{treatments}
+
+*CULTIVARS
+@C CR INGENO CNAME
+{cultivars}
+
+*FIELDS
+@L ID_FIELD WSTA....  FLSA  FLOB  FLDT  FLDD  FLDS  FLST SLTX  SLDP  ID_SOIL    FLNAME
+ 1 {station}0001 {weather:<8}   -99   -99   -99   -99   -99   -99 -99    -99  {soil:<10} -99                       
+@L ...........XCRD ...........YCRD .....ELEV .............AREA .SLEN .FLWR .SLAS FLHST FHDUR
+ 1             -99             -99       -99               -99   -99   -99   -99   -99   -99
+
+*SOIL ANALYSIS
+@A SADAT  SMHB  SMPX  SMKE  SANAME
+ 1 {PDATE:5}   -99   -99   -99  -99                     
+@A  SABL  SADM  SAOC  SANI SAPHW SAPHB  SAPX  SAKE  SASC
+ 1    15   -99   -99   -99   -99   -99   -99   -99   -99
+
+*INITIAL CONDITIONS
+@C   PCR ICDAT  ICRT  ICND  ICRN  ICRE  ICWD ICRES ICREN ICREP ICRIP ICRID ICNAME              ！2006写06***,2007年写07***，其中***表示播种日期的日序数-1
+ 1    {abbreviation} {PDATE_minus_1:05d}   -99   -99     1     1   -99   -99   -99   -99   -99   -99 -99
+@C  ICBL  SH2O  SNH4  SNO3
+ 1    25  .394    .4   3.4
+ 1    55  .428    .4   3.4
+
+*PLANTING DETAILS
+@P PDATE EDATE  PPOP  PPOE  PLME  PLDS  PLRS  PLRD  PLDP  PLWT  PAGE  PENV  PLPH  SPRL                        PLNAME     
+ 1 {PDATE:5} {EDATE:>5}     5     4     S     R    60     0     5   -99   -99   -99   -99   -99                        -99
+
+
+*IRRIGATION AND WATER MANAGEMENT
+@I  EFIR  IDEP  ITHR  IEPT  IOFF  IAME  IAMT IRNAME
+ 1     1    30    50   100 GS000 IR001    10 -99
+@I IDATE  IROP IRVAL
+ 1 {PDATE:5} IR001   -99
+
+*FERTILIZERS (INORGANIC)
+@F FDATE  FMCD  FACD  FDEP  FAMN  FAMP  FAMK  FAMC  FAMO  FOCD FERNAME
+{fertilizer}
+
+*RESIDUES AND ORGANIC FERTILIZER
+@R RDATE  RCOD  RAMT  RESN  RESP  RESK  RINP  RDEP  RMET RENAME
+ 1 {PDATE:5}   -99   -99   -99   -99   -99   -99   -99   -99 -99
+
+*CHEMICAL APPLICATIONS
+@C CDATE CHCOD CHAMT  CHME CHDEP   CHT..CHNAME
+ 1 {PDATE:5}   -99   -99   -99   -99   -99  -99
+
+*TILLAGE AND ROTATIONS
+@T TDATE TIMPL  TDEP TNAME
+ 1 {PDATE:5}   -99   -99 -99
+
+*ENVIRONMENT MODIFICATIONS
+@E ODATE EDAY  ERAD  EMAX  EMIN  ERAIN ECO2  EDEW  EWIND ENVNAME
+ 1 {PDATE:5} A   0 A   0 A   0 A   0 A 0.0 A   0 A   0 A   0
+
+*HARVEST DETAILS
+@H HDATE  HSTG  HCOM HSIZE   HPC  HBPC HNAME
+ 1 {PDATE:5} GS000   -99   -99   -99   -99 Maize
+
+*SIMULATION CONTROLS
+@N GENERAL     NYERS NREPS START SDATE RSEED SNAME.................... SMODEL
+ 1 GE              1     1     S {PDATE:5}  2150 DEFAULT SIMULATION CONTR  MZCER
+@N OPTIONS     WATER NITRO SYMBI PHOSP POTAS DISES  CHEM  TILL   CO2
+ 1 OP              Y     Y     N     N     N     N     N     N     M
+@N METHODS     WTHER INCON LIGHT EVAPO INFIL PHOTO HYDRO NSWIT MESOM MESEV MESOL
+ 1 ME              M     M     E     R     S     C     R     1     G     S     2
+@N MANAGEMENT  PLANT IRRIG FERTI RESID HARVS
+ 1 MA              R     N     R     N     M
+@N OUTPUTS     FNAME OVVEW SUMRY FROPT GROUT CAOUT WAOUT NIOUT MIOUT DIOUT VBOSE CHOUT OPOUT FMOPT
+ 1 OU              N     Y     Y     1     Y     N     N     N     N     N     D     N     Y     A
+
+@  AUTOMATIC MANAGEMENT
+@N PLANTING    PFRST PLAST PH2OL PH2OU PH2OD PSTMX PSTMN
+ 1 PL          {PDATE:5} {PDATE:5}    40   100    30    40    10
+@N IRRIGATION  IMDEP ITHRL ITHRU IROFF IMETH IRAMT IREFF
+ 1 IR             30    50   100 GS000 IR001    10     1
+@N NITROGEN    NMDEP NMTHR NAMNT NCODE NAOFF
+ 1 NI             30    50    25 FE001 GS000
+@N RESIDUES    RIPCN RTIME RIDEP
+ 1 RE            100     1    20
+@N HARVEST     HFRST HLAST HPCNP HPCNR
+ 1 HA              0 {PDATE:5}   100     0
+
+
+                                     
+    '''
+
+
+class XFileWriter(object):
+    """
+    Render .X files with a template which is parsed only once, every section is built once for each file.
+    """
+    suffixes = {'maize': '.MZX', 'rice': '.RIX'}
+    abbreviation = {'maize': 'MZ', 'rice': 'RI'}
+
+    def __init__(self, template=XFILE_TEMPLATE):
+        # The template is compiled to [(literal_text, field_name, format_spec), ...]
+        self._parts = [(literal, field, spec) for literal, field, spec, _ in string.Formatter().parse(template)]
+        self._digest = hashlib.sha256(template.encode('utf-8')).hexdigest()
+
+    def render(self, crop_type, file_name, file_dict):
+        """
+        :param crop_type: The crop type.
+        :param file_name: File name associate with json file and output .X file.
+        :param file_dict: This part is from xfile_dict[c][f], or the model.Experiment of it.
+        :return: The text of .X file.
+        """
+        experiment = self._experiment(crop_type, file_name, file_dict)
+        abbreviation = self.abbreviation[crop_type]
+
+        # simply consider those params are unchanged
+        first = experiment.treatments[0]
+
+        # get STATION param and YEAR param by fname
+        station, year = self._station_year(file_name)
+
+        # every treatment refers to its cultivar and fertilizer level, which hold their INDIES' LEVEL
+        treatments = ''.join(
+            '{number:2d} 1 1 0 {cname:<26}{cultivar:2}  1  0  1  1  1{ml:>3}  1  0  0  0  0  1\n'.format(
+                number=i + 1, cname=t.cultivar.cname, cultivar=t.cultivar.number, ml=t.fertilizer.number)
+            for i, t in enumerate(experiment.treatments))
+        cultivars = ''.join(
+            '{cultivar:2d} {abbreviation} {ingeno} {cname}\n'.format(
+                cultivar=cu.number, abbreviation=abbreviation, ingeno=cu.ingeno, cname=cu.cname)
+            for cu in experiment.cultivars)
+        fertilizer = ''.join(
+            '{0:2d} {1:5}{2:>6}{3:>6}{4:>6}{5:>6}{6:>6}{7:>6}   -99   -99   -99 -99\n'.format(ft.number, *application)
+            for ft in experiment.fertilizers for application in ft.applications)
+
+        fields = {'file_name': file_name, 'abbreviation': abbreviation, 'treatments': treatments,
+                  'cultivars': cultivars, 'weather': first.weather, 'soil': first.soil,
+                  'station': station, 'year': year, 'PDATE': first.PDATE, 'PDATE_minus_1': int(first.PDATE) - 1,
+                  'EDATE': first.EDATE, 'fertilizer': fertilizer}
+        return self._fill(fields)
+
+    @staticmethod
+    def _experiment(crop_type, file_name, file_dict):
+        """
+        :return: The validated model.Experiment of file_dict.
+        """
+        if isinstance(file_dict, Experiment):
+            return file_dict
+        return Experiment.from_dict(crop_type, file_name, file_dict)
+
+    @staticmethod
+    def _station_year(file_name):
+        """
+        :return: STATION (the letters of file_name) and 4 digits YEAR (from the first 2 digits of file_name).
+        """
+        year = ''.join(list(filter(str.isnumeric, file_name))[:2])
+        now = datetime.datetime.now().year.__str__()[-2:]
+        if int(now) >= int(year):
+            year = '20' + year
+        else:
+            year = '19' + year
+        return ''.join(list(filter(str.isalpha, file_name))), year
+
+    def _fill(self, fields):
+        """
+        :return: The compiled template filled with fields.
+        """
+        text = []
+        for literal, field, spec in self._parts:
+            text.append(literal)
+            if field is not None:
+                text.append(format(fields[field], spec))
+        return ''.join(text)
+
+    def write(self, out_path, crop_type, file_name, file_dict):
+        """
+        Render a single .X file and write it with one buffered write.
+        :param out_path: The directory path to .X file.
+        :return: The path of .X file.
+        """
+        path = os.path.join(out_path, file_name + self.suffixes[crop_type])
+        with open(path, 'w', encoding='utf-8') as fp:
+            fp.write(self.render(crop_type, file_name, file_dict))
+        return path
+
+    def fingerprint(self, crop_type, file_name, file_dict):
+        """
+        :return: The hash of everything rendered into .X file: the template, the current year and file_dict.
+        """
+        # The same hash whether file_dict is loaded from xfile.json or from xfile.pickle
+        file_dict = self._experiment(crop_type, file_name, file_dict).to_dict()
+        source = json.dumps([self._digest, datetime.datetime.now().year, crop_type, file_name, file_dict],
+                            sort_keys=True)
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def write_if_changed(self, out_path, crop_type, file_name, file_dict, fingerprints=None):
+        """
+        Write a single .X file only if its text changes, so that unchanged files keep their modified time.
+        :param fingerprints: Optional {.X file name: [fingerprint, st_size, st_mtime_ns]}. If the file is
+            the same as its record, it isn't even rendered. The record of the file is updated.
+        :return: True if .X file is written.
+        """
+        path = os.path.join(out_path, file_name + self.suffixes[crop_type])
+        fingerprint = None
+        if fingerprints is not None:
+            fingerprint = self.fingerprint(crop_type, file_name, file_dict)
+            known = fingerprints.get(os.path.basename(path))
+            if known is not None and os.path.exists(path):
+                stat = os.stat(path)
+                if known == [fingerprint, stat.st_size, stat.st_mtime_ns]:
+                    return False
+        # The same bytes as write, which opens the file in text mode
+        text = self.render(crop_type, file_name, file_dict).replace('\n', os.linesep).encode('utf-8')
+        written = True
+        if os.path.exists(path) and os.path.getsize(path) == len(text):
+            with open(path, 'rb') as fp:
+                written = fp.read() != text
+        if written:
+            with open(path, 'wb') as fp:
+                fp.write(text)
+        if fingerprints is not None:
+            stat = os.stat(path)
+            fingerprints[os.path.basename(path)] = [fingerprint, stat.st_size, stat.st_mtime_ns]
+        return written
+
+
+_XFILE_WRITER = XFileWriter()
+
+
+def _create_xfile(out_path, crop_type, file_name, file_dict):
+    """
+    Create a single xfiles by given particular crop type and file name.
+    :param out_path: The directory path to .X file.
+    :param crop_type: The crop type.
+    :param file_name: File name associate with json file and output .X file.
+    :param file_dict: This part is from xfile_dict[c][f].
+    :return:
+    """
+    _XFILE_WRITER.write(out_path, crop_type, file_name, file_dict)
+
+
+def _load_fingerprints(out_path):
+    path = os.path.join(out_path, FINGERPRINTS)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def _save_fingerprints(out_path, fingerprints):
+    tmp_path = os.path.join(out_path, FINGERPRINTS + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        json.dump(fingerprints, fp)
+    os.replace(tmp_path, os.path.join(out_path, FINGERPRINTS))
+
+
+def create_xfile(in_file, out_path, crop_type=None, file_name=None, incremental=False):
+    """
+    Create xfiles in a pointed strategy.
+    :param in_file: The json file cotain summary data, xfile.pickle next to it is loaded instead if it is fresh.
+    :param out_path: The directory path to .X file.
+    :param crop_type:
+        None: Create every crop_type from in_file;
+        str: Create particular crop_type from in_file.
+    :param file_name:
+        None: Create every file from in_file;
+        list: Create particular file which is in list from in_file
+        str: Create particular file from in_file.
+    :param incremental: Only write the files whose rows have changed, the others keep their modified time.
+    :return:
+        1: Unexpected type of file_name
+        2: Unexpected type of file_dict
+    """
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+    xfile_dict = load_summary(in_file)
+    if incremental:
+        return _create_incrementally(out_path, lambda create: _create_xfiles(
+            xfile_dict, out_path, crop_type, file_name, create))
+    return _create_xfiles(xfile_dict, out_path, crop_type, file_name)
+
+
+def _create_incrementally(out_path, func):
+    """
+    Call func with a function that creates a single .X file only if it has changed, then report the counts.
+    """
+    fingerprints = _load_fingerprints(out_path)
+    counts = [0, 0]
+
+    def _create(out_path, c, fname, fdict):
+        counts[0 if _XFILE_WRITER.write_if_changed(out_path, c, fname, fdict, fingerprints) else 1] += 1
+
+    try:
+        return func(_create)
+    finally:
+        _save_fingerprints(out_path, fingerprints)
+        print('Regenerated %d .X files, skipped %d unchanged .X files' % tuple(counts))
+
+
+def _create_xfiles(xfile_dict, out_path, crop_type=None, file_name=None, create=_create_xfile):
+    """
+    The loops of create_xfile over xfile_dict loaded from the json file.
+    :param create: The function to create a single .X file, called as _create_xfile.
+    """
+    if crop_type is None:
+        for c, cdict in xfile_dict.items():
+            if file_name is None:
+                for fname, fdict in cdict.items():
+                    create(out_path, c, fname, fdict)
+            elif isinstance(file_name, list):
+                for fname in file_name:
+                    create(out_path, c, fname, cdict[fname])
+            elif isinstance(file_name, str):
+                create(out_path, c, file_name, cdict[file_name])
+            else:
+                print('Unrecognized type of FILE_NAME:%s' % type(file_name))
+                return 2
+    elif isinstance(crop_type, str):
+        c, cdict = crop_type, xfile_dict[crop_type]
+        if file_name is None:
+            for fname, fdict in cdict.items():
+                create(out_path, c, fname, fdict)
+        elif isinstance(file_name, list):
+            for fname in file_name:
+                create(out_path, c, fname, cdict[fname])
+        elif isinstance(file_name, str):
+            create(out_path, c, file_name, cdict[file_name])
+        else:
+            print('Unexpected type of FILE_NAME:%s' % type(file_name))
+            return 2
+    else:
+        print('Unexpected type of CROP_TYPE:%s' % type(crop_type))
+        return 1
+
+
+def create_xfile_streaming(in_path, out_path, crop_type=None, file_name=None, json_file=None, chunksize=10000,
+                           incremental=False):
+    """
+    Create xfiles straight from summary input data without the whole xfile.json in memory.
+    Rows are read chunk by chunk, and each file is created as soon as its rows are finished,
+    so the rows of the same (crop_type, file_name) must be next to each other in in_path.
+    :param in_path: The path of summary input data, .xlsx or the equivalent .csv/.parquet.
+    :param out_path: The directory path to .X file.
+    :param crop_type: The same as create_xfile.
+    :param file_name: The same as create_xfile.
+    :param json_file: Optional path to keep the summary as json lines, one {crop_type, file_name, file} per line.
+    :param chunksize: The number of rows read at once.
+    :param incremental: The same as create_xfile.
+    :return:
+        1: Unexpected type of file_name
+        2: Unexpected type of file_dict
+    """
+    if incremental:
+        if not os.path.exists(out_path):
+            os.mkdir(out_path)
+        return _create_incrementally(out_path, lambda create: _create_xfile_streaming(
+            in_path, out_path, crop_type, file_name, json_file, chunksize, create))
+    return _create_xfile_streaming(in_path, out_path, crop_type, file_name, json_file, chunksize)
+
+
+def _create_xfile_streaming(in_path, out_path, crop_type, file_name, json_file, chunksize, create=_create_xfile):
+    if crop_type is not None and not isinstance(crop_type, str):
+        print('Unexpected type of CROP_TYPE:%s' % type(crop_type))
+        return 1
+    if file_name is not None and not isinstance(file_name, (list, str)):
+        print('Unexpected type of FILE_NAME:%s' % type(file_name))
+        return 2
+    file_names = [file_name] if isinstance(file_name, str) else file_name
+    if not os.path.exists(out_path):
+        os.mkdir(out_path)
+
+    json_fp = open(json_file, 'w', encoding='utf-8') if json_file is not None else None
+    finished = set()
+    key, details, cnames = None, [], []
+
+    def _flush():
+        if key is None or not details:
+            return
+        file_dict = _file_dict(details, cnames)
+        create(out_path, key[0], key[1], file_dict)
+        if json_fp is not None:
+            json_fp.write(json.dumps({'crop_type': key[0], 'file_name': key[1], 'file': file_dict}) + '\n')
+
+    try:
+        for row in _iter_sheet(in_path, chunksize):
+            row_key = (row['crop_type'], row['file_name'])
+            if row_key != key:
+                _flush()
+                if row_key in finished:
+                    raise ValueError('Rows of %s/%s are not next to each other in %s' % (row_key + (in_path,)))
+                finished.add(row_key)
+                key, details, cnames = row_key, [], []
+            if (crop_type is None or row_key[0] == crop_type) and (file_names is None or row_key[1] in file_names):
+                details.append({k: row[k] for k in DETAIL_COLUMNS})
+                cnames.append(row['cname'])
+        _flush()
+    finally:
+        if json_fp is not None:
+            json_fp.close()
+
+
+if __name__ == '__main__':
+    # create_input_files('test.xlsx', '.')
+    create_xfile('xfile.json', './output', crop_type='maize', file_name='AUAR0601')
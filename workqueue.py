@@ -0,0 +1,507 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+from backend import create_backend
+from cache import ResultCache, file_digest
+from compactor import Compactor
+from dssat import DSSAT, RE_SUFFIXES
+from genotype import ENCODINGS, GenotypeStore
+from instrument import Recorder
+from scheduler import _result_path
+
+# The states of a task, each of them is a directory of the queue which keeps a JSON file for every task in it
+STATES = ('tasks', 'leases', 'done', 'failed')
+# The settings of the campaign published, which is written after its tasks so that workers never see half of them
+CAMPAIGN = 'campaign.json'
+
+
+def _error(error):
+    if isinstance(error, BaseException):
+        return ''.join(traceback.format_exception_only(type(error), error)).strip()
+    return str(error)
+
+
+class WorkQueue(object):
+    def __init__(self, path, lease=300, max_attempts=3):
+        """
+        A queue of experiments kept as JSON files in a directory, which spreads a campaign over the nodes sharing it
+        by a shared filesystem (NFS, SMB, ...). A task is moved between the directories of STATES by renaming its
+        file, and a rename is atomic, so that a task is claimed by a single worker.
+        The file of a claimed task is its lease, which the worker touches as heartbeat. A lease without heartbeat for
+        lease seconds (the worker is killed, the node is down) is put back to tasks by any worker or the coordinator
+        finding it, until the task has been tried max_attempts times. So a task may run twice, but it is done once.
+        :param path: The queue directory, which is created if it doesn't exist.
+        :param lease: The seconds before a lease expires.
+        :param max_attempts: The number of times a task is tried before it fails.
+            lease and max_attempts are published with a campaign, workers use the ones of the campaign.
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for state in STATES:
+            if not os.path.exists(os.path.join(path, state)):
+                os.makedirs(os.path.join(path, state))
+
+    def _path(self, state, task_id):
+        return os.path.join(self.path, state, task_id + '.json')
+
+    def _ids(self, state):
+        """
+        :return: The ids of the tasks in state, temporary files start with '.'.
+        """
+        return sorted(fn[:-len('.json')] for fn in os.listdir(os.path.join(self.path, state))
+                      if fn.endswith('.json') and not fn.startswith('.'))
+
+    @staticmethod
+    def _read(path):
+        """
+        :return: The record of path, None if it has gone.
+        """
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write(path, record):
+        tmp_path = os.path.join(os.path.dirname(path), '.%s.%s-%d.tmp' % (
+            os.path.basename(path), socket.gethostname(), os.getpid()))
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            json.dump(record, fp)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def campaign(self):
+        """
+        :return: The settings of the campaign published, None if there is none.
+        """
+        return self._read(os.path.join(self.path, CAMPAIGN))
+
+    def close(self):
+        """
+        Mark the campaign closed once the coordinator has collected it, the workers waiting for a campaign don't
+        take it as theirs.
+        """
+        campaign = self.campaign()
+        if campaign is not None:
+            self._write(os.path.join(self.path, CAMPAIGN), dict(campaign, closed=True))
+
+    def publish(self, tasks, settings, resume=False):
+        """
+        Start a campaign. The tasks of the last campaign are dropped, except the ones done or leased with the same
+        digest when resuming.
+        :param tasks: [(task_id, x_file, digest), ...], task_id is the base name of x_file.
+        :param settings: The settings of the campaign shared by workers, see run_task.
+        :param resume: Keep the tasks done or leased with the same digest.
+        :return: The ids of the tasks put to the queue, the others are done or leased before.
+        """
+        self._remove(os.path.join(self.path, CAMPAIGN))
+        digests = {task_id: digest for task_id, _, digest in tasks}
+        kept = set()
+        for state in STATES:
+            for task_id in self._ids(state):
+                record = self._read(self._path(state, task_id)) if resume and state in ('leases', 'done') else None
+                if record is not None and digests.get(task_id) == record['digest']:
+                    kept.add(task_id)
+                else:
+                    self._remove(self._path(state, task_id))
+        put = []
+        for task_id, x_file, digest in tasks:
+            if task_id in kept:
+                continue
+            self._write(self._path('tasks', task_id), {'id': task_id, 'x_file': x_file, 'digest': digest,
+                                                       'attempts': 0, 'errors': [], 'worker': None})
+            put.append(task_id)
+        settings = dict(settings, lease=self.lease, max_attempts=self.max_attempts, published=time.time())
+        self._write(os.path.join(self.path, CAMPAIGN), settings)
+        return put
+
+    def claim(self, worker):
+        """
+        :param worker: The name of the worker, e.g. host:pid.
+        :return: The task leased to worker, None if no task is pending.
+        """
+        for task_id in self._ids('tasks'):
+            path = self._path('leases', task_id)
+            try:
+                # A rename keeps the time of the file, which is the heartbeat of a lease
+                os.utime(self._path('tasks', task_id))
+                os.rename(self._path('tasks', task_id), path)
+            except OSError:
+                # Claimed by another worker
+                continue
+            task = self._read(path)
+            task.update(worker=worker, claimed=time.time())
+            self._write(path, task)
+            return task
+        return None
+
+    def heartbeat(self, task, worker):
+        """
+        Keep the lease of task alive.
+        :return: False if the lease has expired and gone to another worker.
+        """
+        path = self._path('leases', task['id'])
+        lease = self._read(path)
+        if lease is None or lease['worker'] != worker:
+            return False
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _settle(self, task, worker, state, record):
+        """
+        Move the lease of task held by worker to state with record.
+        :return: False if the lease isn't held by worker anymore.
+        """
+        path = self._path('leases', task['id'])
+        settled = os.path.join(self.path, 'leases', '.%s.settled' % task['id'])
+        lease = self._read(path)
+        if lease is None or lease['worker'] != worker:
+            return False
+        # Moved aside before the task is written to state, where it may be claimed again at once
+        try:
+            os.rename(path, settled)
+        except FileNotFoundError:
+            return False
+        self._write(self._path(state, task['id']), record)
+        self._remove(settled)
+        return True
+
+    def complete(self, task, worker, result):
+        """
+        :param result: The result of run_task.
+        :return: False if the lease has gone to another worker, whose result is kept instead.
+        """
+        return self._settle(task, worker, 'done', dict(task, result=result, finished=time.time()))
+
+    def fail(self, task, worker, error):
+        """
+        Put task back to tasks, or to failed once it has been tried max_attempts times.
+        :param error: The exception or the message.
+        :return: False if the lease has gone to another worker.
+        """
+        record = dict(task, attempts=task['attempts'] + 1, errors=task['errors'] + [_error(error)], worker=None)
+        state = 'failed' if record['attempts'] >= self._max_attempts() else 'tasks'
+        return self._settle(task, worker, state, record)
+
+    def _max_attempts(self):
+        campaign = self.campaign()
+        return campaign['max_attempts'] if campaign is not None else self.max_attempts
+
+    def requeue_expired(self):
+        """
+        Put the tasks whose lease has expired back to tasks, or to failed once they have been tried max_attempts
+        times.
+        :return: The number of leases expired.
+        """
+        campaign = self.campaign()
+        lease = campaign['lease'] if campaign is not None else self.lease
+        expired = 0
+        for task_id in self._ids('leases'):
+            path = self._path('leases', task_id)
+            reaped = os.path.join(self.path, 'leases', '.%s.reaped' % task_id)
+            try:
+                if time.time() - os.path.getmtime(path) < lease:
+                    continue
+                # Only one of the processes finding the lease gets it
+                os.rename(path, reaped)
+            except OSError:
+                continue
+            task = self._read(reaped)
+            error = 'Lease of %s expired' % task['worker']
+            task.update(attempts=task['attempts'] + 1, errors=task['errors'] + [error], worker=None)
+            state = 'failed' if task['attempts'] >= self._max_attempts() else 'tasks'
+            self._write(self._path(state, task_id), task)
+            self._remove(reaped)
+            print('\n### %s: %s, put to %s' % (error, task_id, state))
+            expired += 1
+        return expired
+
+    def records(self, state):
+        """
+        :return: The records of the tasks in state.
+        """
+        records = [self._read(self._path(state, task_id)) for task_id in self._ids(state)]
+        return [record for record in records if record is not None]
+
+    def progress(self):
+        """
+        :return: {state: number of tasks} and 'workers': {worker: [lease, ...]}.
+        """
+        progress = {state: len(self._ids(state)) for state in STATES if state != 'leases'}
+        leases = self.records('leases')
+        progress['leases'] = len(leases)
+        progress['workers'] = {}
+        for lease in leases:
+            progress['workers'].setdefault(lease['worker'], []).append(lease)
+        return progress
+
+    def finished(self, progress=None):
+        """
+        :return: True if no task is pending or leased.
+        """
+        progress = progress or self.progress()
+        return self.campaign() is not None and not progress['tasks'] and not progress['leases']
+
+    def summary(self, progress=None):
+        progress = progress or self.progress()
+        total = sum(progress[state] for state in STATES)
+        return 'Queue %s: %d pending, %d leased, %d done, %d failed (%.1f%% of %d)' % (
+            self.path, progress['tasks'], progress['leases'], progress['done'], progress['failed'],
+            100.0 * (progress['done'] + progress['failed']) / total if total else 100.0, total)
+
+    def view(self, progress=None):
+        """
+        :return: The summary, and a line of every lease with its worker, time running, time since the last heartbeat
+            and attempt.
+        """
+        progress = progress or self.progress()
+        lines = [self.summary(progress)]
+        now = time.time()
+        for worker in sorted(progress['workers']):
+            for lease in progress['workers'][worker]:
+                try:
+                    beat = now - os.path.getmtime(self._path('leases', lease['id']))
+                except FileNotFoundError:
+                    continue
+                lines.append('  %-24s %-16s running %6.0fs, heartbeat %4.0fs ago, attempt %d' % (
+                    worker, lease['id'], now - lease['claimed'], beat, lease['attempts'] + 1))
+        return '\n'.join(lines)
+
+
+class _Heartbeat(object):
+    def __init__(self, queue, task, worker, interval):
+        """
+        Touch the lease of task every interval seconds in a thread while the task runs.
+        """
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, args=(queue, task, worker, interval))
+        self._thread.daemon = True
+
+    def _beat(self, queue, task, worker, interval):
+        while not self._stop.wait(interval):
+            if not queue.heartbeat(task, worker):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def _push(src, dst):
+    """
+    Copy the directory src to dst, which may be on another filesystem. The copy is renamed to dst at last,
+    so that dst is never half written.
+    """
+    tmp_path = '%s.%s-%d.tmp' % (dst, socket.gethostname(), os.getpid())
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(src, tmp_path)
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    os.rename(tmp_path, dst)
+
+
+def run_task(task, campaign, run_path_absolute=None, scratch_path=None, glue_workers=1, backend=None):
+    """
+    Run the .X file of task in a private workspace: GLUE, DSSAT model and compaction, then push the result
+    directory to the result_output of campaign.
+    GLUE calibrates a copy of .CUL file in the workspace, so that several workers can share a Dssat installed
+    directory, and the calibrated lines are returned to the coordinator.
+    :param task: The task claimed.
+    :param campaign: The settings of the campaign, which are result_output, gl_epochs, glue_flag, simulation_model,
+        compact ({'keep': [...], 'archive': ...} or None), cache (the params of ResultCache or None) and record
+        (whether to record the stages with a Recorder).
+    :param run_path_absolute: The absolute path to Dssat installed directory of the node.
+    :param scratch_path: The directory to create the workspace in, which is better on a local disk.
+        None means the temporary directory of the system.
+    :param glue_workers: The number of cultivars calibrated at once.
+    :param backend: The backend.Backend of the node.
+    :return: {'result': result directory, 'cultivars': {ingeno: .CUL line calibrated}, 'stats': the stats of cache,
+        'events': the events recorded}
+    """
+    x_file = task['x_file']
+    if file_digest(x_file) != task['digest']:
+        raise ValueError('%s has changed since the campaign was published' % x_file)
+    cache = ResultCache(**campaign['cache']) if campaign.get('cache') is not None else None
+    recorder = Recorder() if campaign.get('record') else None
+    workspace = tempfile.mkdtemp(prefix=os.path.splitext(task['id'])[0] + '_', dir=scratch_path)
+    try:
+        dssat = DSSAT(x_file, run_path_absolute, workspace=workspace, recorder=recorder, backend=backend)
+        cultivars = {}
+        if campaign['gl_epochs'] is not None:
+            dssat.run_glue(campaign['gl_epochs'], campaign['glue_flag'], glue_workers, sandbox=True)
+            cultivars = dssat.cultivar_lines()
+        dssat.create_DSSBatch()
+        dssat.run(os.path.join(workspace, 'result'), campaign['simulation_model'], cache)
+        run_path = _result_path(os.path.join(workspace, 'result'), x_file)
+        if campaign['compact'] is not None:
+            Compactor(**campaign['compact']).compact(run_path)
+        result = _result_path(campaign['result_output'], x_file)
+        if not os.path.exists(os.path.dirname(result)):
+            os.makedirs(os.path.dirname(result))
+        _push(run_path, result)
+        return {'result': result, 'cultivars': cultivars, 'stats': cache.stats if cache is not None else {},
+                'events': recorder.events if recorder is not None else []}
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def work(queue, run_path_absolute=None, scratch_path=None, glue_workers=1, backend=None, poll=5, worker=None):
+    """
+    The loop of a worker: claim a task, run it with heartbeats and report it, until no task of the campaign is
+    pending or leased, or the campaign is closed. A worker started before a campaign is published waits for it.
+    :param queue: WorkQueue.
+    :param poll: The seconds to wait when no task is pending.
+    :param worker: The name of the worker, host:pid by default.
+    :return: The number of tasks done by the worker.
+    See run_task for the other params.
+    """
+    backend = backend or create_backend()
+    if scratch_path is not None and not os.path.exists(scratch_path):
+        os.makedirs(scratch_path)
+    worker = worker or '%s:%d' % (socket.gethostname(), os.getpid())
+    done, joined = 0, False
+    while True:
+        campaign = queue.campaign()
+        if campaign is None or campaign.get('closed'):
+            if joined:
+                break
+            time.sleep(poll)
+            continue
+        joined = True
+        queue.requeue_expired()
+        task = queue.claim(worker)
+        if task is None:
+            if queue.finished():
+                break
+            time.sleep(poll)
+            continue
+        print('\n### Claimed: %s by %s, attempt %d' % (task['id'], worker, task['attempts'] + 1))
+        with _Heartbeat(queue, task, worker, campaign['lease'] / 3.0) as heartbeat:
+            try:
+                result = run_task(task, campaign, run_path_absolute, scratch_path, glue_workers, backend)
+            except Exception as e:
+                print('\n### Failed: %s by %s, %s: %s' % (task['id'], worker, type(e).__name__, e))
+                queue.fail(task, worker, e)
+                continue
+        if heartbeat.lost or not queue.complete(task, worker, result):
+            print('\n### Lost lease: %s, which has gone to another worker' % task['id'])
+            continue
+        done += 1
+        print('\n### Done: %s by %s' % (task['id'], worker))
+    print('\n### Worker %s finished: %d tasks done' % (worker, done))
+    return done
+
+
+def _merge_cultivars(records, run_path_absolute, backend):
+    """
+    Write the .CUL lines calibrated by workers into the .CUL files of Dssat installed directory.
+    """
+    lines = {}
+    for record in records:
+        crop_type = RE_SUFFIXES[os.path.splitext(record['id'])[-1]]
+        lines.setdefault(crop_type, []).extend(record['result']['cultivars'].values())
+    for crop_type, crop_lines in lines.items():
+        if not crop_lines or crop_type not in ENCODINGS:
+            continue
+        path = os.path.join(backend.home(run_path_absolute), 'Genotype', '%s.CUL' % backend.cul_name(crop_type))
+        if not os.path.exists(path):
+            print('\n### Calibrated lines of %s are kept in done of the queue only, %s not found' % (crop_type, path))
+            continue
+        store = GenotypeStore(path, ENCODINGS[crop_type])
+        for line in crop_lines:
+            store.upsert(line)
+        store.flush()
+        print('\n### Merged %d calibrated lines into %s' % (len(crop_lines), path))
+
+
+def coordinate(queue, x_files, result_output, gl_epochs, glue_flag=1, simulation_model='B', compactor=None,
+               resume=False, poll=5, journal=None, run_path_absolute=None, backend=None, cache=None, recorder=None):
+    """
+    Publish a task for every x_file to queue, then wait for the workers while expired leases are put back
+    and the progress is printed. x_files and result_output must be on the filesystem shared by the workers.
+    At last the .CUL lines calibrated by workers are merged into the .CUL files of Dssat installed directory,
+    if there is one on the coordinator.
+    :param queue: WorkQueue.
+    :param compactor: Optional Compactor, whose keep and archive are used by workers before pushing results.
+    :param resume: Keep the tasks done before with the same .X file.
+    :param poll: The seconds between two looks at the queue.
+    :param journal: Optional journal.Journal. The files run in it are skipped, and the stages done or failed are
+        recorded in it.
+    :param cache: Optional ResultCache on the shared filesystem, which workers open with the same params.
+        The stats of workers are merged into it.
+    :param recorder: Optional instrument.Recorder, which gets the events recorded by workers.
+    See run_parallel for the other params.
+    :return: {x_file: result directory} of the files done or skipped.
+    """
+    backend = backend or create_backend()
+    results, tasks, digests = {}, [], {}
+    for x_file in x_files:
+        digests[x_file] = file_digest(x_file)
+        if journal is not None and journal.done(os.path.basename(x_file), 'run', digest=digests[x_file]):
+            results[x_file] = _result_path(result_output, x_file)
+            print('\n### Skipped: %s, which has finished before' % results[x_file])
+        else:
+            tasks.append((os.path.basename(x_file), os.path.abspath(x_file), digests[x_file]))
+    cache_params = None
+    if cache is not None:
+        cache_params = {'root': os.path.abspath(cache.root), 'max_bytes': cache.max_bytes, 'link': cache.link}
+    settings = {'result_output': os.path.abspath(result_output),
+                'gl_epochs': int(gl_epochs) if gl_epochs is not None else None, 'glue_flag': glue_flag,
+                'simulation_model': simulation_model,
+                'compact': {'keep': compactor.keep, 'archive': compactor.archive} if compactor is not None else None,
+                'cache': cache_params, 'record': recorder is not None}
+    put = queue.publish(tasks, settings, resume)
+    print('\n### Published: %d tasks to %s, %d done before' % (len(put), queue.path, len(tasks) - len(put)))
+
+    summary = None
+    while True:
+        queue.requeue_expired()
+        progress = queue.progress()
+        if queue.summary(progress) != summary:
+            summary = queue.summary(progress)
+            print('\n' + queue.view(progress))
+        if queue.finished(progress):
+            break
+        time.sleep(poll)
+    queue.close()
+
+    by_id = {os.path.basename(x_file): x_file for x_file in x_files}
+    done = [record for record in queue.records('done') if record['id'] in by_id]
+    for record in done:
+        x_file = by_id[record['id']]
+        results[x_file] = record['result']['result']
+        if cache is not None:
+            cache.merge_stats(record['result']['stats'])
+        for event in record['result']['events'] if recorder is not None else []:
+            recorder.emit(event)
+        if journal is not None:
+            journal.mark(record['id'], 'run', digest=record['digest'])
+    _merge_cultivars(done, run_path_absolute, backend)
+    for record in queue.records('failed'):
+        print('\n### Failed: %s after %d attempts, %s' % (record['id'], record['attempts'], record['errors'][-1]))
+        if journal is not None:
+            journal.fail(record['id'], 'run', record['errors'][-1])
+    return results
@@ -0,0 +1,149 @@
+import os
+import re
+from collections import OrderedDict
+
+# {absolute path: (st_mtime_ns, st_size, XFile)}, the least recently used one is dropped first
+_CACHE = OrderedDict()
+_CACHE_SIZE = 1024
+
+
+class Table(object):
+    def __init__(self, section, header):
+        """
+        A block of rows under a '@' header line of .X file.
+        A row is split by blanks if it gives one value for each column. Otherwise (names with blanks),
+        every column spans from the end of previous header name to the end of its own name,
+        and the last one spans to the end of line, which fits the fixed width layout of DSSAT.
+        :param section: The name of '*' section this table belongs to.
+        :param header: The '@' header line.
+        """
+        self.section = section
+        self.header = header
+        self.columns, self._spans = [], []
+        begin = 0
+        for m in re.finditer(r'\S+', header):
+            if m.group() == '@':
+                # A bare '@' only marks the header line, such as '@   RUNNO   TRNO' in Summary.OUT
+                continue
+            self.columns.append(m.group().strip('@.'))
+            self._spans.append((begin, m.end()))
+            begin = m.end()
+        if self._spans:
+            self._spans[-1] = (self._spans[-1][0], None)
+        self.rows = []
+
+    def append(self, line):
+        values = line.split()
+        if len(values) != len(self.columns):
+            values = [line[b:e].strip() for b, e in self._spans]
+        self.rows.append(dict(zip(self.columns, values)))
+
+    def column(self, name):
+        """
+        :return: The values of column name in every row.
+        """
+        return [row[name] for row in self.rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class XFile(object):
+    def __init__(self, text):
+        """
+        Index every '*' section and '@' table of .X file with a single pass over its text.
+        :param text: The text of .X file.
+        """
+        # The title after *EXP.DETAILS:
+        self.details = ''
+        # {section name: [Table, ...]}
+        self.sections = OrderedDict()
+        section, table = None, None
+        for line in text.splitlines():
+            if line.startswith('*'):
+                title = line[1:].split(':', 1)
+                section = re.split(r'\s{2,}', title[0].strip())[0]
+                if section == 'EXP.DETAILS' and len(title) > 1:
+                    self.details = title[1].strip()
+                self.sections.setdefault(section, [])
+                table = None
+            elif line.startswith('@'):
+                table = Table(section, line)
+                self.sections.setdefault(section, []).append(table)
+            elif not line.strip():
+                table = None
+            elif table is not None and not line.startswith('!'):
+                table.append(line)
+
+    def table(self, section, column):
+        """
+        :return: The first table of section which has column, None if there isn't one.
+        """
+        for table in self.sections.get(section, []):
+            if column in table.columns:
+                return table
+        return None
+
+    def _rows(self, section, column):
+        table = self.table(section, column)
+        if table is None:
+            raise ValueError('There is no *%s table with %s in .X file' % (section, column))
+        return table.rows
+
+    @property
+    def treatments(self):
+        """
+        :return: [{'N':.., 'TNAME':.., 'CU':.., 'FL':.., 'MF':.., ...}, ...]
+        """
+        return self._rows('TREATMENTS', 'TNAME')
+
+    @property
+    def cultivars(self):
+        """
+        :return: [{'C':.., 'CR':.., 'INGENO':.., 'CNAME':..}, ...]
+        """
+        return self._rows('CULTIVARS', 'INGENO')
+
+    @property
+    def fields(self):
+        return self._rows('FIELDS', 'WSTA')
+
+    @property
+    def planting(self):
+        return self._rows('PLANTING DETAILS', 'PDATE')
+
+    @property
+    def fertilizers(self):
+        """
+        :return: {fertilizer level: [{'F':.., 'FDATE':.., 'FMCD':.., ...}, ...]}
+        """
+        levels = OrderedDict()
+        table = self.table('FERTILIZERS (INORGANIC)', 'FDATE')
+        for row in (table.rows if table is not None else []):
+            levels.setdefault(row['F'], []).append(row)
+        return levels
+
+
+def read_xfile(path, encoding='utf-8'):
+    """
+    Read and parse .X file with one bulk read.
+    The result is cached until the modified time or size of path changes.
+    :param path: The path to .X file.
+    :param encoding: The encoding of .X file.
+    :return: XFile
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    cached = _CACHE.get(path)
+    if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        _CACHE.move_to_end(path)
+        return cached[2]
+    with open(path, 'rb') as fp:
+        xfile = XFile(fp.read().decode(encoding))
+    _CACHE[path] = (stat.st_mtime_ns, stat.st_size, xfile)
+    if len(_CACHE) > _CACHE_SIZE:
+        _CACHE.popitem(last=False)
+    return xfile